@@ -26,3 +26,4 @@ TTT_FILE = 'task_design.ttt'
 
 DEPTH_SCALE = 2**24 - 1
 
+PACKED_EPISODE = 'episode.pack'
@@ -20,6 +20,7 @@ from amsolver.backend.utils import WriteCustomDataBlock, import_distractors, rgb
 from amsolver.demo import Demo
 from amsolver.noise_model import NoiseModel
 from amsolver.observation_config import ObservationConfig, CameraConfig
+from amsolver.point_cloud import pointcloud_from_depth_and_camera_params
 
 STEPS_BEFORE_EPISODE_START = 10
 
@@ -224,7 +225,8 @@ class Scene(object):
                         near = sensor.get_near_clipping_plane()
                         far = sensor.get_far_clipping_plane()
                         depth_m = near + depth * (far - near)
-                    pcd = sensor.pointcloud_from_depth(depth_m)
+                    pcd = pointcloud_from_depth_and_camera_params(
+                        depth_m, sensor.get_matrix(), sensor.get_intrinsic_matrix())
                     if not get_depth:
                         depth = None
             return rgb, depth, pcd
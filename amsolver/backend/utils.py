@@ -19,6 +19,7 @@ from pyrep.robots.end_effectors.gripper import Gripper
 from amsolver.backend.robot import Robot
 from pyrep.objects.cartesian_path import CartesianPath
 from amsolver.const import colors
+from amsolver import depth_codec
 from amsolver.backend.spawn_boundary import BoundaryObject, BoundingBox, SpawnBoundary
 from copy import deepcopy
 from pyrep.backend import sim
@@ -74,28 +75,9 @@ def float_array_to_rgb_image(float_array,
   Returns:
     24-bit RGB PIL Image object representing depth values.
   """
-  # Scale the floating point array.
-  scaled_array = np.floor(float_array * scale_factor + 0.5)
-  # Convert the array to integer type and clip to representable range.
-  min_inttype = 0
-  max_inttype = 2**24 - 1
-  scaled_array = ClipFloatValues(scaled_array, min_inttype, max_inttype)
-  int_array = scaled_array.astype(np.uint32)
-  # Calculate:
-  #   r = (f / 256) / 256  high byte
-  #   g = (f / 256) % 256  middle byte
-  #   b = f % 256          low byte
-  rg = np.divide(int_array, 256)
-  r = np.divide(rg, 256)
-  g = np.mod(rg, 256)
-  image_shape = int_array.shape
-  rgb_array = np.zeros((image_shape[0], image_shape[1], 3), dtype=np.uint8)
-  rgb_array[..., 0] = r
-  rgb_array[..., 1] = g
-  if not drop_blue:
-    # Calculate the blue channel and add it to the array.
-    b = np.mod(int_array, 256)
-    rgb_array[..., 2] = b
+  # Scale, round and clip to 24 bits, then split into bytes, see amsolver.depth_codec.
+  int_array = depth_codec.float_array_to_code(np.asarray(float_array), scale_factor)
+  rgb_array = depth_codec.code_to_rgb(int_array, drop_blue)
   image_mode = 'RGB'
   image = Image.fromarray(rgb_array, mode=image_mode)
   return image
@@ -183,9 +165,9 @@ def image_to_float_array(image, scale_factor=None):
   assert 2 <= len(image_shape) <= 3
   if channels == 3:
     # RGB image needs to be converted to 24 bit integer.
-    float_array = np.sum(image_array * [65536, 256, 1], axis=2)
     if scale_factor is None:
       scale_factor = DEFAULT_RGB_SCALE_FACTOR
+    return depth_codec.code_to_float_array(depth_codec.rgb_to_code(image_array), scale_factor)
   else:
     if scale_factor is None:
       scale_factor = DEFAULT_GRAY_SCALE_FACTOR[image_dtype.type]
@@ -431,7 +413,7 @@ def get_sorted_grasp_pose(obj_pose, local_grasp_pose, sort_key="vertical"):
   grasp_pose = grasp_pose[sort_select]
   return grasp_pose
 
-def get_local_grasp_pose(obj: Object, ply_file: str, grasp_pose_path = './vlm/grasp_poses/', need_rebuild=False, use_meshlab=True, crop_box:Object =None):
+def local_grasp_pose_args(obj: Object, ply_file: str, grasp_pose_path = './vlm/grasp_poses/', use_meshlab=True, crop_box:Object =None):
   args = define_default_args()
   args.input_file = ply_file
   args.output_file = os.path.join(grasp_pose_path, ply_file.split('/')[-1][:-4] + '.pkl')
@@ -448,11 +430,24 @@ def get_local_grasp_pose(obj: Object, ply_file: str, grasp_pose_path = './vlm/gr
     args.crop_x_max = crop_boundary[1]
     args.crop_y_max = crop_boundary[3]
     args.crop_z_max = crop_boundary[5]
+  return args, obj_origin_matrix
+
+def get_local_grasp_pose(obj: Object, ply_file: str, grasp_pose_path = './vlm/grasp_poses/', need_rebuild=False, use_meshlab=True, crop_box:Object =None, jobs=None):
+  """
+  Grasp poses of obj in its own frame, searched on its mesh exported to ply_file, or loaded
+  from a previous search. If jobs is a list, a needed search is appended to it as
+  (args, origin_offset) instead, to run several objects at once with run_grasploc_jobs,
+  and None is returned.
+  """
+  args, obj_origin_matrix = local_grasp_pose_args(obj, ply_file, grasp_pose_path, use_meshlab, crop_box)
   gl = Grasploc(args)
   # scale_object(self.toy, 0.5)
   
   if not os.path.exists(args.output_file) or need_rebuild:
     exportMesh(obj, 'binary_ply', ply_file[:-4])
+    if jobs is not None:
+      jobs.append((args, obj_origin_matrix))
+      return None
     gl.run(obj_origin_matrix)
   else:
     gl.load_result()
@@ -0,0 +1,300 @@
+"""
+Packed episode store.
+
+Every `episodes/episodeN` folder can be packed into a single file
+(`episode.pack`) that holds one fixed-dtype array per camera and modality,
+laid out frame-major so that one frame of one camera is a contiguous chunk.
+The file is memory-mapped when loading, so only the pages of the requested
+frames and cameras are ever read and no PNG has to be decoded.
+
+Layout of the file:
+    PACK_MAGIC | uint64 header length | json header | arrays (PACK_ALIGN aligned)
+"""
+import json
+import mmap
+import os
+import pickle
+from collections import OrderedDict
+from os import listdir
+from os.path import join, exists
+from typing import List, Tuple
+
+import numpy as np
+from PIL import Image
+
+from amsolver import depth_codec
+from amsolver.backend.const import *
+from amsolver.backend.utils import rgb_handles_to_mask
+from amsolver.demo import Demo
+from amsolver.observation_config import ObservationConfig
+from amsolver.utils import get_stored_demos, set_point_clouds
+
+PACK_MAGIC = b'VLMPACK1'
+PACK_VERSION = 1
+PACK_ALIGN = 4096
+
+CAMERAS = ['left_shoulder', 'right_shoulder', 'overhead', 'wrist', 'front']
+MODALITIES = ['rgb', 'depth', 'mask']
+
+# Number of packed episodes kept open (one mmap and one fd each) per process.
+MAX_OPEN_PACKS = 64
+
+
+def depth_image_to_code(depth_image: np.ndarray) -> np.ndarray:
+    """Converts (..., 3) 24-bit RGB coded depth into the uint32 fixed point code."""
+    return depth_codec.rgb_to_code(depth_image)
+
+
+def source_stamp(example_path, cameras=CAMERAS, modalities=('rgb', 'depth')) -> List[Tuple[str, int, int]]:
+    """(name, mtime, size) of low_dim_obs.pkl, episode.pack and the image folders of an episode that exist."""
+    names = [LOW_DIM_PICKLE, PACKED_EPISODE]
+    names += ['%s_%s' % (cam, modality) for cam in cameras for modality in modalities]
+    stamp = []
+    for name in names:
+        path = join(str(example_path), name)
+        if exists(path):
+            stat = os.stat(path)
+            stamp.append((name, stat.st_mtime_ns, stat.st_size))
+    return stamp
+
+
+def pack_episode(example_path, overwrite: bool = False) -> str:
+    """Packs the PNG folders of one episode into `example_path/episode.pack`.
+
+    rgb and mask are stored as the raw uint8 images, depth is stored as the
+    uint32 fixed point code so that decoding gives exactly the values of
+    `image_to_float_array`.
+    """
+    example_path = str(example_path)
+    pack_path = join(example_path, PACKED_EPISODE)
+    if exists(pack_path) and not overwrite:
+        return pack_path
+
+    with open(join(example_path, LOW_DIM_PICKLE), 'rb') as f:
+        obs = pickle.load(f)
+    num_steps = len(obs)
+
+    arrays = OrderedDict()
+    image_size = None
+    for cam in CAMERAS:
+        for modality in MODALITIES:
+            folder = join(example_path, '%s_%s' % (cam, modality))
+            if not exists(folder):
+                continue
+            if len(listdir(folder)) != num_steps:
+                raise RuntimeError('Broken dataset assumption')
+            data = np.stack([np.array(Image.open(join(folder, IMAGE_FORMAT % i)))
+                             for i in range(num_steps)])
+            if modality == 'depth':
+                data = depth_image_to_code(data)
+            if image_size is None:
+                image_size = [data.shape[2], data.shape[1]]
+            elif image_size != [data.shape[2], data.shape[1]]:
+                raise RuntimeError('All cameras of an episode must share the same image size')
+            arrays['%s_%s' % (cam, modality)] = np.ascontiguousarray(data)
+
+    header = {'version': PACK_VERSION, 'num_steps': num_steps,
+              'image_size': image_size}
+    write_pack(pack_path, arrays, header)
+    return pack_path
+
+
+def write_pack(pack_path, arrays, header) -> None:
+    """Atomically writes `arrays` (name -> ndarray) and a json `header` in the pack layout."""
+    header = dict(header, arrays=OrderedDict())
+    # The offsets depend on the header length, so grow the data start until it fits.
+    data_start = PACK_ALIGN
+    while True:
+        offset = data_start
+        for name, data in arrays.items():
+            header['arrays'][name] = {'dtype': data.dtype.str,
+                                      'shape': list(data.shape),
+                                      'offset': offset}
+            offset += -(-data.nbytes // PACK_ALIGN) * PACK_ALIGN
+        header_bytes = json.dumps(header).encode('utf-8')
+        if len(PACK_MAGIC) + 8 + len(header_bytes) <= data_start:
+            break
+        data_start += PACK_ALIGN
+
+    pack_path = str(pack_path)
+    tmp_path = '%s.%d.tmp' % (pack_path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(PACK_MAGIC)
+            f.write(np.uint64(len(header_bytes)).tobytes())
+            f.write(header_bytes)
+            for name, data in arrays.items():
+                f.seek(header['arrays'][name]['offset'])
+                f.write(np.ascontiguousarray(data).tobytes())
+            f.truncate(offset)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, pack_path)
+    except BaseException:
+        # A full disk must not leave partial temporary packs behind.
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def read_pack(pack_path):
+    """Returns the json header and the arrays of a pack, as views on one copy-on-write mmap."""
+    with open(str(pack_path), 'rb') as f:
+        if f.read(len(PACK_MAGIC)) != PACK_MAGIC:
+            raise RuntimeError('%s is not a packed file' % pack_path)
+        header_len = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(header_len).decode('utf-8'))
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    arrays = {
+        name: np.ndarray(tuple(info['shape']), dtype=np.dtype(info['dtype']),
+                         buffer=buffer, offset=info['offset'])
+        for name, info in header['arrays'].items()}
+    return header, arrays
+
+
+class PackedEpisode(object):
+    """Read-only view of an `episode.pack` file.
+
+    Arrays are numpy views on a single copy-on-write mmap, so indexing a frame
+    does not copy anything until the caller writes to it.
+    """
+
+    def __init__(self, pack_path):
+        self.path = str(pack_path)
+        header, self._arrays = read_pack(self.path)
+        if header['version'] != PACK_VERSION:
+            raise RuntimeError('Unsupported pack version %s in %s' % (
+                header['version'], self.path))
+        self.mtime = os.stat(self.path).st_mtime_ns
+        self.num_steps = header['num_steps']
+        self.image_size = tuple(header['image_size'])
+
+    def __contains__(self, name):
+        return name in self._arrays
+
+    def rgb(self, camera: str, frame: int) -> np.ndarray:
+        return self._arrays['%s_rgb' % camera][frame]
+
+    def depth(self, camera: str, frame: int) -> np.ndarray:
+        """Depth normalised between near and far, as `image_to_float_array`."""
+        return depth_codec.code_to_float_array(self._arrays['%s_depth' % camera][frame], DEPTH_SCALE)
+
+    def mask(self, camera: str, frame: int) -> np.ndarray:
+        return rgb_handles_to_mask(self._arrays['%s_mask' % camera][frame])
+
+
+_open_packs = OrderedDict()
+
+
+def open_packed_episode(example_path):
+    """Returns the PackedEpisode of `example_path`, or None if it is not packed."""
+    pack_path = join(str(example_path), PACKED_EPISODE)
+    if not exists(pack_path):
+        return None
+    pack = _open_packs.get(pack_path)
+    if pack is not None and pack.mtime == os.stat(pack_path).st_mtime_ns:
+        _open_packs.move_to_end(pack_path)
+        return pack
+    pack = PackedEpisode(pack_path)
+    _open_packs[pack_path] = pack
+    if len(_open_packs) > MAX_OPEN_PACKS:
+        _open_packs.popitem(last=False)
+    return pack
+
+
+def get_stored_demos_packed(amount: int, image_paths: bool, dataset_root: str,
+                            variation_number: int, task_name: str,
+                            obs_config: ObservationConfig,
+                            episode_number = None,
+                            fail_demos = False,
+                            selected_frame=None) -> List[Demo]:
+    """Drop-in replacement of `get_stored_demos` reading from packed episodes.
+
+    Episodes without an `episode.pack`, packed at another image size, or
+    requested as image paths fall back to `get_stored_demos`.
+    """
+    task_root = join(dataset_root, task_name)
+    if not exists(task_root):
+        raise RuntimeError("Can't find the demos for %s at: %s" % (
+            task_name, task_root))
+
+    examples_path = join(
+        task_root, VARIATIONS_FOLDER % variation_number,
+        'fail_cases' if fail_demos else EPISODES_FOLDER)
+    examples = listdir(examples_path)
+    if amount == -1:
+        amount = len(examples)
+    if amount > len(examples):
+        raise RuntimeError(
+            'You asked for %d examples, but only %d were available.' % (
+                amount, len(examples)))
+    if episode_number is None:
+        selected_examples = np.random.choice(examples, amount, replace=False)
+    else:
+        selected_examples = [episode_number]
+
+    demos = []
+    for example in selected_examples:
+        example_path = join(examples_path, example)
+        pack = None if image_paths else open_packed_episode(example_path)
+        cam_configs = {cam: getattr(obs_config, '%s_camera' % cam) for cam in CAMERAS}
+        if pack is not None and any(
+                (c.rgb or c.depth or c.point_cloud or c.mask)
+                and tuple(c.image_size) != pack.image_size
+                for c in cam_configs.values()):
+            pack = None
+        if pack is None:
+            demos += get_stored_demos(1, image_paths, dataset_root, variation_number,
+                                      task_name, obs_config, example, fail_demos,
+                                      selected_frame)
+            continue
+
+        with open(join(example_path, LOW_DIM_PICKLE), 'rb') as f:
+            obs = pickle.load(f)
+        num_steps = len(obs)
+        if num_steps != pack.num_steps:
+            raise RuntimeError('Broken dataset assumption')
+
+        frames = range(num_steps) if selected_frame is None else selected_frame
+        point_cloud_depths = {cam: [] for cam in CAMERAS}
+        for i in frames:
+            for cam, config in cam_configs.items():
+                if config.rgb:
+                    setattr(obs[i], '%s_rgb' % cam, pack.rgb(cam, i))
+                if config.depth or config.point_cloud:
+                    depth = pack.depth(cam, i)
+                    near = obs[i].misc['%s_camera_near' % cam]
+                    far = obs[i].misc['%s_camera_far' % cam]
+                    depth_m = near + depth * (far - near)
+                    if config.depth:
+                        d = depth_m if config.depth_in_meters else depth
+                        setattr(obs[i], '%s_depth' % cam, config.depth_noise.apply(d))
+                    else:
+                        setattr(obs[i], '%s_depth' % cam, None)
+                    if config.point_cloud:
+                        point_cloud_depths[cam].append((i, depth_m))
+                if config.mask:
+                    setattr(obs[i], '%s_mask' % cam, pack.mask(cam, i))
+
+            # Remove low dim info if necessary
+            if not obs_config.joint_velocities:
+                obs[i].joint_velocities = None
+            if not obs_config.joint_positions:
+                obs[i].joint_positions = None
+            if not obs_config.joint_forces:
+                obs[i].joint_forces = None
+            if not obs_config.gripper_open:
+                obs[i].gripper_open = None
+            if not obs_config.gripper_pose:
+                obs[i].gripper_pose = None
+            if not obs_config.gripper_joint_positions:
+                obs[i].gripper_joint_positions = None
+            if not obs_config.gripper_touch_forces:
+                obs[i].gripper_touch_forces = None
+            if not obs_config.task_low_dim_state:
+                obs[i].task_low_dim_state = None
+
+        for cam, depths in point_cloud_depths.items():
+            set_point_clouds(obs, cam, depths)
+        demos.append(obs)
+    return demos
@@ -0,0 +1,100 @@
+"""
+Keypoint discovery on the low dimensional state of a demo.
+
+The gripper state and joint velocities of all frames are gathered into
+contiguous arrays once, then gripper changes, stops and the final frame are
+found with array operations. Keypoints of stored episodes are cached per
+low_dim_obs.pkl, keyed by its path, mtime and size, so a dataset computes
+them once per episode and process.
+"""
+import os
+import pickle
+from os.path import join
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from amsolver.backend.const import LOW_DIM_PICKLE
+
+# Frames skipped after a stop before another stop can be detected.
+STOPPED_BUFFER = 4
+# A frame is still if every joint velocity is within this tolerance of 0.
+STOPPED_ATOL = 0.1
+
+_episode_keypoints: Dict[Tuple[str, int, int], Tuple[int, ...]] = {}
+
+
+def low_dim_arrays(demo) -> Tuple[np.ndarray, np.ndarray]:
+    """Gripper open state (T,) and joint velocities (T, J) of every frame of a demo."""
+    gripper_open = np.array([obs.gripper_open for obs in demo], dtype=np.float64)
+    joint_velocities = np.array([obs.joint_velocities for obs in demo], dtype=np.float64)
+    return gripper_open, joint_velocities.reshape(len(gripper_open), -1)
+
+
+def stopped_frames(gripper_open: np.ndarray, joint_velocities: np.ndarray,
+                   stopped_buffer: int = STOPPED_BUFFER) -> np.ndarray:
+    """Frames where the arm is still while the gripper keeps its state.
+
+    As the per-frame check this replaces, the neighbours of the first two
+    frames wrap around the end of the episode, and after a stop the next
+    `stopped_buffer` frames cannot be stops.
+    """
+    n = len(gripper_open)
+    prev1 = np.roll(gripper_open, 1)
+    prev2 = np.roll(gripper_open, 2)
+    next1 = np.roll(gripper_open, -1)
+    gripper_state_no_change = (
+        (np.arange(n) < n - 2)
+        & (gripper_open == next1)
+        & (gripper_open == prev1)
+        & (prev2 == prev1)
+    )
+    small_delta = np.all(np.abs(joint_velocities) <= STOPPED_ATOL, axis=1)
+    candidates = np.flatnonzero(gripper_state_no_change & small_delta)
+
+    # Only the buffer is sequential, and it only has to look at candidates.
+    stopped = []
+    next_allowed = 0
+    for i in candidates:
+        if i >= next_allowed:
+            stopped.append(i)
+            next_allowed = i + stopped_buffer + 1
+    return np.array(stopped, dtype=np.int64)
+
+
+def keypoints_from_arrays(gripper_open: np.ndarray, joint_velocities: np.ndarray,
+                          stopped_buffer: int = STOPPED_BUFFER) -> List[int]:
+    """Gripper changes, stops and the last frame, with a stop right before the last frame dropped."""
+    gripper_open = np.asarray(gripper_open)
+    n = len(gripper_open)
+    if n < 2:
+        return []
+    changes = np.flatnonzero(gripper_open[1:] != gripper_open[:-1]) + 1
+    stopped = stopped_frames(gripper_open, joint_velocities, stopped_buffer)
+    keypoints = np.union1d(np.union1d(changes, stopped[stopped > 0]), [n - 1])
+    episode_keypoints = [int(i) for i in keypoints]
+    if len(episode_keypoints) > 1 and (episode_keypoints[-1] - 1) == episode_keypoints[-2]:
+        episode_keypoints.pop(-2)
+    return episode_keypoints
+
+
+def keypoint_discovery(demo) -> List[int]:
+    """Keypoints of a demo (a Demo or a list of observations)."""
+    return keypoints_from_arrays(*low_dim_arrays(demo))
+
+
+def episode_keypoints(example_path, demo=None) -> List[int]:
+    """Cached keypoints of a stored episode.
+
+    `demo` is the already unpickled low_dim_obs.pkl of the episode, if the
+    caller has it; otherwise it is only loaded on a cache miss.
+    """
+    low_dim_path = join(str(example_path), LOW_DIM_PICKLE)
+    stat = os.stat(low_dim_path)
+    key = (low_dim_path, stat.st_mtime_ns, stat.st_size)
+    if key not in _episode_keypoints:
+        if demo is None:
+            with open(low_dim_path, 'rb') as f:
+                demo = pickle.load(f)
+        _episode_keypoints[key] = tuple(keypoint_discovery(demo))
+    return list(_episode_keypoints[key])
@@ -0,0 +1,242 @@
+"""
+Columnar index of the low dimensional data of a dataset split.
+
+Datasets only need a few fields of every low_dim_obs.pkl to select frames
+and build ground truth, but unpickling the full Observation list costs far
+more than the fields themselves. The index gathers them once into a pack
+file (see amsolver.episode_store) at the split root:
+    frame_offsets    int64   E+1    frames of episode e are [offsets[e], offsets[e+1])
+    waypoint         int32   N      index into header['waypoint_names']
+    gripper_open     float64 N
+    gripper_pose     float64 N, 7
+    joint_velocities float64 N, J
+    objects          uint8   pickle of the object_informations of the frames
+                             where a waypoint starts (the only ones the
+                             datasets read), by episode
+with the episode names, their stamp (mtime and size of low_dim_obs.pkl),
+instructions and keypoints in the json header. Everything is in the one
+pack, written atomically, so readers never see parts of two versions.
+
+Stale or missing episodes are re-read when the index is opened, by one
+process at a time (a file lock next to the index): every DDP rank and
+dataset opening a split at once waits for the first one to update it, then
+finds it up to date. An index that cannot be read is rebuilt. The whole
+split can be indexed upfront with tools/build_low_dim_index.py.
+"""
+import os
+import pickle
+from multiprocessing import Pool
+from os.path import join
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from filelock import FileLock
+
+from amsolver.backend.const import LOW_DIM_PICKLE
+from amsolver.episode_store import read_pack, write_pack
+from amsolver.keypoints import keypoints_from_arrays
+
+INDEX_VERSION = 2
+INDEX_FILE = 'low_dim_index.pack'
+LOCK_FILE = 'low_dim_index.lock'
+
+
+def low_dim_stamp(example_path) -> List[int]:
+    stat = os.stat(join(str(example_path), LOW_DIM_PICKLE))
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def waypoint_starts(waypoint_names: Sequence) -> List[int]:
+    """First frame of every waypoint, starting from waypoint0 at frame 0."""
+    starts = [0]
+    previous_waypoint = "waypoint0"
+    for i, name in enumerate(waypoint_names):
+        if name != previous_waypoint:
+            previous_waypoint = name
+            starts.append(i)
+    return starts
+
+
+def _column(observations, name, width=None) -> np.ndarray:
+    values = [getattr(obs, name) for obs in observations]
+    if width is None:
+        return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+    return np.stack([np.full(width, np.nan) if v is None else np.asarray(v, dtype=np.float64)
+                     for v in values]).reshape(len(values), width)
+
+
+def read_episode(dataset_path: Path, episode: str) -> Dict:
+    """Index record of one episode, read from its low_dim_obs.pkl."""
+    example_path = Path(dataset_path) / episode
+    stamp = low_dim_stamp(example_path)
+    with open(example_path / LOW_DIM_PICKLE, 'rb') as f:
+        demo = pickle.load(f)
+    observations = demo._observations
+    waypoint_names = [obs.current_waypoint_name for obs in observations]
+    gripper_open = _column(observations, 'gripper_open')
+    velocities = [obs.joint_velocities for obs in observations]
+    joints = max([len(v) for v in velocities if v is not None] or [0])
+    joint_velocities = _column(observations, 'joint_velocities', joints)
+    return {
+        'episode': episode,
+        'stamp': stamp,
+        'instructions': [str(l) for l in demo.high_level_instructions],
+        'keypoints': keypoints_from_arrays(gripper_open, joint_velocities),
+        'waypoint_names': waypoint_names,
+        'gripper_open': gripper_open,
+        'gripper_pose': _column(observations, 'gripper_pose', 7),
+        'joint_velocities': joint_velocities,
+        'object_informations': {
+            i: observations[i].object_informations for i in waypoint_starts(waypoint_names)},
+    }
+
+
+def _read_episode(job):
+    return read_episode(*job)
+
+
+class EpisodeLowDim(object):
+    """Low dimensional data of one episode, as views on the index."""
+
+    def __init__(self, record: Dict):
+        self.name = record['episode']
+        self.stamp = record['stamp']
+        self.instructions = record['instructions']
+        self.keypoints = list(record['keypoints'])
+        self.waypoint_names = record['waypoint_names']
+        self.gripper_open = record['gripper_open']
+        self.gripper_pose = record['gripper_pose']
+        self.joint_velocities = record['joint_velocities']
+        self.object_informations = record['object_informations']
+
+    def __len__(self):
+        return len(self.gripper_open)
+
+    def waypoint_starts(self) -> List[int]:
+        return waypoint_starts(self.waypoint_names)
+
+    def waypoints(self) -> List[str]:
+        """Name of every waypoint, in the order of waypoint_starts."""
+        return ["waypoint0"] + [self.waypoint_names[i] for i in self.waypoint_starts()[1:]]
+
+
+class LowDimIndex(object):
+    """Low dimensional data of every indexed episode of a split."""
+
+    def __init__(self, dataset_path):
+        self.dataset_path = Path(dataset_path)
+        self._records: Dict[str, Dict] = {}
+        path = self.dataset_path / INDEX_FILE
+        if not path.is_file():
+            return
+        try:
+            header, arrays = read_pack(path)
+            if header.get('version') != INDEX_VERSION:
+                return
+            objects = pickle.loads(arrays['objects'].tobytes())
+        except (OSError, RuntimeError, ValueError, KeyError, pickle.UnpicklingError, EOFError):
+            return
+        names = header['waypoint_names']
+        offsets = arrays['frame_offsets']
+        for e, episode in enumerate(header['episodes']):
+            start, end = int(offsets[e]), int(offsets[e + 1])
+            self._records[episode] = {
+                'episode': episode,
+                'stamp': header['stamps'][e],
+                'instructions': header['instructions'][e],
+                'keypoints': header['keypoints'][e],
+                'waypoint_names': [names[i] for i in arrays['waypoint'][start:end]],
+                'gripper_open': arrays['gripper_open'][start:end],
+                'gripper_pose': arrays['gripper_pose'][start:end],
+                'joint_velocities': arrays['joint_velocities'][start:end],
+                'object_informations': objects[episode],
+            }
+
+    @classmethod
+    def open(cls, dataset_path, episodes: Optional[Sequence] = None, processes: int = 1) -> 'LowDimIndex':
+        """Index of `episodes` (default: every episode of the split), updated if stale."""
+        index = cls(dataset_path)
+        if episodes is None:
+            episodes = [p.parent.relative_to(index.dataset_path)
+                        for p in index.dataset_path.rglob(LOW_DIM_PICKLE)]
+        if not index.stale(episodes):
+            return index
+        try:
+            lock = FileLock(str(index.dataset_path / LOCK_FILE))
+            lock.acquire()
+        except OSError:
+            # A split that cannot be written to is indexed in memory.
+            index.update(index.stale(episodes), processes, write=False)
+            return index
+        try:
+            # Whoever held the lock may have indexed these episodes meanwhile.
+            index = cls(dataset_path)
+            stale = index.stale(episodes)
+            if stale:
+                index.update(stale, processes)
+        finally:
+            lock.release()
+        return index
+
+    def stale(self, episodes: Sequence) -> List[str]:
+        """The `episodes` missing from the index or changed since they were indexed."""
+        return [str(e) for e in episodes
+                if str(e) not in self._records
+                or self._records[str(e)]['stamp'] != low_dim_stamp(self.dataset_path / e)]
+
+    def update(self, episodes: Sequence[str], processes: int = 1, write: bool = True) -> None:
+        """Re-reads `episodes` from their pickles and rewrites the index (with the lock of open held)."""
+        jobs = [(self.dataset_path, str(e)) for e in episodes]
+        if processes > 1:
+            with Pool(processes) as pool:
+                records = pool.map(_read_episode, jobs)
+        else:
+            records = [_read_episode(job) for job in jobs]
+        for record in records:
+            self._records[record['episode']] = record
+        if write:
+            try:
+                self.write()
+            except OSError as e:
+                print('Could not write the low dimensional index of %s: %s' % (self.dataset_path, e))
+
+    def write(self) -> None:
+        episodes = sorted(self._records)
+        records = [self._records[e] for e in episodes]
+        names = sorted({n for r in records for n in r['waypoint_names']}, key=str)
+        name_ids = {n: i for i, n in enumerate(names)}
+        joints = max([r['joint_velocities'].shape[1] for r in records] or [0])
+
+        def padded(v):
+            return np.pad(v, ((0, 0), (0, joints - v.shape[1])), constant_values=np.nan)
+
+        arrays = {
+            'frame_offsets': np.cumsum([0] + [len(r['gripper_open']) for r in records]).astype(np.int64),
+            'waypoint': np.array([name_ids[n] for r in records for n in r['waypoint_names']], dtype=np.int32),
+            'gripper_open': np.concatenate([r['gripper_open'] for r in records] or [np.zeros(0)]),
+            'gripper_pose': np.concatenate([r['gripper_pose'] for r in records] or [np.zeros((0, 7))]),
+            'joint_velocities': np.concatenate(
+                [padded(r['joint_velocities']) for r in records] or [np.zeros((0, joints))]),
+        }
+        header = {
+            'version': INDEX_VERSION,
+            'episodes': episodes,
+            'stamps': [r['stamp'] for r in records],
+            'instructions': [r['instructions'] for r in records],
+            'keypoints': [r['keypoints'] for r in records],
+            'waypoint_names': names,
+        }
+        objects = {e: r['object_informations'] for e, r in zip(episodes, records)}
+        arrays['objects'] = np.frombuffer(pickle.dumps(objects, protocol=pickle.HIGHEST_PROTOCOL), dtype=np.uint8)
+        write_pack(self.dataset_path / INDEX_FILE, arrays, header)
+
+    def __contains__(self, episode) -> bool:
+        return str(episode) in self._records
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def __getitem__(self, episode) -> EpisodeLowDim:
+        return EpisodeLowDim(self._records[str(episode)])
+
@@ -0,0 +1,82 @@
+"""
+Point clouds of depth images, with the camera rays cached.
+
+A pixel (u, v) at depth d is the world point R K^-1 (d u, d v, d) + C, with K
+the intrinsics and [R | C] the extrinsics (camera to world). The rays
+K^-1 (u, v, 1) only depend on the intrinsics and the resolution, so they are
+computed once and kept, and a frame costs a rotation of the rays and a
+multiply-add. The rotation is also shared by the frames of a batch whose
+camera did not move, which is every camera but the wrist one.
+
+The results match VisionSensor.pointcloud_from_depth_and_camera_params of
+PyRep to float tolerance.
+"""
+from functools import lru_cache
+
+import numpy as np
+
+# Ray grids kept, one per (intrinsics, resolution), and rotated to the world
+# frame, one per camera pose: the fixed cameras stay in while the wrist churns.
+RAY_CACHE_SIZE = 32
+WORLD_RAY_CACHE_SIZE = 64
+
+
+@lru_cache(maxsize=RAY_CACHE_SIZE)
+def _camera_rays(intrinsics, height, width):
+    rays = np.ones((height * width, 3))
+    rays[:, 0] = np.tile(np.arange(width), height)
+    rays[:, 1] = np.repeat(np.arange(height), width)
+    rays = rays @ np.linalg.inv(np.array(intrinsics).reshape(3, 3)).T
+    rays.flags.writeable = False
+    return rays
+
+
+@lru_cache(maxsize=WORLD_RAY_CACHE_SIZE)
+def _world_rays(pose, height, width):
+    rays = _camera_rays(pose[:9], height, width) @ np.array(pose[9:]).reshape(3, 3).T
+    rays = rays.reshape(height, width, 3)
+    rays.flags.writeable = False
+    return rays
+
+
+def camera_rays(intrinsics: np.ndarray, resolution) -> np.ndarray:
+    """(H, W, 3) read-only rays of unit depth in the camera frame, cached."""
+    height, width = resolution
+    rays = _camera_rays(tuple(np.asarray(intrinsics, dtype=np.float64).ravel()), int(height), int(width))
+    return rays.reshape(height, width, 3)
+
+
+def pointcloud_from_depth_and_camera_params(depth: np.ndarray, extrinsics: np.ndarray,
+                                            intrinsics: np.ndarray) -> np.ndarray:
+    """(..., H, W, 3) world points of (..., H, W) depths in meters.
+
+    extrinsics (..., 4, 4) and intrinsics (..., 3, 3) broadcast against the
+    leading dimensions of depth, e.g. (frames,) with intrinsics shared by
+    every frame of a camera.
+    """
+    depth = np.asarray(depth)
+    batch, (height, width) = depth.shape[:-2], depth.shape[-2:]
+    depth = depth.reshape(-1, height, width, 1)
+    n = len(depth)
+    extrinsics = np.broadcast_to(extrinsics, batch + (4, 4)).reshape(n, 4, 4)
+    intrinsics = np.broadcast_to(intrinsics, batch + (3, 3)).reshape(n, 3, 3)
+
+    # Rays in the world frame, shared by the frames of the same camera pose.
+    poses = np.concatenate([intrinsics.reshape(n, 9), extrinsics[:, :3, :3].reshape(n, 9)], 1)
+    poses = poses.astype(np.float64)
+    if n > 1:
+        poses, pose_index = np.unique(poses, axis=0, return_inverse=True)
+        pose_index = pose_index.reshape(-1)
+    else:
+        pose_index = np.zeros(1, dtype=int)
+
+    points = np.empty((n, height, width, 3))
+    for p, pose in enumerate(poses):
+        rays = _world_rays(tuple(pose), height, width)
+        if len(poses) == 1:
+            np.multiply(depth, rays, out=points)
+        else:
+            frames = np.flatnonzero(pose_index == p)
+            points[frames] = depth[frames] * rays
+    points += extrinsics[:, np.newaxis, np.newaxis, :3, 3]
+    return points.reshape(batch + (height, width, 3))
@@ -8,12 +8,15 @@ from typing import List
 import numpy as np
 from PIL import Image
 from natsort import natsorted
-from pyrep.objects import VisionSensor
 
 from amsolver.backend.const import *
 from amsolver.backend.utils import image_to_float_array, rgb_handles_to_mask
 from amsolver.demo import Demo
 from amsolver.observation_config import ObservationConfig
+from amsolver.point_cloud import pointcloud_from_depth_and_camera_params
+
+
+CAMERAS = ['left_shoulder', 'right_shoulder', 'overhead', 'wrist', 'front']
 
 
 class InvalidTaskName(Exception):
@@ -163,6 +166,8 @@ def get_stored_demos(amount: int, image_paths: bool, dataset_root: str,
                 obs[i].task_low_dim_state = None
 
         if not image_paths:
+            # Point clouds are reconstructed per camera once all frames are read.
+            point_cloud_depths = {cam: [] for cam in CAMERAS}
             for i in selected_frame:
                 if obs_config.left_shoulder_camera.rgb:
                     obs[i].left_shoulder_rgb = np.array(
@@ -266,30 +271,15 @@ def get_stored_demos(amount: int, image_paths: bool, dataset_root: str,
                         obs[i].front_depth = None
 
                 if obs_config.left_shoulder_camera.point_cloud:
-                    obs[i].left_shoulder_point_cloud = VisionSensor.pointcloud_from_depth_and_camera_params(
-                        l_sh_depth_m,
-                        obs[i].misc['left_shoulder_camera_extrinsics'],
-                        obs[i].misc['left_shoulder_camera_intrinsics'])
+                    point_cloud_depths['left_shoulder'].append((i, l_sh_depth_m))
                 if obs_config.right_shoulder_camera.point_cloud:
-                    obs[i].right_shoulder_point_cloud = VisionSensor.pointcloud_from_depth_and_camera_params(
-                        r_sh_depth_m,
-                        obs[i].misc['right_shoulder_camera_extrinsics'],
-                        obs[i].misc['right_shoulder_camera_intrinsics'])
+                    point_cloud_depths['right_shoulder'].append((i, r_sh_depth_m))
                 if obs_config.overhead_camera.point_cloud:
-                    obs[i].overhead_point_cloud = VisionSensor.pointcloud_from_depth_and_camera_params(
-                        oh_depth_m,
-                        obs[i].misc['overhead_camera_extrinsics'],
-                        obs[i].misc['overhead_camera_intrinsics'])
+                    point_cloud_depths['overhead'].append((i, oh_depth_m))
                 if obs_config.wrist_camera.point_cloud:
-                    obs[i].wrist_point_cloud = VisionSensor.pointcloud_from_depth_and_camera_params(
-                        wrist_depth_m,
-                        obs[i].misc['wrist_camera_extrinsics'],
-                        obs[i].misc['wrist_camera_intrinsics'])
+                    point_cloud_depths['wrist'].append((i, wrist_depth_m))
                 if obs_config.front_camera.point_cloud:
-                    obs[i].front_point_cloud = VisionSensor.pointcloud_from_depth_and_camera_params(
-                        front_depth_m,
-                        obs[i].misc['front_camera_extrinsics'],
-                        obs[i].misc['front_camera_intrinsics'])
+                    point_cloud_depths['front'].append((i, front_depth_m))
 
                 # Masks are stored as coded RGB images.
                 # Here we transform them into 1 channel handles.
@@ -319,6 +309,9 @@ def get_stored_demos(amount: int, image_paths: bool, dataset_root: str,
                             obs[i].front_mask),
                             obs_config.front_camera.image_size)))
 
+            for cam, depths in point_cloud_depths.items():
+                set_point_clouds(obs, cam, depths)
+
         demos.append(obs)
     if len(demos)==0:
         print(1)
@@ -611,6 +604,19 @@ def get_stored_demos_nodepth(amount: int, image_paths: bool, dataset_root: str,
     return demos
 
 
+def set_point_clouds(obs, camera, depths):
+    """Sets the point clouds of (frame, depth in meters) pairs of a camera, reconstructed as one batch."""
+    if not depths:
+        return
+    frames = [i for i, _ in depths]
+    point_clouds = pointcloud_from_depth_and_camera_params(
+        np.stack([d for _, d in depths]),
+        np.stack([obs[i].misc['%s_camera_extrinsics' % camera] for i in frames]),
+        np.stack([obs[i].misc['%s_camera_intrinsics' % camera] for i in frames]))
+    for i, point_cloud in zip(frames, point_clouds):
+        setattr(obs[i], '%s_point_cloud' % camera, point_cloud)
+
+
 def _resize_if_needed(image, size):
     if image.size[0] != size[0] or image.size[1] != size[1]:
         image = image.resize(size)
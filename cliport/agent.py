@@ -701,7 +701,7 @@ class BlindLangAgent_6Dof(TransporterAgent_6Dof):
         )
     def attn_forward(self, inp, softmax=True):
         inp_img = inp['inp_img']
-        inp_img = np.zeros_like(inp_img)
+        inp_img = torch.zeros_like(inp_img) if torch.is_tensor(inp_img) else np.zeros_like(inp_img)
         lang_goal = inp['lang_goal']
 
         out = self.attention.forward(inp_img, lang_goal, softmax=softmax)
@@ -709,7 +709,7 @@ class BlindLangAgent_6Dof(TransporterAgent_6Dof):
 
     def trans_forward(self, inp, softmax=True):
         inp_img = inp['inp_img']
-        inp_img = np.zeros_like(inp_img)
+        inp_img = torch.zeros_like(inp_img) if torch.is_tensor(inp_img) else np.zeros_like(inp_img)
         p0 = inp['p0']
         lang_goal = inp['lang_goal']
 
@@ -718,7 +718,7 @@ class BlindLangAgent_6Dof(TransporterAgent_6Dof):
     
     def rpz_forward(self, inp, softmax=True):
         inp_img = inp['inp_img']
-        inp_img = np.zeros_like(inp_img)
+        inp_img = torch.zeros_like(inp_img) if torch.is_tensor(inp_img) else np.zeros_like(inp_img)
         p0 = inp['p0']
         lang_goal = inp['lang_goal']
 
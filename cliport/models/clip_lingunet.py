@@ -69,7 +69,8 @@ class CLIPLingUNet(CLIPLingUNetLat):
         x = x.to(in_type)
 
         # encode text
-        l_enc, l_emb, l_mask = self.encode_text(l)
+        encoded = isinstance(l, tuple) and not isinstance(l[0], str)
+        l_enc, l_emb, l_mask = l if encoded else self.encode_text(l)
         l_input = l_emb if 'word' in self.lang_fusion_type else l_enc
         l_input = l_input.to(dtype=x.dtype)
 
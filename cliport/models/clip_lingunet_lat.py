@@ -6,6 +6,8 @@ import cliport.utils.utils as utils
 from cliport.models.resnet import IdentityBlock, ConvBlock
 from cliport.models.core.unet import Up
 from cliport.models.core.clip import build_model, load_clip, tokenize
+from cliport.models.core.clip_registry import get_frozen_clip
+from cliport.models.core.text_cache import get_text_cache
 # from clip import load, tokenize
 
 from cliport.models.core import fusion
@@ -29,9 +31,8 @@ class CLIPLingUNetLat(nn.Module):
         self.preprocess = preprocess
 
         # self._load_clip()
-        self.clip_rn50,_ = load_clip('RN50', device=self.device)
-        for parameter in self.clip_rn50.parameters():
-            parameter.requires_grad=False
+        # frozen, with its parameters shared by every stream of the process
+        self.clip_rn50 = get_frozen_clip('RN50', device=self.device)
         self._build_decoder()
 
     def _load_clip(self):
@@ -95,6 +96,13 @@ class CLIPLingUNetLat(nn.Module):
         return img_encoding, img_im
 
     def encode_text(self, x):
+        # Every text is padded to the context length and the weights are shared and
+        # frozen, so the encodings are cached per text for all the streams.
+        texts = [x] if isinstance(x, str) else list(x)
+        cache = get_text_cache(('clip', 'RN50'), self.device)
+        return cache.lookup(texts, self._encode_text)
+
+    def _encode_text(self, x):
         with torch.no_grad():
             tokens = tokenize(x).to(self.device)
             text_feat, text_emb = self.clip_rn50.encode_text_with_embeddings(tokens)
@@ -112,7 +120,8 @@ class CLIPLingUNetLat(nn.Module):
         x, im = self.encode_image(x)
         x = x.to(in_type)
 
-        l_enc, l_emb, l_mask = self.encode_text(l)
+        encoded = isinstance(l, tuple) and not isinstance(l[0], str)
+        l_enc, l_emb, l_mask = l if encoded else self.encode_text(l)
         l_input = l_emb if 'word' in self.lang_fusion_type else l_enc
         l_input = l_input.to(dtype=x.dtype)
 
@@ -32,6 +32,9 @@ class Attention(nn.Module):
         self.in_shape = in_shape
 
         self.rotator = utils.ImageRotator(self.n_rotations)
+        # Rotations folded into the batch of one stream pass at inference (1 runs
+        # them one by one). Training always runs them one by one, see attend_rotations.
+        self.rotation_chunk = self.cfg['train'].get('attn_rotation_chunk', 12)
 
         self._build_nets()
 
@@ -43,6 +46,26 @@ class Attention(nn.Module):
     def attend(self, x):
         return self.attn_stream(x)
 
+    def attend_rotations(self, in_tens, *args):
+        """Attend over the n rotated BxCxHxW inputs, up to rotation_chunk rotations per pass.
+
+        Rotations are stacked sample-major into the batch, so a per-sample
+        language input of batch B is tiled over them by the fusion layers.
+        In train mode every rotation gets its own batch-B pass, as the
+        BatchNorm layers of the streams would otherwise take their batch
+        statistics (and running statistic updates) over all the rotations.
+        Returns B x n x 1 x H x W logits.
+        """
+        b = in_tens[0].shape[0]
+        chunk = 1 if self.training else max(1, int(self.rotation_chunk))
+        logits = []
+        for i in range(0, len(in_tens), chunk):
+            x = torch.stack(in_tens[i:i + chunk], dim=1)  # [B k 6 W H]
+            k = x.shape[1]
+            lgts = self.attend(x.reshape((b * k,) + x.shape[2:]), *args)
+            logits.append(lgts.reshape((b, k) + lgts.shape[1:]))
+        return torch.cat(logits, dim=1)
+
     # def forward(self, inp_img, softmax=True):
     #     """Forward pass."""
     #     in_data = np.pad(inp_img, self.padding, mode='constant')
@@ -82,15 +105,12 @@ class Attention(nn.Module):
         """Forward pass."""
         padding = np.zeros((4,2),dtype=int)
         padding[1:,:] = self.padding
-        in_data = np.pad(inp_img, padding, mode='constant')
-        # in_shape = (1,) + in_data.shape
-        # in_data = in_data.reshape(in_shape)
-        in_tens = torch.from_numpy(in_data).to(dtype=torch.float, device=self.device)  # [B W H 6]
+        in_tens = utils.pad_image_batch(inp_img, padding, self.device)  # [B W H 6]
 
         # Rotation pivot.
-        pv = np.zeros((in_data.shape[0], 2))
-        pv[:, 0] = in_data.shape[1]//2
-        pv[:, 1] = in_data.shape[2]//2
+        pv = np.zeros((in_tens.shape[0], 2))
+        pv[:, 0] = in_tens.shape[1]//2
+        pv[:, 1] = in_tens.shape[2]//2
         # pv = np.array([in_data.shape[1:3]]) // 2
 
         # Rotate input.
@@ -100,11 +120,7 @@ class Attention(nn.Module):
         in_tens = self.rotator(in_tens, pivot=pv)
 
         # Forward pass.
-        logits = []
-        for x in in_tens:
-            lgts = self.attend(x)
-            logits.append(lgts)
-        logits = torch.stack(logits, dim=1)
+        logits = self.attend_rotations(in_tens)
 
         # Rotate back output.
         logits = self.rotator(logits, reverse=True, pivot=pv)
@@ -0,0 +1,60 @@
+"""
+Frozen CLIP backbones shared by the cliport streams.
+
+Every CLIPLingUNetLat stream of an agent (attention, transport key and query,
+rpz) holds a frozen CLIP model. Rather than loading one per stream, each
+(model, device) is loaded once per process by get_frozen_clip, and every
+stream gets a view of it: the parameters are the shared, frozen tensors, the
+buffers (the running statistics of the batch norms, which train() still
+updates, and which checkpoints hold per stream) are the stream's own. The
+outputs are the ones of separate copies.
+
+The shared parameters are read-only: a stream must neither unfreeze them nor
+move its backbone to another device.
+"""
+import copy
+from time import time
+from typing import Dict, Tuple, Union
+
+import torch
+from torch import nn
+
+from cliport.models.core.clip import load_clip
+
+# Loaded backbones, one per (model name, device), never handed out themselves.
+_backbones: Dict[Tuple[str, str], nn.Module] = {}
+_stats: Dict[Tuple[str, str], Dict] = {}
+
+
+def _tensor_bytes(tensors) -> int:
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def get_frozen_clip(name: str = 'RN50', device: Union[str, torch.device] = 'cuda') -> nn.Module:
+    """A view of the frozen CLIP `name` on `device`, sharing its parameters with every other view."""
+    key = (name, str(torch.device(device)))
+    if key not in _backbones:
+        start = time()
+        model, _ = load_clip(name, device=device)
+        for parameter in model.parameters():
+            parameter.requires_grad = False
+        _backbones[key] = model
+        _stats[key] = {
+            'load_seconds': time() - start,
+            'parameter_bytes': _tensor_bytes(model.parameters()),
+            'buffer_bytes': _tensor_bytes(model.buffers()),
+            'views': 0,
+        }
+        print('Loaded frozen CLIP %s on %s in %.1f s, %.0f MB of parameters shared by its views' % (
+            name, key[1], _stats[key]['load_seconds'], _stats[key]['parameter_bytes'] / 2 ** 20))
+    backbone = _backbones[key]
+    _stats[key]['views'] += 1
+    return copy.deepcopy(backbone, memo={id(p): p for p in backbone.parameters()})
+
+
+def frozen_clip_stats() -> Dict[Tuple[str, str], Dict]:
+    """Load time, resident bytes (parameters once, buffers per view) and views of every loaded backbone."""
+    stats = {}
+    for key, s in _stats.items():
+        stats[key] = dict(s, resident_bytes=s['parameter_bytes'] + s['buffer_bytes'] * (s['views'] + 1))
+    return stats
@@ -0,0 +1,85 @@
+"""
+Bounded LRU caches of frozen language encodings for the cliport streams.
+
+The attention, transport and rpz streams of an agent all encode the same
+lang_goal at every step, with text encoders that do not train. A
+TextEncodingCache maps a key (a text, or a whole batch of texts when the
+encoding of a text depends on its batch) to the tuple of tensors the encoder
+gave for it, and only the missing keys of a batch reach the encoder, once
+each however many samples share them.
+
+Entries are detached and kept on the device they were computed on, and the
+device is part of the cache key, see get_text_cache. Lookups return new
+tensors, so they are the same under torch.no_grad or not.
+"""
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, List, Sequence, Tuple
+
+import torch
+
+TEXT_CACHE_SIZE = 256
+
+
+class TextEncodingCache(object):
+    """LRU of key -> tuple of tensors, with hit and miss counters."""
+
+    def __init__(self, capacity: int = TEXT_CACHE_SIZE):
+        self.capacity = capacity
+        self._entries: "OrderedDict[Hashable, Tuple[torch.Tensor, ...]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, keys: Sequence[Hashable],
+               encode: Callable[[List[Hashable]], Tuple[torch.Tensor, ...]]) -> Tuple[torch.Tensor, ...]:
+        """Encodings of `keys` stacked along a new first dimension.
+
+        encode(missing keys) returns a tuple of tensors with one row per key,
+        and is called at most once, on the unique missing keys.
+        """
+        missing = [k for k in dict.fromkeys(keys) if k not in self._entries]
+        self.misses += len(missing)
+        self.hits += len(keys) - len(missing)
+        found = {}
+        if missing:
+            encodings = encode(missing)
+            for i, k in enumerate(missing):
+                found[k] = tuple(e[i].detach() for e in encodings)
+        rows = []
+        for k in keys:
+            if k in found:
+                rows.append(found[k])
+            else:
+                self._entries.move_to_end(k)
+                rows.append(self._entries[k])
+        for k, entry in found.items():
+            self._entries[k] = entry
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+        return tuple(torch.stack(column) for column in zip(*rows))
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# Caches shared by the streams that encode text with the same frozen weights on the same device.
+_caches: Dict[Hashable, TextEncodingCache] = {}
+
+
+def get_text_cache(encoder: Hashable, device) -> TextEncodingCache:
+    key = (encoder, str(torch.device(device)))
+    if key not in _caches:
+        _caches[key] = TextEncodingCache()
+    return _caches[key]
+
+
+def text_cache_stats() -> Dict[Hashable, Dict]:
+    """Entries, hits, misses and hit rate of every cache, by (encoder, device)."""
+    return {key: {'entries': len(c), 'hits': c.hits, 'misses': c.misses, 'hit_rate': c.hit_rate}
+            for key, c in _caches.items()}
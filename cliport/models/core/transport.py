@@ -115,9 +115,7 @@ class Transport6Dof(Transport):
         """Forward pass."""
         padding = np.zeros((4,2),dtype=int)
         padding[1:,:] = self.padding
-        img_unprocessed = np.pad(inp_img, padding, mode='constant')
-        input_data = img_unprocessed
-        in_tensor = torch.from_numpy(input_data).to(dtype=torch.float, device=self.device)
+        in_tensor = utils.pad_image_batch(inp_img, padding, self.device)
 
         # Rotation pivot.
         pv = p + self.pad_size
@@ -5,6 +5,7 @@ import torch.nn.functional as F
 import cliport.utils.utils as utils
 from transformers import DistilBertTokenizer, DistilBertModel
 from cliport.models.core import fusion
+from cliport.models.core.text_cache import TextEncodingCache
 from cliport.models.resnet import ConvBlock, IdentityBlock
 
 
@@ -74,6 +75,7 @@ class ResNet43_8s_lang(nn.Module):
         self.tokenizer = DistilBertTokenizer.from_pretrained('distilbert-base-uncased')
         self.text_encoder = DistilBertModel.from_pretrained('distilbert-base-uncased')
         self.text_fc = nn.Linear(768, 1024)
+        self.text_cache = TextEncodingCache()
 
         self.lang_fuser1 = fusion.names[self.lang_fusion_type](input_dim=self.input_dim // 2)
         self.lang_fuser2 = fusion.names[self.lang_fusion_type](input_dim=self.input_dim // 4)
@@ -85,20 +87,32 @@ class ResNet43_8s_lang(nn.Module):
         self.lang_proj3 = nn.Linear(self.proj_input_dim, 128)
 
     def encode_text(self, l):
+        if self.text_encoder.training:
+            # dropout, nothing to reuse
+            text_encodings, text_emb, text_mask = self._encode_text(l)
+        else:
+            # An encoding depends on the padding of its batch, so whole batches are cached.
+            batch = tuple([l] if isinstance(l, str) else l)
+            encode = lambda batches: tuple(t.unsqueeze(0) for t in self._encode_text(list(batches[0])))
+            text_encodings, text_emb, text_mask = [t[0] for t in self.text_cache.lookup([batch], encode)]
+        text_feat = self.text_fc(text_encodings)
+        return text_feat, text_emb, text_mask
+
+    def _encode_text(self, l):
         with torch.no_grad():
             inputs = self.tokenizer(l, return_tensors='pt', padding=True)
             input_ids, attention_mask = inputs['input_ids'].to(self.device), inputs['attention_mask'].to(self.device)
             text_embeddings = self.text_encoder(input_ids, attention_mask)
             text_encodings = text_embeddings.last_hidden_state.mean(1)
-        text_feat = self.text_fc(text_encodings)
         text_mask = torch.ones_like(input_ids) # [1, max_token_len]
-        return text_feat, text_embeddings.last_hidden_state, text_mask
+        return text_encodings, text_embeddings.last_hidden_state, text_mask
 
     def forward(self, x, l):
         x = self.preprocess(x, dist='transporter')
 
         # encode language
-        l_enc, l_emb, l_mask = self.encode_text(l)
+        encoded = isinstance(l, tuple) and not isinstance(l[0], str)
+        l_enc, l_emb, l_mask = l if encoded else self.encode_text(l)
         l_input = l_emb if 'word' in self.lang_fusion_type else l_enc
         l_input = l_input.to(dtype=x.dtype)
 
@@ -18,6 +18,11 @@ class OneStreamAttentionLangFusion(TwoStreamAttentionLangFusion):
         self.attn_stream_one = stream_one_model(self.in_shape, 1, self.cfg, self.device, self.preprocess)
         print(f"Attn FCN: {stream_one_fcn}")
 
+    def encode_lang(self, l):
+        if hasattr(self.attn_stream_one, 'encode_text'):
+            return self.attn_stream_one.encode_text(l)
+        return l
+
     def attend(self, x, l):
         x = self.attn_stream_one(x, l)
         return x
\ No newline at end of file
@@ -4,6 +4,7 @@ import torch.nn.functional as F
 
 from cliport.models.core.attention import Attention
 import cliport.models as models
+import cliport.utils.utils as utils
 import cliport.models.core.fusion as fusion
 
 
@@ -31,29 +32,30 @@ class TwoStreamAttentionLangFusion(Attention):
         x = self.fusion(x1, x2)
         return x
 
+    def encode_lang(self, l):
+        """Encoded goal of the language stream, or the raw goal if it cannot be encoded upfront."""
+        if hasattr(self.attn_stream_two, 'encode_text'):
+            return self.attn_stream_two.encode_text(l)
+        return l
+
     def forward(self, inp_img, lang_goal, softmax=True):
         """Forward pass."""
         padding = np.zeros((4,2),dtype=int)
         padding[1:,:] = self.padding
-        in_data = np.pad(inp_img, padding, mode='constant')
-        in_tens = torch.from_numpy(in_data).to(dtype=torch.float, device=self.device)  # [B W H 6]
+        in_tens = utils.pad_image_batch(inp_img, padding, self.device)  # [B W H 6]
 
         # Rotation pivot.
-        pv = np.zeros((in_data.shape[0], 2))
-        pv[:, 0] = in_data.shape[1]//2
-        pv[:, 1] = in_data.shape[2]//2
+        pv = np.zeros((in_tens.shape[0], 2))
+        pv[:, 0] = in_tens.shape[1]//2
+        pv[:, 1] = in_tens.shape[2]//2
 
         # Rotate input.
         in_tens = in_tens.permute(0, 3, 1, 2).contiguous()  # [B 6 W H]
         in_tens = in_tens.unsqueeze(1).repeat(1, self.n_rotations, 1, 1, 1)
         in_tens = self.rotator(in_tens, pivot=pv)
 
-        # Forward pass.
-        logits = []
-        for x in in_tens:
-            lgts = self.attend(x, lang_goal)
-            logits.append(lgts)
-        logits = torch.stack(logits, dim=1)
+        # Forward pass, with the goal encoded once for all rotations.
+        logits = self.attend_rotations(in_tens, self.encode_lang(lang_goal))
 
         # Rotate back output.
         logits = self.rotator(logits, reverse=True, pivot=pv)
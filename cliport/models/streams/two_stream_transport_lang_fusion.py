@@ -3,6 +3,7 @@ import numpy as np
 import torch.nn.functional as F
 
 import cliport.models as models
+import cliport.utils.utils as utils
 import cliport.models.core.fusion as fusion
 from cliport.models.core.transport import Transport, Transport6Dof
 from cliport.utils.utils import mlp
@@ -37,11 +38,7 @@ class TwoStreamTransportLangFusion(Transport6Dof):
         """Forward pass."""
         padding = np.zeros((4,2),dtype=int)
         padding[1:,:] = self.padding
-        img_unprocessed = np.pad(inp_img, padding, mode='constant')
-        input_data = img_unprocessed
-        # in_shape = (1,) + input_data.shape
-        # input_data = input_data.reshape(in_shape)
-        in_tensor = torch.from_numpy(input_data).to(dtype=torch.float, device=self.device)
+        in_tensor = utils.pad_image_batch(inp_img, padding, self.device)
 
         # Rotation pivot.
         # pv = np.array([p[0], p[1]]) + self.pad_size
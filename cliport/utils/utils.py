@@ -1,5 +1,6 @@
 """Miscellaneous utilities."""
 
+import collections
 import cv2
 import random
 import matplotlib
@@ -9,12 +10,12 @@ import PIL
 import yaml
 import numpy as np
 
-import kornia
 # from omegaconf import OmegaConf
 
 import os
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 # -----------------------------------------------------------------------------
 # HEIGHTMAP UTILS
@@ -22,23 +23,145 @@ import torch.nn as nn
 
 def get_fused_heightmap(colors, points, bounds, pix_size):
     """Reconstruct orthographic heightmaps with segmentation masks."""
-    heightmaps, colormaps = [], []
-    for p,i in zip(points, colors):
-        h, c_map = get_heightmap(p, i, bounds, pix_size)
-        heightmaps.append(h)
-        colormaps.append(c_map)
-    colormaps = np.float32(colormaps)
-    heightmaps = np.float32(heightmaps)
+    return fuse_heightmaps(colors, points, bounds, pix_size)
+
+
+def fuse_heightmaps(colors, points, bounds, pixel_size, backend='numpy'):
+    """Fused top-down heightmap of all views in one pass, without sorting.
+
+    Same output as running get_heightmap on every view and fusing the maps
+    like get_fused_heightmap used to: per view and pixel, the highest point
+    gives the height and the color (scatter-max instead of argsort + z
+    buffering), then colors are averaged over the views that see the pixel
+    and heights are maxed over views.
+
+    Args:
+      colors: VxHxWxC uint8 array (or list of V HxWxC arrays), optionally with
+        a leading batch dimension B.
+      points: VxHxWx3 float array of 3D points aligned with colors, optionally
+        with the same leading batch dimension.
+      bounds: 3x2 float array of the heightmap region (rows: X,Y,Z; columns: min,max).
+      pixel_size: float defining size of each pixel in meters.
+      backend: 'numpy', or 'torch' to run on (CPU) tensors and return tensors.
+
+    Returns:
+      cmap: [B]xHxWxC uint8 fused colormap.
+      hmap: [B]xHxW float32 fused heightmap.
+    """
+    if backend == 'torch':
+        return _fuse_heightmaps_torch(colors, points, bounds, pixel_size)
+
+    points = np.asarray(points)
+    colors = np.asarray(colors)
+    batched = points.ndim == 5
+    if not batched:
+        points, colors = points[None], colors[None]
+    batch_size, num_views = points.shape[:2]
+    num_channels = colors.shape[-1]
+    width = int(np.round((bounds[0, 1] - bounds[0, 0]) / pixel_size))
+    height = int(np.round((bounds[1, 1] - bounds[1, 0]) / pixel_size))
+    num_maps = batch_size * num_views
+    num_cells = height * width
+
+    points_per_map = points[0, 0].size // 3
+    points = points.reshape(-1, 3)
+    colors = colors.reshape(-1, num_channels)
+
+    # Filter out 3D points that are outside of the predefined bounds.
+    ix = (points[:, 0] >= bounds[0, 0]) & (points[:, 0] < bounds[0, 1])
+    iy = (points[:, 1] >= bounds[1, 0]) & (points[:, 1] < bounds[1, 1])
+    iz = (points[:, 2] >= bounds[2, 0]) & (points[:, 2] < bounds[2, 1])
+    point_ids = np.flatnonzero(ix & iy & iz)
+    valid_points = np.take(points, point_ids, axis=0)
+
+    px = np.int32(np.floor((valid_points[:, 0] - bounds[0, 0]) / pixel_size))
+    py = np.int32(np.floor((valid_points[:, 1] - bounds[1, 0]) / pixel_size))
+    px = np.clip(px, 0, width - 1)
+    py = np.clip(py, 0, height - 1)
+    cells = (point_ids // points_per_map) * num_cells + py.astype(np.int64) * width + px
+    z = valid_points[:, 2]
+
+    # Highest point of every (map, pixel), and the last such point on ties.
+    zmax = np.full(num_maps * num_cells, -np.inf)
+    np.maximum.at(zmax, cells, z)
+    top = np.flatnonzero(z == zmax[cells])
+    winner = np.full(num_maps * num_cells, -1, dtype=np.int64)
+    np.maximum.at(winner, cells[top], top)
+    filled = winner >= 0
+
+    heightmaps = np.zeros(num_maps * num_cells, dtype=np.float32)
+    heightmaps[filled] = zmax[filled] - bounds[2, 0]
+    colormaps = np.zeros((num_maps * num_cells, num_channels), dtype=np.uint8)
+    colormaps[filled] = np.take(colors, point_ids[winner[filled]], axis=0)
+    heightmaps = heightmaps.reshape(batch_size, num_views, height, width)
+    colormaps = colormaps.reshape(batch_size, num_views, height, width, num_channels)
 
     # Fuse maps from different views.
-    valid = np.sum(colormaps, axis=3) > 0
-    repeat = np.sum(valid, axis=0)
+    repeat = np.sum(colormaps.any(axis=-1), axis=1)
     repeat[repeat == 0] = 1
-    cmap = np.sum(colormaps, axis=0) / repeat[Ellipsis, None]
+    cmap = np.sum(colormaps, axis=1, dtype=np.float32) / repeat[Ellipsis, None]
     cmap = np.uint8(np.round(cmap))
-    hmap = np.max(heightmaps, axis=0)  # Max to handle occlusions.
+    hmap = np.max(heightmaps, axis=1)  # Max to handle occlusions.
+    if not batched:
+        cmap, hmap = cmap[0], hmap[0]
+    return cmap, hmap
+
+
+def _fuse_heightmaps_torch(colors, points, bounds, pixel_size):
+    """Torch version of fuse_heightmaps, see there."""
+    points = points if torch.is_tensor(points) else torch.from_numpy(np.asarray(points))
+    colors = colors if torch.is_tensor(colors) else torch.from_numpy(np.asarray(colors))
+    batched = points.dim() == 5
+    if not batched:
+        points, colors = points[None], colors[None]
+    batch_size, num_views = points.shape[:2]
+    num_channels = colors.shape[-1]
+    width = int(np.round((bounds[0, 1] - bounds[0, 0]) / pixel_size))
+    height = int(np.round((bounds[1, 1] - bounds[1, 0]) / pixel_size))
+    num_maps = batch_size * num_views
+    num_cells = height * width
+
+    points_per_map = points[0, 0].numel() // 3
+    points = points.reshape(-1, 3)
+    colors = colors.reshape(-1, num_channels)
+
+    ix = (points[:, 0] >= bounds[0, 0]) & (points[:, 0] < bounds[0, 1])
+    iy = (points[:, 1] >= bounds[1, 0]) & (points[:, 1] < bounds[1, 1])
+    iz = (points[:, 2] >= bounds[2, 0]) & (points[:, 2] < bounds[2, 1])
+    point_ids = torch.nonzero(ix & iy & iz, as_tuple=True)[0]
+    valid_points = points[point_ids]
+
+    px = torch.floor((valid_points[:, 0] - bounds[0, 0]) / pixel_size).int()
+    py = torch.floor((valid_points[:, 1] - bounds[1, 0]) / pixel_size).int()
+    px = torch.clamp(px, 0, width - 1)
+    py = torch.clamp(py, 0, height - 1)
+    cells = torch.div(point_ids, points_per_map, rounding_mode='floor') * num_cells + py.long() * width + px
+    z = valid_points[:, 2]
+
+    zmax = torch.full((num_maps * num_cells,), -float('inf'), dtype=z.dtype)
+    zmax.scatter_reduce_(0, cells, z, reduce='amax')
+    top = torch.nonzero(z == zmax[cells], as_tuple=True)[0]
+    winner = torch.full((num_maps * num_cells,), -1, dtype=torch.long)
+    winner.scatter_reduce_(0, cells[top], top, reduce='amax')
+    filled = winner >= 0
+
+    heightmaps = torch.zeros(num_maps * num_cells, dtype=torch.float32)
+    heightmaps[filled] = (zmax[filled] - bounds[2, 0]).float()
+    colormaps = torch.zeros((num_maps * num_cells, num_channels), dtype=torch.uint8)
+    colormaps[filled] = colors[point_ids[winner[filled]]]
+    heightmaps = heightmaps.reshape(batch_size, num_views, height, width)
+    colormaps = colormaps.reshape(batch_size, num_views, height, width, num_channels)
+
+    repeat = colormaps.any(dim=-1).sum(dim=1)
+    repeat[repeat == 0] = 1
+    cmap = colormaps.sum(dim=1, dtype=torch.float32).double() / repeat[Ellipsis, None]
+    cmap = torch.round(cmap).to(torch.uint8)
+    hmap = heightmaps.max(dim=1).values
+    if not batched:
+        cmap, hmap = cmap[0], hmap[0]
     return cmap, hmap
 
+
 def get_heightmap(points, colors, bounds, pixel_size):
     """Get top-down (z-axis) orthographic heightmap image from 3D pointcloud.
   
@@ -328,6 +451,18 @@ def apply_transform(transform_to_from, points_from):
 # -----------------------------------------------------------------------------
 
 
+def pad_image_batch(img, padding, device):
+    """Zero padded float tensor on device of a [B H W C] batch, numpy array or tensor.
+
+    padding is the (4, 2) before/after padding of each dimension, as for np.pad.
+    """
+    if torch.is_tensor(img):
+        img = img.to(device=device, dtype=torch.float, non_blocking=True)
+        # F.pad goes from the last dimension to the first.
+        return F.pad(img, tuple(int(p) for p in np.asarray(padding)[::-1].ravel()))
+    return torch.from_numpy(np.pad(img, padding, mode='constant')).to(dtype=torch.float, device=device)
+
+
 def preprocess(img, dist='transporter'):
     """Pre-process input (subtract mean, divide by std)."""
 
@@ -561,42 +696,73 @@ def apply_perturbation(input_image, transform_params):
 
 
 class ImageRotator:
-    """Rotate for n rotations."""
+    """Rotate for n rotations.
+
+    All rotations of a batch are warped by a single grid_sample call. The
+    sampling grids only depend on the image size, the pivots and the
+    direction, so the last `cache_size` of them are kept. Matches the
+    per-rotation kornia.warp_affine loop (bilinear, zero padding,
+    align_corners=False as in the pinned kornia 0.4.1) up to float rounding.
+    """
     # Reference: https://kornia.readthedocs.io/en/latest/tutorials/warp_affine.html?highlight=rotate
 
-    def __init__(self, n_rotations):
+    def __init__(self, n_rotations, align_corners=False, cache_size=16):
         self.angles = []
         for i in range(n_rotations):
             theta = i * 2 * 180 / n_rotations
             self.angles.append(theta)
+        self.align_corners = align_corners
+        self.cache_size = cache_size
+        self._grids = collections.OrderedDict()
+
+    def rotation_matrices(self, pivot, reverse=False):
+        """B*n 3x3 pixel rotation matrices, as kornia.get_rotation_matrix2d (pivot is x, y)."""
+        center = np.asarray(pivot, dtype=np.float64).reshape(-1, 1, 2)
+        angles = np.deg2rad(self.angles) * (-1.0 if reverse else 1.0)
+        alpha, beta = np.cos(angles), np.sin(angles)
+        cx, cy = center[..., 0], center[..., 1]
+        M = np.zeros((center.shape[0], len(self.angles), 3, 3))
+        M[..., 0, 0] = alpha
+        M[..., 0, 1] = beta
+        M[..., 0, 2] = (1 - alpha) * cx - beta * cy
+        M[..., 1, 0] = -beta
+        M[..., 1, 1] = alpha
+        M[..., 1, 2] = beta * cx + (1 - alpha) * cy
+        M[..., 2, 2] = 1
+        return M.reshape(-1, 3, 3)
+
+    def sampling_grid(self, b, h, w, pivot, reverse=False, device='cpu'):
+        """B*n HxWx2 grid of the rotations of a BxCxHxW batch."""
+        pivot = np.broadcast_to(np.asarray(pivot, dtype=np.float64).reshape(-1, 2), (b, 2))
+        key = (b, h, w, pivot.tobytes(), reverse, str(device))
+        if key in self._grids:
+            self._grids.move_to_end(key)
+            return self._grids[key]
+
+        # Same pixel -> [-1, 1] normalisation as kornia.warp_affine.
+        norm = np.eye(3)
+        norm[0, 0] = 2.0 / max(w - 1, 1e-14)
+        norm[1, 1] = 2.0 / max(h - 1, 1e-14)
+        norm[:2, 2] = -1
+        M = self.rotation_matrices(pivot, reverse)
+        dst_norm_trans_src_norm = norm @ M @ np.linalg.inv(norm)
+        src_norm_trans_dst_norm = np.linalg.inv(dst_norm_trans_src_norm)
+        theta = torch.from_numpy(src_norm_trans_dst_norm[:, :2]).float()
+        grid = F.affine_grid(theta, [theta.shape[0], 1, h, w], align_corners=self.align_corners).to(device)
+
+        self._grids[key] = grid
+        if len(self._grids) > self.cache_size:
+            self._grids.popitem(last=False)
+        return grid
 
     def __call__(self, x_list, pivot, reverse=False):
-        rot_x_list = []
-        for i, angle in enumerate(self.angles):
-            x = x_list[:, i]
-            b, _, h, w = x.shape
-            # create transformation (rotation)
-            alpha: float = angle if not reverse else (-1.0 * angle)  # in degrees
-            angle: torch.tensor = torch.ones(b) * alpha
-
-            # define the rotation center
-            # center: torch.tensor = torch.ones(b, 2)
-            # center[..., 0] = pivot[1]
-            # center[..., 1] = pivot[0]
-            center = torch.from_numpy(pivot).to(dtype=torch.float)
-
-            # define the scale factor
-            scale: torch.tensor = torch.ones(b, 2)
-
-            # compute the transformation matrix
-            M: torch.tensor = kornia.get_rotation_matrix2d(center, angle, scale)
-
-            # apply the transformation to original image
-            x_warped: torch.tensor = kornia.warp_affine(x.float(), M.to(x.device), dsize=(h, w))
-            x_warped = x_warped
-            rot_x_list.append(x_warped)
-
-        return rot_x_list
+        n = len(self.angles)
+        x = x_list[:, :n]
+        b, _, c, h, w = x.shape
+        grid = self.sampling_grid(b, h, w, pivot, reverse, x.device)
+        x_warped = F.grid_sample(x.reshape(b * n, c, h, w).float(), grid, mode='bilinear',
+                                 padding_mode='zeros', align_corners=self.align_corners)
+        return list(x_warped.reshape(b, n, c, h, w).unbind(1))
 
 
 # -----------------------------------------------------------------------------
@@ -16,12 +16,12 @@ from scipy.spatial.transform import Rotation as R
 from num2words import num2words
 pickle.DEFAULT_PROTOCOL=pickle.HIGHEST_PROTOCOL
 import random
-from vlm.scripts.utils import keypoint_discovery,mask_tokens,max_sperate_index
+from vlm.scripts.utils import episode_keypoints,mask_tokens,max_sperate_index
 from pytorch_transformers import  BertTokenizer
 # add hiverformer
 from torch.nn import functional as F
 from hiverformer.utils import obs_to_attn, DataTransform
-from hiverformer.process_instructions import get_language_feat
+from hiverformer.language_features import get_language_feat
 import random
 import math
 import itertools
@@ -262,7 +262,7 @@ class Hive_dataset(Dataset):
         if self.mode == 'waypoint':
             key_frames = obs_select_inds
         else:
-            key_frames = keypoint_discovery(demo_temple._observations)
+            key_frames = episode_keypoints(self.dataset_path/episode, demo_temple._observations)
 
         select_frames=[]
 
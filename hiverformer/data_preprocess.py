@@ -13,7 +13,7 @@ from torch.nn import functional as F
 import numpy as np
 import einops
 from rlbench.demo import Demo
-from hiverformer.process_instructions import get_language_feat
+from hiverformer.language_features import get_language_feat
 from hiverformer.utils import (
     RLBenchEnv,
     keypoint_discovery,
@@ -1,4 +1,7 @@
 import itertools
+import hashlib
+import os
+import pickle
 import random
 from typing import (
     Union,
@@ -11,7 +14,7 @@ from typing import (
     Generic,
 )
 from pickle import UnpicklingError
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from pathlib import Path
 import numpy as np
 import torch
@@ -20,6 +23,7 @@ from torch.nn import functional as F
 import torchvision.transforms as transforms
 import torchvision.transforms.functional as transforms_f
 import einops
+from filelock import FileLock
 from hiverformer.utils import Instructions, Sample, Camera
 
 
@@ -27,33 +31,230 @@ T = TypeVar("T")
 U = TypeVar("U")
 
 
+def _nbytes(value) -> int:
+    """
+    Bytes held by the arrays and tensors of a (nested) episode.
+    """
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, np.ndarray):
+        if value.dtype == object:
+            return sum(_nbytes(v) for v in value.flat)
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sum(_nbytes(v) for v in value)
+    if isinstance(value, dict):
+        return sum(_nbytes(v) for v in value.values())
+    return 0
+
+
+class SharedEpisodeStore:
+    """
+    Decoded episodes shared by every process of a machine.
+
+    An episode is written once to a file of ``directory`` (use a tmpfs such as
+    /dev/shm): its arrays and tensors are laid out in a flat buffer and the
+    rest of its structure is pickled in a small header. Readers memory-map the
+    file copy-on-write, so all DataLoader workers read the same pages instead
+    of each holding its own decoded copy.
+
+    Files are keyed by path, mtime and size of the source episode, and the
+    least recently used ones are removed once ``max_bytes`` is exceeded.
+    """
+
+    ALIGN = 64
+
+    def __init__(self, directory: Union[Path, str], max_bytes: Optional[int] = None):
+        self._dir = Path(directory).expanduser()
+        self._dir.mkdir(parents=True, exist_ok=True)
+        self._lock = FileLock(str(self._dir / ".lock"))
+        self._max_bytes = max_bytes
+        self.evictions = 0
+
+    def _path(self, file: Path) -> Path:
+        stat = os.stat(file)
+        key = f"{Path(file).resolve()}\0{stat.st_mtime_ns}\0{stat.st_size}"
+        return self._dir / f"{hashlib.sha1(key.encode('utf-8')).hexdigest()}.episode"
+
+    def _flatten(self, value, buffers: List[Tuple[int, np.ndarray]], offset: List[int]):
+        if isinstance(value, torch.Tensor) and value.dtype != torch.bfloat16:
+            array = value.detach().cpu().contiguous().numpy()
+            return self._flatten_array(array, True, buffers, offset)
+        if isinstance(value, np.ndarray):
+            if value.dtype == object:
+                flat = [self._flatten(v, buffers, offset) for v in value.flat]
+                return ("object", value.shape, flat)
+            return self._flatten_array(np.ascontiguousarray(value), False, buffers, offset)
+        if isinstance(value, list):
+            return ("list", [self._flatten(v, buffers, offset) for v in value])
+        if isinstance(value, tuple):
+            return ("tuple", [self._flatten(v, buffers, offset) for v in value])
+        if isinstance(value, dict):
+            return ("dict", {k: self._flatten(v, buffers, offset) for k, v in value.items()})
+        return ("value", value)
+
+    def _flatten_array(self, array: np.ndarray, tensor: bool, buffers: List[Tuple[int, np.ndarray]], offset: List[int]):
+        start = -(-offset[0] // self.ALIGN) * self.ALIGN
+        buffers.append((start, array))
+        offset[0] = start + array.nbytes
+        return ("array", start, array.dtype.str, array.shape, tensor)
+
+    def _unflatten(self, node, data: np.ndarray):
+        kind = node[0]
+        if kind == "array":
+            _, offset, dtype, shape, tensor = node
+            dtype = np.dtype(dtype)
+            count = int(np.prod(shape))
+            array = data[offset : offset + count * dtype.itemsize].view(dtype).reshape(shape)
+            return torch.from_numpy(array) if tensor else array
+        if kind == "object":
+            array = np.empty(len(node[2]), dtype=object)
+            for i, v in enumerate(node[2]):
+                array[i] = self._unflatten(v, data)
+            return array.reshape(node[1])
+        if kind == "list":
+            return [self._unflatten(v, data) for v in node[1]]
+        if kind == "tuple":
+            return tuple(self._unflatten(v, data) for v in node[1])
+        if kind == "dict":
+            return {k: self._unflatten(v, data) for k, v in node[1].items()}
+        return node[1]
+
+    def get(self, file: Path):
+        path = self._path(file)
+        try:
+            data = np.memmap(path, dtype=np.uint8, mode="c")
+        except (FileNotFoundError, ValueError):
+            return None
+        header_len = int(data[:8].view(np.uint64)[0])
+        skeleton = pickle.loads(data[8 : 8 + header_len].tobytes())
+        start = -(-(8 + header_len) // self.ALIGN) * self.ALIGN
+        # Keep the most recently used episodes out of the eviction
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return self._unflatten(skeleton, data[start:])
+
+    def put(self, file: Path, value) -> None:
+        path = self._path(file)
+        buffers: List[Tuple[int, np.ndarray]] = []
+        offset = [0]
+        header = pickle.dumps(self._flatten(value, buffers, offset))
+        start = -(-(8 + len(header)) // self.ALIGN) * self.ALIGN
+        size = start + offset[0]
+
+        with self._lock:
+            self._evict(size)
+            # Workers may decode the same episode concurrently, so write then rename
+            tmp = path.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp, "wb") as fid:
+                fid.write(np.uint64(len(header)).tobytes())
+                fid.write(header)
+                for array_start, array in buffers:
+                    fid.seek(start + array_start)
+                    fid.write(array.tobytes())
+                fid.truncate(size)
+            os.replace(tmp, path)
+
+    def _evict(self, incoming: int) -> None:
+        if self._max_bytes is None:
+            return
+        files = []
+        for path in self._dir.glob("*.episode"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime_ns, stat.st_size, path))
+        total = sum(size for _, size, _ in files) + incoming
+        # Unlinking keeps the pages of workers that still map the file alive
+        for _, size, path in sorted(files):
+            if total <= self._max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+            self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            for path in self._dir.glob("*.episode"):
+                path.unlink(missing_ok=True)
+
+
 class Cache(Generic[T, U]):
-    def __init__(self, size: int, loader: Callable[[T], U]):
+    """
+    LRU cache of loaded episodes.
+
+    At most ``size`` entries and, if given, ``max_bytes`` bytes of arrays and
+    tensors are kept. With a ``store``, loaded episodes are first published to
+    that SharedEpisodeStore and the cache keeps the shared mapping, so the
+    byte budget is better set on the store.
+    """
+
+    def __init__(
+        self,
+        size: int,
+        loader: Callable[[T], U],
+        max_bytes: Optional[int] = None,
+        store: Optional[SharedEpisodeStore] = None,
+    ):
         self._size = size
+        self._max_bytes = max_bytes
         self._loader = loader
-        self._keys: List[T] = []
-        self._cache: Dict[T, U] = {}
+        self._store = store
+        self._cache: "OrderedDict[T, Tuple[U, int]]" = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _load(self, args: T) -> U:
+        if self._store is None:
+            return self._loader(args)
+        value = self._store.get(args)
+        if value is None:
+            value = self._loader(args)
+            if value is not None:
+                self._store.put(args, value)
+                value = self._store.get(args)
+        return value
 
     def __call__(self, args: T) -> U:
         if args in self._cache:
-            index = self._keys.index(args)
-            del self._keys[index]
-            self._keys.append(args)
-            return self._cache[args]
-
-        # print(args, len(self._keys), self._size)
-        value = self._loader(args)
-
-        if len(self._keys) == self._size and self._keys != []:
-            key = self._keys[0]
-            del self._cache[key]
-            del self._keys[0]
+            self.hits += 1
+            self._cache.move_to_end(args)
+            return self._cache[args][0]
+
+        self.misses += 1
+        value = self._load(args)
+        nbytes = _nbytes(value)
+        if self._size <= 0 or (self._max_bytes is not None and nbytes > self._max_bytes):
+            return value
+
+        while self._cache and (
+            len(self._cache) >= self._size
+            or (self._max_bytes is not None and self.nbytes + nbytes > self._max_bytes)
+        ):
+            _, (_, evicted) = self._cache.popitem(last=False)
+            self.nbytes -= evicted
+            self.evictions += 1
+
+        self._cache[args] = (value, nbytes)
+        self.nbytes += nbytes
+        return value
 
-        if len(self._keys) < self._size:
-            self._keys.append(args)
-            self._cache[args] = value
+    def __len__(self) -> int:
+        return len(self._cache)
 
-        return value
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._cache),
+            "nbytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
 
 
 def data_transform(scales, **kwargs: torch.Tensor) -> Dict[str, torch.Tensor]:
@@ -121,6 +322,19 @@ def loader(file: Path) -> Optional[np.ndarray]:
     return None
 
 
+def make_cache(
+    cache_size: int, cache_bytes: Optional[int] = None, shared_cache: Optional[Path] = None
+) -> Cache[Path, Optional[np.ndarray]]:
+    """
+    Episode cache of a dataset. With ``shared_cache``, a directory on tmpfs,
+    the DataLoader workers share one decoded copy of each episode and
+    ``cache_bytes`` bounds that shared copy; otherwise it bounds each worker.
+    """
+    if shared_cache is None:
+        return Cache(cache_size, loader, max_bytes=cache_bytes)
+    return Cache(cache_size, loader, store=SharedEpisodeStore(shared_cache, cache_bytes))
+
+
 class DataTransform(object):
     def __init__(self, scales):
         self.scales = scales
@@ -197,8 +411,10 @@ class My_Dataset(data.Dataset):
         num_iters: Optional[int] = None,
         cameras: Tuple[Camera, ...] = ("wrist", "left_shoulder", "right_shoulder"),
         training: bool = True,
+        cache_bytes: Optional[int] = None,
+        shared_cache: Optional[Path] = None,
     ):
-        self._cache = Cache(cache_size, loader)
+        self._cache = make_cache(cache_size, cache_bytes, shared_cache)
         self._cameras = cameras
         self._max_episode_length = max_episode_length
         # self._max_episodes_per_taskvar = max_episodes_per_taskvar
@@ -327,8 +543,10 @@ class RLBenchDataset(data.Dataset):
         num_iters: Optional[int] = None,
         cameras: Tuple[Camera, ...] = ("wrist", "left_shoulder", "right_shoulder"),
         training: bool = True,
+        cache_bytes: Optional[int] = None,
+        shared_cache: Optional[Path] = None,
     ):
-        self._cache = Cache(cache_size, loader)
+        self._cache = make_cache(cache_size, cache_bytes, shared_cache)
         self._cameras = cameras
         self._max_episode_length = max_episode_length
         self._max_episodes_per_taskvar = max_episodes_per_taskvar
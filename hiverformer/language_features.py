@@ -0,0 +1,207 @@
+"""
+Language features for hiverformer, computed once and cached.
+
+The text encoder of every (encoder, device) pair is loaded a single time per
+process and kept resident. Features are cached in memory and on disk under a
+content address built from (encoder, num_words, text), so instructions that
+were already encoded, by this process or by an earlier run, never reach the
+encoder again.
+
+Precompute the cache of a dataset split with:
+    python -m hiverformer.language_features --data_dir /path/to/train
+"""
+import hashlib
+import os
+import pickle
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+from typing_extensions import Literal
+import tap
+import transformers
+from tqdm.auto import tqdm
+import torch
+from transformers import logging
+logging.set_verbosity_error()
+
+TextEncoder = Literal["bert", "clip"]
+
+DEFAULT_CACHE_DIR = Path(
+    os.environ.get("HIVEFORMER_LANG_CACHE", "~/.cache/hiverformer/language_features")
+).expanduser()
+
+
+def load_model(encoder: TextEncoder) -> transformers.PreTrainedModel:
+    if encoder == "bert":
+        model = transformers.BertModel.from_pretrained("bert-base-uncased")
+    elif encoder == "clip":
+        model = transformers.CLIPTextModel.from_pretrained("openai/clip-vit-base-patch32", ignore_mismatched_sizes=True)
+    else:
+        raise ValueError(f"Unexpected encoder {encoder}")
+    if not isinstance(model, transformers.PreTrainedModel):
+        raise ValueError(f"Unexpected encoder {encoder}")
+    return model
+
+def load_tokenizer(encoder: TextEncoder) -> transformers.PreTrainedTokenizer:
+    if encoder == "bert":
+        tokenizer = transformers.BertTokenizer.from_pretrained("bert-base-uncased")
+    elif encoder == "clip":
+        tokenizer = transformers.CLIPTokenizer.from_pretrained(
+            "openai/clip-vit-base-patch32"
+        )
+    else:
+        raise ValueError(f"Unexpected encoder {encoder}")
+    if not isinstance(tokenizer, transformers.PreTrainedTokenizer):
+        raise ValueError(f"Unexpected encoder {encoder}")
+    return tokenizer
+
+
+# Resident encoders, one per (encoder, device), and tokenizers, one per encoder
+_models: Dict[Tuple[str, str], transformers.PreTrainedModel] = {}
+_tokenizers: Dict[str, transformers.PreTrainedTokenizer] = {}
+
+
+def get_model(encoder: TextEncoder, device: Union[str, torch.device]) -> transformers.PreTrainedModel:
+    key = (encoder, str(torch.device(device)))
+    if key not in _models:
+        model = load_model(encoder).to(device)
+        model.eval()
+        for p in model.parameters():
+            p.requires_grad = False
+        _models[key] = model
+    return _models[key]
+
+
+def get_tokenizer(encoder: TextEncoder) -> transformers.PreTrainedTokenizer:
+    if encoder not in _tokenizers:
+        _tokenizers[encoder] = load_tokenizer(encoder)
+    return _tokenizers[encoder]
+
+
+class LanguageFeatureService:
+    """
+    Maps a list of instructions to a (B, num_words, C) tensor of token features.
+
+    Lookups go through an in-memory cache, then the on-disk cache, and only the
+    remaining unique instructions are tokenized and encoded, in batches.
+    """
+
+    def __init__(
+        self,
+        encoder: TextEncoder = "clip",
+        num_words: int = 75,
+        cache_dir: Optional[Path] = DEFAULT_CACHE_DIR,
+        batch_size: int = 64,
+    ):
+        self.encoder = encoder
+        self.num_words = num_words
+        self.batch_size = batch_size
+        self._cache_dir = None if cache_dir is None else Path(cache_dir) / encoder
+        self._memory: Dict[str, torch.Tensor] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, text: str) -> str:
+        return hashlib.sha1(f"{self.encoder}\0{self.num_words}\0{text}".encode("utf-8")).hexdigest()
+
+    def _path(self, text: str) -> Path:
+        key = self.key(text)
+        return self._cache_dir / key[:2] / f"{key}.pt"
+
+    def _load(self, text: str) -> Optional[torch.Tensor]:
+        if self._cache_dir is None:
+            return None
+        path = self._path(text)
+        if not path.is_file():
+            return None
+        try:
+            return torch.load(path, map_location="cpu")
+        except (EOFError, RuntimeError):
+            return None
+
+    def _store(self, text: str, feat: torch.Tensor):
+        if self._cache_dir is None:
+            return
+        path = self._path(text)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Several workers/ranks may write the same entry, so write then rename.
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        torch.save(feat.clone(), tmp)
+        os.replace(tmp, path)
+
+    @torch.no_grad()
+    def _encode(self, texts: List[str], device: Union[str, torch.device]) -> torch.Tensor:
+        model = get_model(self.encoder, device)
+        tokenizer = get_tokenizer(self.encoder)
+        tokenizer.model_max_length = self.num_words
+        tokens = tokenizer(texts, padding="max_length")["input_ids"]
+        tokens = torch.tensor(tokens).to(device)
+        return model(tokens).last_hidden_state
+
+    def lookup(self, language: Sequence[str], device: Union[str, torch.device] = "cpu") -> List[torch.Tensor]:
+        """
+        Returns one CPU tensor per instruction, encoding the missing ones on device.
+        """
+        missing = []
+        for text in dict.fromkeys(language):
+            if text in self._memory:
+                continue
+            feat = self._load(text)
+            if feat is None:
+                missing.append(text)
+            else:
+                self._memory[text] = feat
+        self.misses += len(missing)
+        self.hits += len(language) - len(missing)
+
+        for i in range(0, len(missing), self.batch_size):
+            batch = missing[i : i + self.batch_size]
+            feats = self._encode(batch, device).cpu()
+            for text, feat in zip(batch, feats):
+                self._memory[text] = feat
+                self._store(text, feat)
+
+        return [self._memory[text] for text in language]
+
+    def __call__(self, language: Sequence[str], device: Union[str, torch.device] = "cpu") -> torch.Tensor:
+        feats = torch.stack(self.lookup(language, device))
+        return feats.to(device, non_blocking=True)
+
+
+_services: Dict[Tuple[str, int], LanguageFeatureService] = {}
+
+
+def get_language_service(encoder: TextEncoder, num_words: int) -> LanguageFeatureService:
+    key = (encoder, num_words)
+    if key not in _services:
+        _services[key] = LanguageFeatureService(encoder, num_words)
+    return _services[key]
+
+
+def get_language_feat(language, encoder, num_words, device):
+    return get_language_service(encoder, num_words)(language, device)
+
+
+class Arguments(tap.Tap):
+    data_dir: Path
+    encoder: TextEncoder = "clip"
+    num_words: int = 75
+    batch_size: int = 64
+    cache_dir: Path = DEFAULT_CACHE_DIR
+    device: str = "cuda"
+
+
+if __name__ == "__main__":
+    args = Arguments().parse_args()
+
+    instructions = set()
+    for path in tqdm(sorted(args.data_dir.rglob("low_dim_obs.pkl")), desc="Reading instructions"):
+        with open(path, "rb") as f:
+            demo = pickle.load(f)
+        instructions.update(demo.high_level_instructions)
+    instructions = sorted(instructions)
+    print(f"{len(instructions)} unique instructions in {args.data_dir}")
+
+    service = LanguageFeatureService(args.encoder, args.num_words, args.cache_dir, args.batch_size)
+    for i in tqdm(range(0, len(instructions), args.batch_size), desc="Encoding"):
+        service.lookup(instructions[i : i + args.batch_size], args.device)
+    print(f"Encoded {service.misses} new instructions, {service.hits} were already cached")
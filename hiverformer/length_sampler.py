@@ -0,0 +1,106 @@
+"""
+Batches of hiverformer samples padded to their own longest history.
+
+The datasets pad every sample to max_episode_length (maxAction) frames, but
+most VLMbench episodes have 3 to 8 key frames, and the conv encoder and
+the history transformer run on every frame, padded or not. A step of the
+history only attends to itself and the instruction (see CrossTransformer),
+and the padding is at the end, so the frames after the longest valid
+history of a batch can be dropped without changing the predictions:
+trim_padding_collate collates a batch and cuts its time dimension to
+max(padding_mask.sum(1)).
+
+LengthBucketBatchSampler then batches episodes of the same valid length
+together, so that little padding is left. Like DistributedSampler it
+shuffles with seed + epoch (see set_epoch), and every rank builds the same
+global batches of num_replicas * batch_size episodes and takes its own
+slice of them, so the ranks get the same number of batches and, at every
+step, similar lengths.
+"""
+import math
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.utils.data import Sampler
+from torch.utils.data._utils.collate import default_collate
+
+# Entries of a sample with the frames along their first dimension.
+TIME_KEYS = ("rgbs", "pcds", "attns", "action", "gripper", "padding_mask")
+
+
+def trim_padding_collate(batch: List[Dict]) -> Dict:
+    """default_collate, then the frames past the longest valid history of the batch dropped."""
+    batch = default_collate(batch)
+    length = int(batch["padding_mask"].sum(1).max())
+    for key in TIME_KEYS:
+        if key in batch:
+            batch[key] = batch[key][:, :length]
+    return batch
+
+
+class LengthBucketBatchSampler(Sampler):
+    """Batches of indices of `lengths` (the valid length of every sample) with similar lengths.
+
+    Every epoch, the samples are shuffled, stably sorted by length (so those of
+    the same length stay shuffled), cut into global batches of
+    num_replicas * batch_size consecutive samples, and the global batches are
+    shuffled. Rank r gets the slice [r * batch_size, (r + 1) * batch_size) of
+    each. Without drop_last, the last global batch is completed with
+    repeated samples, as DistributedSampler does.
+    """
+
+    def __init__(self, lengths: Sequence[int], batch_size: int, num_replicas: Optional[int] = None,
+                 rank: Optional[int] = None, shuffle: bool = True, seed: int = 0, drop_last: bool = True):
+        distributed = dist.is_available() and dist.is_initialized()
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if distributed else 1
+        if rank is None:
+            rank = dist.get_rank() if distributed else 0
+        if not 0 <= rank < num_replicas:
+            raise ValueError("Invalid rank {}, rank should be in the interval [0, {}]".format(rank, num_replicas - 1))
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        global_batch = batch_size * num_replicas
+        if drop_last:
+            self.num_batches = len(self.lengths) // global_batch
+        else:
+            self.num_batches = math.ceil(len(self.lengths) / global_batch)
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def global_batches(self) -> np.ndarray:
+        """(batches, num_replicas * batch_size) indices of the epoch, the same on every rank."""
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        n = len(self.lengths)
+        if self.shuffle:
+            order = torch.randperm(n, generator=g).numpy()
+        else:
+            order = np.arange(n)
+        total = self.num_batches * self.batch_size * self.num_replicas
+        if total <= n:
+            order = order[:total]
+        else:
+            order = np.concatenate([order, np.resize(order, total - n)])
+        order = order[np.argsort(self.lengths[order], kind="stable")]
+        batches = order.reshape(self.num_batches, self.batch_size * self.num_replicas)
+        if self.shuffle:
+            batches = batches[torch.randperm(self.num_batches, generator=g).numpy()]
+        return batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        start = self.rank * self.batch_size
+        for batch in self.global_batches():
+            yield batch[start:start + self.batch_size].tolist()
+
+    def __len__(self) -> int:
+        return self.num_batches
@@ -0,0 +1,98 @@
+"""
+Losses and metrics of the hiverformer training loops, without a device
+sync per step.
+
+A DeviceMeter keeps running sums of named scalars as tensors on the
+device: update() detaches them, so no autograd graph outlives its step,
+and only adds them in place, so it never waits on the GPU. means() reads
+all the sums back at once (one sync), optionally summed over the ranks
+with a single all_reduce, and starts over. The loops read an interval
+meter every `log_every` steps and an epoch meter once per epoch.
+
+AsyncScalarWriter hands the scalars to a SummaryWriter from a background
+thread, so the training thread does not build the events itself. It is a
+no-op without a writer (on the ranks other than 0).
+"""
+import queue
+import threading
+from typing import Dict, Optional
+
+import torch
+import torch.distributed as dist
+
+
+class DeviceMeter(object):
+    """Running means of named scalars, summed on `device`."""
+
+    def __init__(self, device):
+        self.device = torch.device(device)
+        self.sums: Dict[str, torch.Tensor] = {}
+        self.count = 0
+
+    @torch.no_grad()
+    def update(self, values: Dict[str, torch.Tensor]) -> None:
+        for name, value in values.items():
+            value = torch.as_tensor(value).detach().to(self.device, torch.float32)
+            if name in self.sums:
+                self.sums[name] += value
+            else:
+                self.sums[name] = value.clone()
+        self.count += 1
+
+    def means(self, all_reduce: bool = False) -> Dict[str, float]:
+        """The means since the last call, over the ranks with `all_reduce`, then resets."""
+        names = sorted(self.sums)
+        totals = torch.stack([self.sums[n] for n in names] + [torch.tensor(float(self.count), device=self.device)])
+        if all_reduce and dist.is_available() and dist.is_initialized():
+            dist.all_reduce(totals)
+        totals = totals.tolist()
+        self.sums, self.count = {}, 0
+        return {n: t / max(totals[-1], 1.) for n, t in zip(names, totals[:-1])}
+
+
+class AsyncScalarWriter(object):
+    """add_scalar of a SummaryWriter (or of None) from a background thread."""
+
+    def __init__(self, writer=None, max_queue: int = 10000):
+        self.writer = writer
+        self._queue: Optional[queue.Queue] = None
+        self._thread: Optional[threading.Thread] = None
+        if writer is not None:
+            self._queue = queue.Queue(max_queue)
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+            try:
+                tag, value, step = item
+                self.writer.add_scalar(tag, value, step)
+            except Exception as e:
+                print('AsyncScalarWriter: could not write %s: %r' % (item[0], e))
+            self._queue.task_done()
+
+    def add_scalar(self, tag: str, value: float, step: int) -> None:
+        if self._queue is not None:
+            self._queue.put((tag, float(value), step))
+
+    def add_scalars(self, values: Dict[str, float], step: int, prefix: str = '') -> None:
+        for tag, value in values.items():
+            self.add_scalar(prefix + tag, value, step)
+
+    def flush(self) -> None:
+        """Waits until the queued scalars reached the SummaryWriter."""
+        if self._queue is not None:
+            self._queue.join()
+            self.writer.flush()
+
+    def close(self) -> None:
+        """Writes the queued scalars and stops the thread; the SummaryWriter stays open."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self.writer.flush()
+            self._queue = self._thread = None
@@ -343,24 +343,20 @@ class CrossTransformer(nn.Module):
         x: torch.Tensor,
         padding_mask: torch.Tensor,
         instruction: torch.Tensor,
+        first_step: int = 0,
     ):
         B, T, K, C = x.shape    # torch.Size([16, 10, 192, 64])
 
         # Cross attention
         input_tensor = einops.rearrange(x, "b t k c -> (b t) k c")      # torch.Size([160, 192, 64])
-        ctx_tensor = einops.rearrange(x, "b t k c -> (b t) k c")
-        ctx_tensor = einops.repeat(ctx_tensor, "(b t) k c -> (b t) (tp k) c", tp=T, t=T)    # torch.Size([160, 1920, 64])
-
-        ctx_attn_mask = torch.triu(torch.ones((T, T)), diagonal=1).to(x.device) 
-        ctx_attn_mask = einops.repeat(ctx_attn_mask, "t tp -> (b t) tp", b=B)
-        ctx_attn_mask = ctx_attn_mask.to(x.dtype)
-        ctx_attn_mask[ctx_attn_mask == 1] = -float("inf")
-        ctx_attn_mask = einops.repeat(
-            ctx_attn_mask, "bt t -> bt nh k (t kp)", nh=1, k=K, kp=K    # torch.Size([160, 1, 192, 1920])
-        )
-
-        ctx_tensor = self._add_instruction(instruction, ctx_tensor)
+        ctx_tensor = self._add_instruction(instruction, input_tensor)    # torch.Size([160, 8 + 192, 64])
         num_words = instruction.shape[1]
+
+        # The context of step t used to be T copies of its own tokens, those after
+        # t masked with -inf. Softmax over t + 1 copies of the same keys is softmax
+        # over one copy with a log(t + 1) bias, which needs no T * K context.
+        copies = torch.arange(first_step + 1, first_step + T + 1, device=x.device, dtype=x.dtype).log()
+        ctx_attn_mask = einops.repeat(copies, "t -> (b t) nh q k", b=B, nh=1, q=1, k=K)  # torch.Size([160, 1, 1, 192])
         ctx_attn_mask = F.pad(ctx_attn_mask, (num_words, 0))
 
         x = input_tensor
@@ -461,6 +457,7 @@ class Hiveformer(nn.Module):
         self._hidden_dim = hidden_dim
         self._mask_obs_prob = mask_obs_prob
         self._token_size = token_size
+        self._history_length = 0  # frames seen by `step` in the current episode
 
         self.cross_transformer = CrossTransformer(
             hidden_size=hidden_dim,
@@ -642,6 +639,7 @@ class Hiveformer(nn.Module):
         padding_mask,
         instruction: torch.Tensor,
         gripper: torch.Tensor,
+        first_step: int = 0,
     ) -> Output:
         padding_mask2 = torch.ones_like(padding_mask)  # HACK
 
@@ -682,7 +680,7 @@ class Hiveformer(nn.Module):
         x = torch.cat([x, pcd], 3)  # torch.Size([16, 10, 3, 19, 8, 8])
 
         # Add history channels to the backbone
-        ce = self.encoding(x, padding_mask, instruction, gripper)
+        ce = self.encoding(x, padding_mask, instruction, gripper, first_step)
         ce = ce[padding_mask]  # bpad n c h w
         ce = einops.repeat(ce, "bpad n c h w -> (bpad n) c h w")
         backbone.append(ce)
@@ -696,7 +694,40 @@ class Hiveformer(nn.Module):
             enc_feat,
             padding_mask,
             instruction,
+            first_step,
+        )
+
+    def reset_history(self) -> None:
+        """Starts a new episode for `step`."""
+        self._history_length = 0
+
+    def step(
+        self,
+        rgb_obs,
+        pc_obs,
+        instruction: torch.Tensor,
+        gripper: torch.Tensor,
+    ) -> Output:
+        """
+        Prediction for the newest frame of an episode, rgb_obs (B, N, ch, h, w).
+
+        A step only attends to its own tokens and the instruction, and only
+        reads the history through its index, so this is the last frame of
+        forward over the whole episode without encoding the earlier frames
+        again.
+        """
+        first_step = self._history_length
+        padding_mask = torch.ones(rgb_obs.shape[0], 1, dtype=torch.bool, device=rgb_obs.device)
+        pred = self(
+            rgb_obs.unsqueeze(1),
+            pc_obs.unsqueeze(1),
+            padding_mask,
+            instruction,
+            gripper.unsqueeze(1),
+            first_step,
         )
+        self._history_length = first_step + 1
+        return pred
 
     def encoding(
         self,
@@ -704,10 +735,11 @@ class Hiveformer(nn.Module):
         padding_mask: torch.Tensor,
         instruction: torch.Tensor,
         gripper: torch.Tensor,
+        first_step: int = 0,
     ):
         B, T, N, C, H, W = x.shape          # torch.Size([16, 10, 3, 19, 8, 8])
 
-        position = torch.arange(T).type_as(x).unsqueeze(0).long()
+        position = torch.arange(first_step, first_step + T).type_as(x).unsqueeze(0).long()
         pos_emb = self.position_embedding(position)
         pos_emb = self.position_norm(pos_emb).squeeze(0)
         pos_emb = einops.repeat(pos_emb, "t d -> b t n h w d", b=B, n=N, h=H, w=W)  # torch.Size([16, 10, 3, 8, 8, 64])
@@ -732,7 +764,7 @@ class Hiveformer(nn.Module):
 
         xe = einops.rearrange(xe, "b t n h w c -> b t (n h w) c")   # torch.Size([16, 10, 192, 64])
 
-        ce = self.cross_transformer(xe, padding_mask, instruction)  # torch.Size([160, 192, 64])
+        ce = self.cross_transformer(xe, padding_mask, instruction, first_step)  # torch.Size([160, 192, 64])
 
         ce = einops.rearrange(ce, "(b t) (n h w) c -> b t n c h w", n=N, t=T, h=H, w=W)
 
@@ -746,6 +778,7 @@ class Hiveformer(nn.Module):
         enc_feat,
         padding_mask,
         instruction: torch.Tensor,
+        first_step: int = 0,
     ) -> Output:
         """
         N: 视角数量
@@ -754,6 +787,7 @@ class Hiveformer(nn.Module):
         enc_feat: 通过编码之后的特征，纯图像的特征
         padding_maks: 补全的mask
         instruction: 文本的特征
+        first_step: 第一帧在episode中的序号
         """
         pc_obs = pc_obs[padding_mask]   # torch.Size([65, 3, 3, 128, 128])
         # decoding features for translation
@@ -798,7 +832,7 @@ class Hiveformer(nn.Module):
         z_instr = einops.repeat(z_instr, "b n -> b t 1 n", t=T)
         z_instr = z_instr[padding_mask]
 
-        step_ids = torch.arange(T, dtype=torch.long, device=device)
+        step_ids = torch.arange(first_step, first_step + T, dtype=torch.long, device=device)
         z_pos = self.z_pos_instr(step_ids.unsqueeze(0)).squeeze(0)
         z_pos = einops.repeat(z_pos, "t (n d) -> b t n d", b=B, n=num_tasks, d=3)
         z_pos = z_pos[padding_mask]
@@ -18,7 +18,7 @@ from amsolver.observation_config import ObservationConfig
 from pyrep.const import RenderMode
 from vlm.scripts.cliport_test import CliportAgent
 from num2words import num2words
-from hiverformer.process_instructions import get_language_feat
+from hiverformer.language_features import get_language_feat
 from hiverformer.network import Hiveformer
 from hiverformer.utils import (
     RLBenchEnv,
@@ -318,9 +318,7 @@ if __name__=="__main__":
                 high_descriptions = descriptions[0]
 
                 images = []
-                rgbs = torch.Tensor([]).to(device)
-                pcds = torch.Tensor([]).to(device)
-                grippers = torch.Tensor([]).to(device)
+                agent.reset_history()
 
                 images.append(
                     {cam: getattr(obs, f"{cam}_rgb") for cam in args.cameras}
@@ -345,16 +343,11 @@ if __name__=="__main__":
                     pcd = pcd.float().to(device)
                     gripper = gripper.float().to(device)
 
-                    rgbs = torch.cat([rgbs, rgb.unsqueeze(1)], dim=1)
-                    pcds = torch.cat([pcds, pcd.unsqueeze(1)], dim=1)
-                    grippers = torch.cat([grippers, gripper.unsqueeze(1)], dim=1)
-                    padding_mask = torch.ones_like(rgbs[:, :, 0, 0, 0, 0]).bool()
-
                     output: Dict[str, Any] = {"action": None, "attention": {}}
-                    pred = agent(
-                        rgbs,    
-                        pcds,
-                        padding_mask,
+                    # Only the new frame is encoded, see Hiveformer.step
+                    pred = agent.step(
+                        rgb,
+                        pcd,
                         lang_feat,
                         gripper,
                     )
@@ -17,9 +17,10 @@ import numpy as np
 from tqdm import tqdm, trange
 from filelock import FileLock
 import tap
-from hiverformer.process_instructions import get_language_feat
+from hiverformer.language_features import get_language_feat
 from hiverformer.network import Hiveformer
 from hiverformer.dataset import My_Dataset, RLBenchDataset
+from hiverformer.metrics import AsyncScalarWriter, DeviceMeter
 from hiverformer.utils import (
     LossAndMetrics,
     count_parameters,
@@ -44,6 +45,8 @@ class Arguments(tap.Tap):
     max_episodes_per_taskvar: int = 100
     instructions: Optional[Path] = None
     cache_size: int = 300
+    cache_bytes: Optional[int] = None
+    shared_cache: Optional[Path] = None  # e.g. /dev/shm/hiveformer, shared by all workers
     seed: int = 2
 
     # tasks: Tuple[str, ...]
@@ -58,6 +61,7 @@ class Arguments(tap.Tap):
     val_freq: int = 10000     # 200
     val_batch_size: int = 64
     jitter: bool = False
+    log_every: int = 50  # steps between two reads of the losses, the only device syncs of the loop
     
     # 自己加的
     train_dir: Path = "/home/liuchang/projects/VLMbench/VLMbench/hiverformer/packaged"
@@ -119,6 +123,11 @@ def training(
     # model.eval()
     iter_loader = iter(train_loader)
     device = next(model.parameters()).device
+    scalar_writer = AsyncScalarWriter(writer)
+    interval_meter = DeviceMeter(device)
+    # 每个 epoch（train_loader 走完一遍）所有进程的平均值
+    epoch_meter = DeviceMeter(device)
+    epoch = 0
 
     print('---------------------------------------------start------------------------------------------------------')
     with trange(args.epochs, ncols=100) as tbar:
@@ -126,6 +135,8 @@ def training(
             try:
                 sample = next(iter_loader)
             except StopIteration:
+                epoch += 1
+                scalar_writer.add_scalars(epoch_meter.means(all_reduce=args.distributed), epoch, prefix="epoch-")
                 iter_loader = iter(train_loader)
                 sample = next(iter_loader)
 
@@ -152,14 +163,11 @@ def training(
             train_losses = loss_and_metrics.compute_loss(pred, sample)
             train_losses["total"] = sum(list(train_losses.values()))  # type: ignore
 
-            for n, l in train_losses.items():
-                writer.add_scalar(f"train-loss/{n}", l, step_id)
-
-            writer.add_scalar(f"lr/", args.lr, step_id)
-
             metrics = loss_and_metrics.compute_metrics(pred, sample)
-            for n, l in metrics.items():
-                writer.add_scalar(f"train-metrics/{n}", l, step_id)
+            values = {f"train-loss/{n}": l for n, l in train_losses.items()}
+            values.update({f"train-metrics/{n}": l for n, l in metrics.items()})
+            interval_meter.update(values)
+            epoch_meter.update(values)
 
             train_losses["total"].backward()  # type: ignore
 
@@ -180,8 +188,14 @@ def training(
                 else:
                     val_metrics = {}
                 checkpointer(val_metrics)
-            # 显示 loss 的
-            tbar.set_postfix(l=float(train_losses["total"]))
+            # 显示 loss 的，每 log_every 步才从 GPU 读回来一次，写 Tensorboard 的是这几步的平均值
+            if (step_id + 1) % args.log_every == 0:
+                means = interval_meter.means()
+                scalar_writer.add_scalars(means, step_id)
+                scalar_writer.add_scalar(f"lr/", args.lr, step_id)
+                tbar.set_postfix(l=means["train-loss/total"])
+
+    scalar_writer.close()
             
 def get_log_dir(args: Arguments) -> Path:
     log_dir = args.xp / args.name
@@ -443,6 +457,8 @@ def main(gpu, ngpus_per_node, args):
         max_episode_length=args.maxAction,
         max_episodes_per_taskvar=args.max_episodes_per_taskvar,
         cache_size=args.cache_size,
+        cache_bytes=args.cache_bytes,
+        shared_cache=args.shared_cache,
         cameras=args.cameras,  # type: ignore
     )
 
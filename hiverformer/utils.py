@@ -29,8 +29,11 @@ from rlbench.action_modes.gripper_action_modes import Discrete
 from rlbench.action_modes.arm_action_modes import EndEffectorPoseViaPlanning
 from rlbench.backend.exceptions import InvalidActionError
 from rlbench.demo import Demo
+from rlbench.utils import get_stored_demos
 from pyrep.errors import IKError, ConfigurationPathError
 from pyrep.const import RenderMode
+from amsolver.keypoints import keypoint_discovery
+from amsolver.point_cloud import pointcloud_from_depth_and_camera_params
 import torchvision.transforms as transforms
 import torchvision.transforms.functional as transforms_f
 
@@ -364,6 +367,11 @@ class RLBenchEnv:
         self.obs_config = self.create_obs_config(
             apply_rgb, apply_depth, apply_pc, apply_cameras
         )
+        # Stored demos are loaded with their depths, the point clouds are
+        # rebuilt from them one batch per camera (see add_point_clouds)
+        self.demo_obs_config = self.create_obs_config(
+            apply_rgb, apply_depth or apply_pc, False, apply_cameras
+        )
         self.action_mode = MoveArmThenGripper(
             arm_action_mode=EndEffectorPoseViaPlanning(),
             gripper_action_mode=Discrete(),
@@ -455,15 +463,43 @@ class RLBenchEnv:
             :param episode_index: fetch episode index: 0 ~ 99
             :return: desired demo
         """
-        demos = self.env.get_demos(
-            task_name=task_name,
-            variation_number=variation,
+        demos = get_stored_demos(
             amount=1,
-            from_episode_number=episode_index,
+            image_paths=False,
+            dataset_root=str(self.data_path),
+            variation_number=variation,
+            task_name=task_name,
+            obs_config=self.demo_obs_config,
             random_selection=False,
+            from_episode_number=episode_index,
         )
+        if self.apply_pc:
+            for demo in demos:
+                self.add_point_clouds(demo)
         return demos
 
+    def add_point_clouds(self, demo: Demo):
+        """
+        Set the point clouds of a demo loaded with demo_obs_config from its
+        normalised depths, one batch of frames per camera.
+            :param demo: demo to complete, its depths are dropped unless apply_depth
+        """
+        observations = demo._observations
+        for cam in self.apply_cameras:
+            depth = np.stack([getattr(obs, f"{cam}_depth") for obs in observations])
+            near = np.array([obs.misc[f"{cam}_camera_near"] for obs in observations])
+            far = np.array([obs.misc[f"{cam}_camera_far"] for obs in observations])
+            depth_m = near[:, None, None] + depth * (far - near)[:, None, None]
+            point_clouds = pointcloud_from_depth_and_camera_params(
+                depth_m,
+                np.stack([obs.misc[f"{cam}_camera_extrinsics"] for obs in observations]),
+                np.stack([obs.misc[f"{cam}_camera_intrinsics"] for obs in observations]),
+            )
+            for obs, pc in zip(observations, point_clouds):
+                setattr(obs, f"{cam}_point_cloud", pc)
+                if not self.apply_depth:
+                    setattr(obs, f"{cam}_depth", None)
+
     def evaluate(
         self,
         task_str: str,
@@ -626,46 +662,6 @@ class RLBenchEnv:
         return obs_config
 
 
-# Identify way-point in each RLBench Demo
-def _is_stopped(demo, i, obs, stopped_buffer):
-    next_is_not_final = i == (len(demo) - 2)
-    gripper_state_no_change = i < (len(demo) - 2) and (
-        obs.gripper_open == demo[i + 1].gripper_open
-        and obs.gripper_open == demo[i - 1].gripper_open
-        and demo[i - 2].gripper_open == demo[i - 1].gripper_open
-    )
-    small_delta = np.allclose(obs.joint_velocities, 0, atol=0.1)
-    stopped = (
-        stopped_buffer <= 0
-        and small_delta
-        and (not next_is_not_final)
-        and gripper_state_no_change
-    )
-    return stopped
-
-
-def keypoint_discovery(demo: Demo) -> List[int]:
-    episode_keypoints = []
-    prev_gripper_open = demo[0].gripper_open
-    stopped_buffer = 0
-    for i, obs in enumerate(demo):
-        stopped = _is_stopped(demo, i, obs, stopped_buffer)
-        stopped_buffer = 4 if stopped else stopped_buffer - 1
-        # If change in gripper, or end of episode.
-        last = i == (len(demo) - 1)
-        if i != 0 and (obs.gripper_open != prev_gripper_open or last or stopped):
-            episode_keypoints.append(i)
-        prev_gripper_open = obs.gripper_open
-    if (
-        len(episode_keypoints) > 1
-        and (episode_keypoints[-1] - 1) == episode_keypoints[-2]
-    ):
-        episode_keypoints.pop(-2)
-
-    # HACK for tower3 task
-    return episode_keypoints
-
-
 # --------------------------------------------------------------------------------
 # General Functions
 # --------------------------------------------------------------------------------
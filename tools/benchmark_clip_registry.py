@@ -0,0 +1,88 @@
+from os.path import join, dirname, abspath
+from time import time
+import sys
+CURRENT_DIR = dirname(abspath(__file__))
+sys.path.insert(0, join(CURRENT_DIR, '..'))
+import torch
+
+from cliport.models.core.clip import load_clip, tokenize
+from cliport.models.core import clip_registry
+
+from absl import app
+from absl import flags
+
+"""
+Builds the frozen CLIP backbones of the streams of a cliport agent, once
+with a load_clip per stream as CLIPLingUNetLat did, once from
+cliport.models.core.clip_registry, and reports the construction time and
+the parameter memory of both. Checks the views give the outputs of separate
+copies in train and eval mode, including with per-stream batch norm
+statistics loaded from a state dict.
+"""
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('streams', 4, 'Streams of the agent (attention, transport key and query, rpz).')
+flags.DEFINE_integer('batch', 2, 'Images encoded per check.')
+flags.DEFINE_string('device', 'cuda' if torch.cuda.is_available() else 'cpu', 'Device of the agent.')
+
+
+def reference_backbone(device):
+    """The backbone CLIPLingUNetLat loaded for every stream before the registry."""
+    clip_rn50, _ = load_clip('RN50', device=device)
+    for parameter in clip_rn50.parameters():
+        parameter.requires_grad = False
+    return clip_rn50
+
+
+def unique_parameter_bytes(modules):
+    parameters = {id(p): p for m in modules for p in m.parameters()}
+    return sum(p.numel() * p.element_size() for p in parameters.values())
+
+
+def outputs(backbone, img, tokens):
+    with torch.no_grad():
+        img_encoding, img_im = backbone.visual.prepool_im(img)
+        text_feat, text_emb = backbone.encode_text_with_embeddings(tokens)
+    return [img_encoding, text_feat, text_emb] + list(img_im)
+
+
+def main(argv):
+    device = torch.device(FLAGS.device)
+    start = time()
+    ref = [reference_backbone(device) for _ in range(FLAGS.streams)]
+    ref_time = time() - start
+    start = time()
+    new = [clip_registry.get_frozen_clip('RN50', device) for _ in range(FLAGS.streams)]
+    new_time = time() - start
+
+    torch.manual_seed(0)
+    dtype = ref[0].visual.conv1.weight.dtype
+    img = torch.randn(FLAGS.batch, 3, 224, 224, device=device, dtype=dtype)
+    tokens = tokenize(['pick up the red block', 'stack the cubes']).to(device)
+    # Train mode updates the batch norm statistics of every stream on its own inputs.
+    for i, (a, b) in enumerate(zip(ref, new)):
+        a.train(), b.train()
+        for x, y in zip(outputs(a, img + i, tokens), outputs(b, img + i, tokens)):
+            assert torch.equal(x, y)
+    for a, b in zip(ref, new):
+        a.eval(), b.eval()
+        for x, y in zip(outputs(a, img, tokens), outputs(b, img, tokens)):
+            assert torch.equal(x, y)
+    # Per-stream statistics of a checkpoint.
+    for a, b in zip(ref, new):
+        b.load_state_dict(a.state_dict())
+    for a, b in zip(ref, new):
+        for x, y in zip(outputs(a, img, tokens), outputs(b, img, tokens)):
+            assert torch.equal(x, y)
+
+    stats = clip_registry.frozen_clip_stats()[('RN50', str(device))]
+    print('%d streams on %s' % (FLAGS.streams, device))
+    print('load_clip per stream : %.1f s, %.0f MB of parameters' % (
+        ref_time, unique_parameter_bytes(ref) / 2 ** 20))
+    print('clip_registry        : %.1f s, %.0f MB of parameters, %.0f MB resident' % (
+        new_time, unique_parameter_bytes(new) / 2 ** 20, stats['resident_bytes'] / 2 ** 20))
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,136 @@
+from os.path import join, dirname, abspath
+from time import time, sleep
+import sys
+CURRENT_DIR = dirname(abspath(__file__))
+sys.path.insert(0, join(CURRENT_DIR, '..'))
+import numpy as np
+import torch
+from scipy.spatial.transform import Rotation as R
+
+from vlm.scripts.cliport_batch import CliportCollate, prefetch_to_device
+
+from absl import app
+from absl import flags
+
+"""
+Runs the batch loop of vlm/scripts/train_baselines.py on random samples
+shaped like the ones of VLM_dataset, with a --step_time sleep in place of
+the training step: once with the list collate and the batch assembly on
+the training process it had, once with CliportCollate in the workers and
+prefetch_to_device. Reports data_time and batch_time of both and checks
+they build the same inputs.
+"""
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('samples', 256, 'Samples of the dataset.')
+flags.DEFINE_integer('batch_size', 16, 'Batch size.')
+flags.DEFINE_integer('steps', 3, 'Waypoint steps of a sample.')
+flags.DEFINE_integer('workers', 2, 'DataLoader workers.')
+flags.DEFINE_float('step_time', 0.05, 'Seconds of a training step.')
+flags.DEFINE_string('device', 'cuda' if torch.cuda.is_available() else 'cpu', 'Device of the model.')
+
+BOUNDS = np.array([[-0.05, 0.67], [-0.45, 0.45], [0.7, 1.2]])
+PIXEL_SIZE = 5.625e-3
+
+
+class FakeDataset(torch.utils.data.Dataset):
+    """Samples of VLM_dataset.get_cliport_gt: fused color and height maps, pick and place poses."""
+
+    def __len__(self):
+        return FLAGS.samples
+
+    def __getitem__(self, index):
+        rng = np.random.RandomState(index)
+        steps = FLAGS.steps
+        cmap = rng.randint(0, 256, (steps, 128, 160, 3)).astype(np.uint8)
+        hmap = np.tile(rng.rand(steps, 128, 160)[..., None], (1, 1, 1, 3))
+
+        def poses():
+            xyz = rng.uniform(BOUNDS[:, 0], BOUNDS[:, 1], (steps, 3))
+            return np.concatenate([xyz, R.random(steps, random_state=rng).as_quat()], 1)
+        return {'img': np.concatenate([cmap, hmap], axis=-1),
+                'attention_points': poses(), 'target_points': poses(),
+                'language': ['Pick the block. Step %d.' % i for i in range(steps)],
+                'bounds': BOUNDS, 'pixel_size': PIXEL_SIZE, 'episode': str(index), 'valid': 1}
+
+
+def list_collate(batch):
+    return batch
+
+
+def reference_inputs(batch_data, euler='zyx'):
+    """Batch assembly of train() in vlm/scripts/train_baselines.py before CliportCollate."""
+    bounds, pixel_size = batch_data[0]['bounds'], batch_data[0]['pixel_size']
+    img, language_instructions = [], []
+    attention_points, target_points = [], []
+    for data in batch_data:
+        img.append(data['img'])
+        language_instructions += data['language']
+        attention_points.append(data['attention_points'])
+        target_points.append(data['target_points'])
+    img = np.concatenate(img, axis=0)
+    attention_points = np.concatenate(attention_points, axis=0)
+    target_points = np.concatenate(target_points, axis=0)
+    p0 = np.int16((attention_points[:, :2]-bounds[:2, 0])/pixel_size)
+    p0_z = attention_points[:, 2:3]-bounds[2, 0]
+    p0_rotation = R.from_quat(attention_points[:, 3:])
+    p1 = np.int16((target_points[:, :2]-bounds[:2, 0])/pixel_size)
+    p1_z = target_points[:, 2:3]-bounds[2, 0]
+    p1_rotation = R.from_quat(target_points[:, 3:])
+    p0 = p0[:, ::-1]
+    p1 = p1[:, ::-1]
+    p0_rotation = p0_rotation.as_euler(euler, degrees=True)
+    p1_rotation = p1_rotation.as_euler(euler, degrees=True)
+    return {'img': img, 'lang_goal': language_instructions,
+            'p0': p0, 'p0_z': p0_z, 'p0_rotation': p0_rotation,
+            'p1': p1, 'p1_z': p1_z, 'p1_rotation': p1_rotation}
+
+
+def step(inp, device):
+    """Stands for model(inp): the image goes to the device, the rest is simulated."""
+    img = inp['img']
+    if not torch.is_tensor(img):
+        img = torch.from_numpy(img)
+    img.to(device=device, dtype=torch.float).sum().item()
+    sleep(FLAGS.step_time)
+
+
+def run(collate, assemble, prefetch):
+    loader = torch.utils.data.DataLoader(
+        FakeDataset(), batch_size=FLAGS.batch_size, shuffle=False, num_workers=FLAGS.workers,
+        pin_memory=FLAGS.device.startswith('cuda'), drop_last=True, collate_fn=collate,
+        persistent_workers=True)
+    batches = prefetch_to_device(loader, FLAGS.device) if prefetch else loader
+    data_time = batch_time = 0.
+    end = time()
+    for batch in batches:
+        inp = assemble(batch) if assemble else batch
+        data_time += time() - end
+        step(inp, FLAGS.device)
+        batch_time += time() - end
+        end = time()
+    return data_time / len(loader), batch_time / len(loader)
+
+
+def main(argv):
+    dataset = FakeDataset()
+    for euler in ('zyx', 'zxy'):
+        samples = [dataset[i] for i in range(FLAGS.batch_size)]
+        ref, new = reference_inputs(samples, euler), CliportCollate(euler)(samples)
+        for key, value in ref.items():
+            other = new[key].numpy() if torch.is_tensor(new[key]) else new[key]
+            assert np.array_equal(np.asarray(value, dtype=np.asarray(other).dtype), other), key
+
+    ref_data, ref_batch = run(list_collate, reference_inputs, False)
+    new_data, new_batch = run(CliportCollate('zyx'), None, True)
+    print('%d workers, batches of %d samples of %d steps, %.0f ms steps on %s' % (
+        FLAGS.workers, FLAGS.batch_size, FLAGS.steps, FLAGS.step_time * 1e3, FLAGS.device))
+    print('assembled on the training process : data_time %.1f ms, batch_time %.1f ms' % (
+        ref_data * 1e3, ref_batch * 1e3))
+    print('CliportCollate + prefetch         : data_time %.1f ms, batch_time %.1f ms' % (
+        new_data * 1e3, new_batch * 1e3))
+
+
+if __name__ == '__main__':
+  app.run(main)
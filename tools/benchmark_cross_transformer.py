@@ -0,0 +1,103 @@
+from os.path import join, dirname, abspath
+from time import time
+import sys
+CURRENT_DIR = dirname(abspath(__file__))
+sys.path.insert(0, join(CURRENT_DIR, '..'))
+import einops
+import torch
+import torch.nn.functional as F
+
+from hiverformer.network import CrossTransformer
+
+from absl import app
+from absl import flags
+
+"""
+Micro-benchmark of the hiverformer CrossTransformer on CPU: the context
+replicated T times with a (B*T, 1, K, T*K) mask against the un-replicated
+context with a log-count bias, for T = 4...20. Checks that both give the
+same output and reports activation memory saved for backward and
+forward + backward time.
+"""
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('batch', 4, 'Batch size.')
+flags.DEFINE_list('steps', [4, 8, 12, 16, 20], 'History lengths T.')
+flags.DEFINE_integer('tokens', 192, 'Visual tokens per step K.')
+flags.DEFINE_integer('hidden', 64, 'Hidden size.')
+flags.DEFINE_integer('num_words', 53, 'Instruction length.')
+flags.DEFINE_integer('layers', 1, 'Cross layers.')
+flags.DEFINE_integer('repeats', 3, 'Timed repetitions.')
+
+
+def reference_forward(model, x, padding_mask, instruction):
+    """CrossTransformer.forward before the context stopped being replicated."""
+    B, T, K, C = x.shape
+    input_tensor = einops.rearrange(x, "b t k c -> (b t) k c")
+    ctx_tensor = einops.rearrange(x, "b t k c -> (b t) k c")
+    ctx_tensor = einops.repeat(ctx_tensor, "(b t) k c -> (b t) (tp k) c", tp=T, t=T)
+
+    ctx_attn_mask = torch.triu(torch.ones((T, T)), diagonal=1).to(x.device)
+    ctx_attn_mask = einops.repeat(ctx_attn_mask, "t tp -> (b t) tp", b=B)
+    ctx_attn_mask = ctx_attn_mask.to(x.dtype)
+    ctx_attn_mask[ctx_attn_mask == 1] = -float("inf")
+    ctx_attn_mask = einops.repeat(
+        ctx_attn_mask, "bt t -> bt nh k (t kp)", nh=1, k=K, kp=K
+    )
+
+    ctx_tensor = model._add_instruction(instruction, ctx_tensor)
+    num_words = instruction.shape[1]
+    ctx_attn_mask = F.pad(ctx_attn_mask, (num_words, 0))
+
+    x = input_tensor
+    for x_layer in model.cross_layers:
+        x = x_layer(x, ctx_tensor, ctx_attn_mask)
+    return x
+
+
+def saved_bytes(fn):
+    """Bytes of the tensors autograd keeps for backward while running fn."""
+    total = [0]
+
+    def pack(t):
+        total[0] += t.numel() * t.element_size()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        out = fn()
+    return out, total[0]
+
+
+def timeit(fn, repeats):
+    fn()
+    start = time()
+    for _ in range(repeats):
+        fn()
+    return (time() - start) / repeats
+
+
+def main(argv):
+    torch.manual_seed(0)
+    model = CrossTransformer(FLAGS.hidden, FLAGS.hidden * 4, 512, 8, 0.1, FLAGS.num_words, FLAGS.layers)
+    model.eval()  # Attention dropout would drop the replicated copies independently.
+
+    print('T   replicated: MB  ms    |  linear: MB  ms      max abs diff')
+    for T in map(int, FLAGS.steps):
+        x = torch.randn(FLAGS.batch, T, FLAGS.tokens, FLAGS.hidden, requires_grad=True)
+        padding_mask = torch.ones(FLAGS.batch, T, dtype=torch.bool)
+        instruction = torch.randn(FLAGS.batch, FLAGS.num_words, 512)
+
+        ref, ref_bytes = saved_bytes(lambda: reference_forward(model, x, padding_mask, instruction))
+        out, new_bytes = saved_bytes(lambda: model(x, padding_mask, instruction))
+        diff = (ref - out).abs().max().item()
+        assert torch.allclose(ref, out, atol=1e-4), diff
+
+        t_ref = timeit(lambda: reference_forward(model, x, padding_mask, instruction).sum().backward(), FLAGS.repeats)
+        t_new = timeit(lambda: model(x, padding_mask, instruction).sum().backward(), FLAGS.repeats)
+        print('%-3d %14.1f %6.1f  | %10.1f %6.1f     %.2e' % (
+            T, ref_bytes / 2 ** 20, t_ref * 1e3, new_bytes / 2 ** 20, t_new * 1e3, diff))
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,190 @@
+from os.path import join, dirname, abspath
+from time import time
+import io
+import socket
+import sys
+CURRENT_DIR = dirname(abspath(__file__))
+sys.path.insert(0, join(CURRENT_DIR, '..'))
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch import nn
+from torch.distributed.algorithms.ddp_comm_hooks.default_hooks import allreduce_hook
+from torch.utils.data import DataLoader, TensorDataset
+from torch.utils.data.distributed import DistributedSampler
+
+from vlm.scripts.cliport_batch import prefetch_to_device
+from vlm.scripts.train_engine import GradientAccumulator, wrap_ddp
+
+from absl import app
+from absl import flags
+
+"""
+Trains a small stand-in of Hiveformer (dropout, and a head forward never
+calls) with DistributedDataParallel on gloo CPU processes, once with the
+loop train_hiverformer.training ran before vlm/scripts/train_engine.py
+(find_unused_parameters, gradients all-reduced after every micro-batch),
+once with the engine (unused parameters found upfront and ignored by DDP,
+no_sync on the micro-batches before the last one of a step). Checks both end with the
+same parameters and optimizer state on every rank and reports the time and
+the all-reduces per optimizer step.
+"""
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('processes', 2, 'Ranks of the gloo process group.')
+flags.DEFINE_integer('accumulate_grad_batches', 4, 'Micro-batches per optimizer step.')
+flags.DEFINE_integer('samples', 256, 'Samples of the fake dataset.')
+flags.DEFINE_integer('batch_size', 8, 'Samples per micro-batch and rank.')
+flags.DEFINE_integer('epochs', 2, 'Epochs of both runs.')
+flags.DEFINE_integer('hidden', 256, 'Width of the stand-in model.')
+flags.DEFINE_bool('double', True, 'Train in float64, so the summation order of the gradients does not show.')
+
+
+class StandIn(nn.Module):
+    def __init__(self, hidden):
+        super().__init__()
+        self.encoder = nn.Sequential(nn.Linear(32, hidden), nn.ReLU(), nn.Dropout(0.1),
+                                     nn.Linear(hidden, hidden), nn.LayerNorm(hidden), nn.ReLU())
+        self.position = nn.Linear(hidden, 3)
+        self.gripper = nn.Linear(hidden, 1)
+        self.unused_head = nn.Linear(hidden, 8)
+
+    def forward(self, x):
+        h = self.encoder(x)
+        return {'position': self.position(h), 'gripper': torch.sigmoid(self.gripper(h))}
+
+
+def compute_loss(pred, sample):
+    return (nn.functional.mse_loss(pred['position'], sample['position'])
+            + nn.functional.mse_loss(pred['gripper'], sample['gripper']))
+
+
+def make_loader(dtype):
+    generator = torch.Generator().manual_seed(0)
+    x = torch.randn(FLAGS.samples, 32, generator=generator, dtype=dtype)
+    dataset = TensorDataset(x, torch.randn(FLAGS.samples, 3, generator=generator, dtype=dtype),
+                            torch.rand(FLAGS.samples, 1, generator=generator, dtype=dtype).round())
+    sampler = DistributedSampler(dataset, seed=0)
+
+    def collate(batch):
+        x, position, gripper = (torch.stack(column) for column in zip(*batch))
+        return {'x': x, 'position': position, 'gripper': gripper}
+    return DataLoader(dataset, batch_size=FLAGS.batch_size, sampler=sampler, collate_fn=collate, drop_last=True), sampler
+
+
+def make_optimizer(model):
+    groups = [{'params': [], 'weight_decay': 0.0, 'lr': 1e-3}, {'params': [], 'weight_decay': 5e-4, 'lr': 1e-3}]
+    for name, param in model.named_parameters():
+        groups[0 if 'bias' in name else 1]['params'].append(param)
+    return torch.optim.AdamW(groups)
+
+
+def counting_hook(counter, bucket):
+    counter[0] += 1
+    return allreduce_hook(None, bucket)
+
+
+def reference_training(model, optimizer, loader, sampler):
+    """train_hiverformer.training before the engine, on CPU."""
+    for epoch in range(FLAGS.epochs):
+        sampler.set_epoch(epoch)
+        for batch_step, sample in enumerate(loader):
+            if batch_step % FLAGS.accumulate_grad_batches == 0:
+                optimizer.zero_grad()
+            loss = compute_loss(model(sample['x']), sample)
+            loss.backward()
+            if batch_step % FLAGS.accumulate_grad_batches == FLAGS.accumulate_grad_batches - 1:
+                optimizer.step()
+
+
+def engine_training(model, optimizer, loader, sampler):
+    accumulator = GradientAccumulator(model, optimizer, FLAGS.accumulate_grad_batches)
+    for epoch in range(FLAGS.epochs):
+        sampler.set_epoch(epoch)
+        for batch_step, sample in enumerate(prefetch_to_device(loader, 'cpu')):
+            with accumulator.micro_batch(batch_step):
+                loss = compute_loss(model(sample['x']), sample)
+                loss.backward()
+
+
+def run(argv, rank, port, engine, results):
+    FLAGS(argv)  # Spawned processes do not get the parsed flags.
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:%d' % port,
+                            world_size=FLAGS.processes, rank=rank)
+    dtype = torch.float64 if FLAGS.double else torch.float32
+    torch.manual_seed(0)
+    model = StandIn(FLAGS.hidden).to(dtype)
+    loader, sampler = make_loader(dtype)
+    # Dropout differs per rank, as it does with the seed of train_hiverformer on different data.
+    torch.manual_seed(1 + rank)
+    if engine:
+        def probe_step(net):
+            sample = next(iter(loader))
+            compute_loss(net(sample['x']), sample).backward()
+        model = wrap_ddp(model, probe_step=probe_step)
+    else:
+        model = wrap_ddp(model)
+    optimizer = make_optimizer(model)
+    allreduces = [0]
+    model.register_comm_hook(allreduces, counting_hook)
+    dist.barrier()
+    start = time()
+    (engine_training if engine else reference_training)(model, optimizer, loader, sampler)
+    dist.barrier()
+    elapsed = time() - start
+    steps = FLAGS.epochs * (len(loader) // FLAGS.accumulate_grad_batches)
+    state = {'parameters': {k: v.detach().clone() for k, v in model.module.state_dict().items()},
+             'optimizer': optimizer.state_dict()['state']}
+    buffer = io.BytesIO()
+    torch.save(state, buffer)  # Shared tensors would not outlive the process.
+    results.put((engine, rank, buffer.getvalue(), elapsed, allreduces[0] / steps))
+    dist.destroy_process_group()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def main(argv):
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+    outcomes = {}
+    for engine in (False, True):
+        port = free_port()
+        procs = [ctx.Process(target=run, args=(sys.argv, rank, port, engine, results)) for rank in range(FLAGS.processes)]
+        for proc in procs:
+            proc.start()
+        for _ in procs:
+            engine_, rank, state, elapsed, allreduces = results.get()
+            outcomes[engine_, rank] = (torch.load(io.BytesIO(state)), elapsed, allreduces)
+        for proc in procs:
+            proc.join()
+            assert proc.exitcode == 0
+
+    max_diff = 0.
+    for rank in range(FLAGS.processes):
+        ref, new = outcomes[False, rank][0], outcomes[True, rank][0]
+        for name, value in ref['parameters'].items():
+            max_diff = max(max_diff, (value - new['parameters'][name]).abs().max().item())
+            assert torch.allclose(value, new['parameters'][name], rtol=0, atol=1e-10 if FLAGS.double else 1e-5), name
+        assert ref['optimizer'].keys() == new['optimizer'].keys()
+        for index, s in ref['optimizer'].items():
+            for key, value in s.items():
+                assert torch.allclose(value, new['optimizer'][index][key], rtol=0,
+                                      atol=1e-10 if FLAGS.double else 1e-5), (index, key)
+    unchanged = torch.equal(ref['parameters']['unused_head.weight'], new['parameters']['unused_head.weight'])
+
+    print('%d gloo processes, %d micro-batches of %d per step, %s' % (
+        FLAGS.processes, FLAGS.accumulate_grad_batches, FLAGS.batch_size, 'float64' if FLAGS.double else 'float32'))
+    print('max parameter difference: %.3g, unused head identical: %s' % (max_diff, unchanged))
+    for engine, label in ((False, 'find_unused_parameters, sync every micro-batch'),
+                          (True, 'train_engine                                 ')):
+        _, elapsed, allreduces = outcomes[engine, 0]
+        print('%s : %.2f s, %.1f bucket all-reduces / optimizer step' % (label, elapsed, allreduces))
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,108 @@
+from os.path import join, dirname, abspath
+from time import time, sleep
+import filecmp
+import os
+import shutil
+import sys
+import tempfile
+CURRENT_DIR = dirname(abspath(__file__))
+sys.path.insert(0, join(CURRENT_DIR, '..'))
+import numpy as np
+
+from demo_writer import CAMERA_FOLDERS, DemoWriter, demo_images, write_image, write_low_dim
+from amsolver.backend.const import LOW_DIM_PICKLE
+
+from absl import app
+from absl import flags
+
+"""
+Saves random demos with the 5 cameras of dataset generation, on the
+simulator process as save_demo used to and with DemoWriter, sleeping
+--sim_time between demos in place of the simulation. Reports the time the
+simulator spends saving, the total time, and checks both write the same
+files.
+"""
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('episodes', 8, 'Demos saved.')
+flags.DEFINE_integer('frames', 40, 'Frames per demo.')
+flags.DEFINE_integer('image_size', 128, 'Image size.')
+flags.DEFINE_float('sim_time', 1., 'Seconds of simulation per demo.')
+flags.DEFINE_integer('workers', 4, 'Writer threads (or processes).')
+flags.DEFINE_bool('processes', False, 'Encode in processes rather than threads.')
+flags.DEFINE_integer('compress_level', 6, 'PNG zlib level.')
+flags.DEFINE_string('save_path', None, 'Where to write, a temporary folder otherwise.')
+
+
+class FakeObservation(object):
+    pass
+
+
+def fake_demo(rng):
+    size = FLAGS.image_size
+    demo = []
+    for _ in range(FLAGS.frames):
+        obs = FakeObservation()
+        obs.gripper_pose = rng.rand(7)
+        for camera, _, _, _ in CAMERA_FOLDERS:
+            setattr(obs, camera + '_rgb', rng.randint(0, 256, (size, size, 3), dtype=np.uint8))
+            setattr(obs, camera + '_depth', rng.rand(size, size).astype(np.float32))
+            setattr(obs, camera + '_mask', (rng.rand(size, size, 3) > 0.5).astype(np.float32))
+            setattr(obs, camera + '_point_cloud', rng.rand(size, size, 3))
+        demo.append(obs)
+    return demo
+
+
+def run(save_path, writer):
+    rng = np.random.RandomState(0)
+    saving = 0.
+    start = time()
+    for e in range(FLAGS.episodes):
+        demo = fake_demo(rng)
+        sleep(FLAGS.sim_time)
+        example_path = join(save_path, 'episode%d' % e)
+        t0 = time()
+        if writer is None:
+            for path, kind, array in demo_images(demo, example_path):
+                write_image(path, kind, array, FLAGS.compress_level)
+            write_low_dim(demo, example_path)
+        else:
+            writer.save(demo, example_path)
+        saving += time() - t0
+    if writer is not None:
+        writer.close()
+    return saving, time() - start
+
+
+def same_files(a, b):
+    for root, _, files in os.walk(a):
+        for name in files:
+            other = join(b, os.path.relpath(join(root, name), a))
+            if name != LOW_DIM_PICKLE and not filecmp.cmp(join(root, name), other, shallow=False):
+                return False
+    return True
+
+
+def main(argv):
+    root = FLAGS.save_path or tempfile.mkdtemp()
+    sync_path, async_path = join(root, 'sync'), join(root, 'async')
+    try:
+        sync_saving, sync_total = run(sync_path, None)
+        writer = DemoWriter(FLAGS.workers, compress_level=FLAGS.compress_level, processes=FLAGS.processes)
+        async_saving, async_total = run(async_path, writer)
+        assert same_files(sync_path, async_path)
+        assert all(os.path.isfile(join(async_path, 'episode%d' % e, LOW_DIM_PICKLE))
+                   for e in range(FLAGS.episodes))
+    finally:
+        if FLAGS.save_path is None:
+            shutil.rmtree(root)
+
+    n = FLAGS.episodes
+    print('%d demos of %d frames, %.1f s of simulation each' % (n, FLAGS.frames, FLAGS.sim_time))
+    print('on the simulator : %.2f s saving / demo, %.1f s total' % (sync_saving / n, sync_total))
+    print('DemoWriter       : %.2f s saving / demo, %.1f s total' % (async_saving / n, async_total))
+
+
+if __name__ == '__main__':
+  app.run(main)
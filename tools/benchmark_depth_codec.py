@@ -0,0 +1,109 @@
+from os.path import join, dirname, abspath
+from time import time
+import sys
+CURRENT_DIR = dirname(abspath(__file__))
+sys.path.insert(0, join(CURRENT_DIR, '..'))
+import numpy as np
+
+from amsolver.depth_codec import code_to_float_array, code_to_rgb, float_array_to_code, rgb_to_code
+
+from absl import app
+from absl import flags
+
+"""
+Checks amsolver.depth_codec against the per-image depth conversions of
+amsolver.backend.utils it replaced, on random depth batches of
+(frames, cameras, H, W) with values outside [0, 1] too, and times both.
+Encoded bytes and decoded values must be bit-exact.
+"""
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('frames', 40, 'Frames per batch.')
+flags.DEFINE_integer('cameras', 5, 'Cameras per frame.')
+flags.DEFINE_integer('image_size', 128, 'Image size.')
+flags.DEFINE_integer('repeats', 3, 'Timed repetitions.')
+
+DEPTH_SCALE = 2**24 - 1
+
+
+def reference_encode(float_array, scale_factor=DEPTH_SCALE, drop_blue=False):
+    """float_array_to_rgb_image before amsolver.depth_codec, without the PIL image."""
+    scaled_array = np.floor(float_array * scale_factor + 0.5)
+    min_inttype = 0
+    max_inttype = 2**24 - 1
+    if scaled_array.min() < min_inttype or scaled_array.max() > max_inttype:
+        scaled_array = np.clip(scaled_array, min_inttype, max_inttype)
+    int_array = scaled_array.astype(np.uint32)
+    rg = np.divide(int_array, 256)
+    r = np.divide(rg, 256)
+    g = np.mod(rg, 256)
+    image_shape = int_array.shape
+    rgb_array = np.zeros((image_shape[0], image_shape[1], 3), dtype=np.uint8)
+    rgb_array[..., 0] = r
+    rgb_array[..., 1] = g
+    if not drop_blue:
+        b = np.mod(int_array, 256)
+        rgb_array[..., 2] = b
+    return rgb_array
+
+
+def reference_decode(image_array, scale_factor=DEPTH_SCALE):
+    """image_to_float_array before amsolver.depth_codec, for RGB images."""
+    float_array = np.sum(image_array * [65536, 256, 1], axis=2)
+    return float_array / scale_factor
+
+
+def timeit(fn):
+    fn()
+    start = time()
+    for _ in range(FLAGS.repeats):
+        fn()
+    return (time() - start) / FLAGS.repeats
+
+
+def main(argv):
+    rng = np.random.RandomState(0)
+    size = FLAGS.image_size
+    shape = (FLAGS.frames, FLAGS.cameras, size, size)
+    near = rng.uniform(0.01, 0.1, shape[:2])
+    far = rng.uniform(3., 5., shape[:2])
+    frames = FLAGS.frames * FLAGS.cameras
+
+    for dtype in (np.float32, np.float64):
+        depth = rng.uniform(-0.05, 1.05, shape).astype(dtype)
+        flat = depth.reshape((-1, size, size))
+
+        ref_rgb = np.stack([reference_encode(d) for d in flat]).reshape(shape + (3,))
+        rgb = code_to_rgb(float_array_to_code(depth, DEPTH_SCALE))
+        assert np.array_equal(ref_rgb, rgb)
+        ref_blue = np.stack([reference_encode(d, drop_blue=True) for d in flat]).reshape(shape + (3,))
+        assert np.array_equal(ref_blue, code_to_rgb(float_array_to_code(depth, DEPTH_SCALE), drop_blue=True))
+
+        ref_depth = np.stack([reference_decode(i) for i in ref_rgb.reshape((-1, size, size, 3))]).reshape(shape)
+        code = rgb_to_code(rgb)
+        assert np.array_equal(ref_depth, code_to_float_array(code, DEPTH_SCALE))
+        ref_metres = np.empty(shape)
+        for f in range(shape[0]):
+            for c in range(shape[1]):
+                ref_metres[f, c] = near[f, c] + ref_depth[f, c] * (far[f, c] - near[f, c])
+        assert np.array_equal(ref_metres, code_to_float_array(code, DEPTH_SCALE, near, far))
+        metres32 = code_to_float_array(code, DEPTH_SCALE, near, far, dtype=np.float32)
+        assert np.allclose(ref_metres, metres32, rtol=1e-6, atol=1e-6)
+
+        t_enc_ref = timeit(lambda: [reference_encode(d) for d in flat])
+        t_enc = timeit(lambda: code_to_rgb(float_array_to_code(depth, DEPTH_SCALE)))
+        t_dec_ref = timeit(lambda: [near[f, c] + reference_decode(ref_rgb[f, c]) * (far[f, c] - near[f, c])
+                                    for f in range(shape[0]) for c in range(shape[1])])
+        t_dec = timeit(lambda: code_to_float_array(rgb_to_code(rgb), DEPTH_SCALE, near, far))
+        t_dec32 = timeit(lambda: code_to_float_array(rgb_to_code(rgb), DEPTH_SCALE, near, far, dtype=np.float32))
+        print('%s depth, %d images of %dx%d: bit-exact' % (np.dtype(dtype).name, frames, size, size))
+        print('  encode            : %.3f -> %.3f ms / image (x%.1f)' % (
+            t_enc_ref / frames * 1e3, t_enc / frames * 1e3, t_enc_ref / t_enc))
+        print('  decode to metres  : %.3f -> %.3f ms / image (x%.1f)' % (
+            t_dec_ref / frames * 1e3, t_dec / frames * 1e3, t_dec_ref / t_dec))
+        print('  ... as float32    : %.3f ms / image (x%.1f)' % (t_dec32 / frames * 1e3, t_dec_ref / t_dec32))
+
+
+if __name__ == '__main__':
+  app.run(main)
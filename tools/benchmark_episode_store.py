@@ -0,0 +1,119 @@
+import os
+import pickle
+import tempfile
+from os.path import join, dirname, abspath
+from time import time
+import sys
+CURRENT_DIR = dirname(abspath(__file__))
+sys.path.insert(0, join(CURRENT_DIR, '..'))  # Use local amsolver rather than installed
+import numpy as np
+from PIL import Image
+
+from amsolver.backend.const import *
+from amsolver.backend.observation import Observation
+from amsolver.backend.utils import float_array_to_rgb_image
+from amsolver.demo import Demo
+from amsolver.episode_store import CAMERAS, pack_episode, get_stored_demos_packed
+from amsolver.observation_config import ObservationConfig
+from amsolver.utils import get_stored_demos
+
+from absl import app
+from absl import flags
+
+"""
+Compare frames/sec of get_stored_demos (PNG) and get_stored_demos_packed on a synthetic dataset.
+"""
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('episodes', 8, 'Number of synthetic episodes.')
+flags.DEFINE_integer('steps', 60, 'Number of frames per episode.')
+flags.DEFINE_integer('image_size', 128, 'Square image size of every camera.')
+flags.DEFINE_integer('frames_per_sample', 6, 'Frames requested by each get_stored_demos call.')
+flags.DEFINE_integer('samples', 50, 'Number of get_stored_demos calls to time.')
+
+TASK_NAME = 'synthetic_task'
+
+
+def _synthetic_observation(size):
+    fields = Observation.__init__.__code__.co_varnames[1:Observation.__init__.__code__.co_argcount]
+    obs = Observation(**{f: None for f in fields})
+    obs.gripper_open = 1.0
+    obs.gripper_pose = np.random.rand(7)
+    obs.joint_velocities = np.random.rand(7)
+    obs.misc = {}
+    for cam in CAMERAS:
+        obs.misc['%s_camera_near' % cam] = 0.01
+        obs.misc['%s_camera_far' % cam] = 4.5
+        extrinsics = np.eye(4)
+        extrinsics[:3, 3] = np.random.rand(3)
+        obs.misc['%s_camera_extrinsics' % cam] = extrinsics
+        obs.misc['%s_camera_intrinsics' % cam] = np.array(
+            [[-size * 1.2, 0, size / 2], [0, -size * 1.2, size / 2], [0, 0, 1]])
+    return obs
+
+
+def make_dataset(root, episodes, steps, size):
+    examples_path = join(root, TASK_NAME, VARIATIONS_FOLDER % 0, EPISODES_FOLDER)
+    for e in range(episodes):
+        example_path = join(examples_path, EPISODE_FOLDER % e)
+        for cam in CAMERAS:
+            for modality in ['rgb', 'depth', 'mask']:
+                os.makedirs(join(example_path, '%s_%s' % (cam, modality)))
+        for i in range(steps):
+            for cam in CAMERAS:
+                Image.fromarray(np.random.randint(0, 256, (size, size, 3), dtype=np.uint8)).save(
+                    join(example_path, '%s_rgb' % cam, IMAGE_FORMAT % i))
+                float_array_to_rgb_image(np.random.rand(size, size), scale_factor=DEPTH_SCALE).save(
+                    join(example_path, '%s_depth' % cam, IMAGE_FORMAT % i))
+                Image.fromarray(np.random.randint(0, 8, (size, size, 3), dtype=np.uint8)).save(
+                    join(example_path, '%s_mask' % cam, IMAGE_FORMAT % i))
+        with open(join(example_path, LOW_DIM_PICKLE), 'wb') as f:
+            pickle.dump(Demo([_synthetic_observation(size) for _ in range(steps)]), f)
+
+
+def time_loader(loader, root, obs_config, requests):
+    start = time()
+    frames = 0
+    for episode, selected_frame in requests:
+        loader(1, False, root, 0, TASK_NAME, obs_config, episode, selected_frame=selected_frame)
+        frames += len(selected_frame)
+    return frames / (time() - start)
+
+
+def main(argv):
+    obs_config = ObservationConfig()
+    obs_config.set_all(True)
+    for cam in CAMERAS:
+        getattr(obs_config, '%s_camera' % cam).image_size = (FLAGS.image_size, FLAGS.image_size)
+
+    with tempfile.TemporaryDirectory() as root:
+        print('Writing synthetic dataset ...')
+        make_dataset(root, FLAGS.episodes, FLAGS.steps, FLAGS.image_size)
+        requests = [(EPISODE_FOLDER % np.random.randint(FLAGS.episodes),
+                     sorted(np.random.choice(FLAGS.steps, FLAGS.frames_per_sample, replace=False)))
+                    for _ in range(FLAGS.samples)]
+
+        start = time()
+        for e in range(FLAGS.episodes):
+            pack_episode(join(root, TASK_NAME, VARIATIONS_FOLDER % 0, EPISODES_FOLDER, EPISODE_FOLDER % e))
+        print('Packed %d episodes in %.2fs' % (FLAGS.episodes, time() - start))
+
+        # Both loaders must give the same observations.
+        episode, selected_frame = requests[0]
+        png = get_stored_demos(1, False, root, 0, TASK_NAME, obs_config, episode, selected_frame=selected_frame)[0]
+        packed = get_stored_demos_packed(1, False, root, 0, TASK_NAME, obs_config, episode, selected_frame=selected_frame)[0]
+        for i in selected_frame:
+            for cam in CAMERAS:
+                for attr in ['rgb', 'depth', 'mask', 'point_cloud']:
+                    name = '%s_%s' % (cam, attr)
+                    assert np.array_equal(getattr(png[i], name), getattr(packed[i], name)), name
+
+        png_fps = time_loader(get_stored_demos, root, obs_config, requests)
+        packed_fps = time_loader(get_stored_demos_packed, root, obs_config, requests)
+        print('PNG    : %.1f frames/s' % png_fps)
+        print('Packed : %.1f frames/s (x%.1f)' % (packed_fps, packed_fps / png_fps))
+
+
+if __name__ == '__main__':
+  app.run(main)
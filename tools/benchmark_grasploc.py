@@ -0,0 +1,123 @@
+from os.path import join, dirname, abspath
+from time import time
+import sys
+CURRENT_DIR = dirname(abspath(__file__))
+sys.path.insert(0, join(CURRENT_DIR, '..'))
+import numpy as np
+import open3d as o3d
+
+from tools.grasploc import Grasploc, GraspPoint, define_default_args
+
+from absl import app
+from absl import flags
+
+"""
+Checks the batched grasp search of Grasploc.find_grasp1 against the
+per-candidate loop it replaced, on a mesh file or a box, and times both.
+Both searches run on the same point cloud, so the grasp poses must match.
+"""
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('input_file', None, 'Mesh to search, a box otherwise.')
+flags.DEFINE_list('box', ['0.04', '0.06', '0.1'], 'Size of the box.')
+flags.DEFINE_integer('points', 20000, 'Points sampled on the mesh.')
+flags.DEFINE_float('voxel_size', 0.001, 'Voxel size of the point cloud.')
+flags.DEFINE_float('grasp_voxel_size', 0.01, 'Voxel size of the grasp samples.')
+flags.DEFINE_integer('seed', 0, 'Seed of the mesh sampling.')
+
+
+def reference_find_grasp1(self):
+    """Grasploc.find_grasp1 before the batched candidate search, without its prints."""
+    self.pcd.estimate_normals()
+    pcd_tree = o3d.geometry.KDTreeFlann(self.pcd)
+    ft, fd, fw, fl = self.args.finger_thickness, self.args.finger_max_distance, self.args.finger_width, self.args.finger_length
+    self.downpcd = self.pcd.voxel_down_sample(voxel_size=self.args.grasp_sample_voxel_size)
+    while len(self.downpcd.points) > 2000:
+        self.args.grasp_sample_voxel_size = self.args.grasp_sample_voxel_size*1.2
+        self.downpcd = self.pcd.voxel_down_sample(voxel_size=self.args.grasp_sample_voxel_size)
+    min_num_points_in_grasp = (fd*fl + fl*ft + fd*ft) / self.args.pcd_sample_voxel_size**2 * self.args.min_num_points_between_proportion
+    min_num_points_in_grasp *= self.crop_factor / 2
+    while len(self.grasp_points) <= 10:
+        for i, (pt, nm) in enumerate(zip(self.downpcd.points, self.downpcd.normals)):
+            for normal in [nm, -nm]:
+                normal = normal / np.linalg.norm(normal)
+                finger_percents = [0.1, 0.2, 0.4, 0.5]
+                for f_p in finger_percents:
+                    centroid = pt + fl*f_p * normal
+                    tmp = np.array([1, 0, 0])
+                    principal = tmp - np.dot(tmp, normal) * normal
+                    principal = principal / np.linalg.norm(principal)
+                    theta = np.pi * 2 / self.args.rotation_sample
+                    principals = [np.cos(i*theta) * principal + np.sin(i*theta) * np.cross(principal, normal) for i in range(self.args.rotation_sample)]
+                    principals = [p / np.linalg.norm(p) for p in principals]
+                    radius = np.sqrt(ft**2 + (fd + 2*fw)**2 + fl**2) / 2
+                    _, idx, _ = pcd_tree.search_radius_vector_3d(centroid, radius=radius)
+                    pt_offset = np.asarray(self.pcd.points)[idx[1:], :] - centroid
+                    for principal in principals:
+                        cross = np.cross(normal, principal)
+                        between_conditions = [np.abs(pt_offset @ normal) < fl / 2, np.abs(pt_offset @ principal) < ft / 2, np.abs(pt_offset @ cross) < fd / 2]
+                        around_conditions = [pt_offset @ normal < fl / 2, pt_offset @ normal > -fl / 2 - fw, np.abs(pt_offset @ principal) < ft / 2, np.abs(pt_offset @ cross) < fd / 2 + fw]
+                        n_between = np.sum(np.bitwise_and.reduce(between_conditions))
+                        n_around = np.sum(np.bitwise_and.reduce(around_conditions)) - n_between
+                        if n_between > min_num_points_in_grasp and n_around < self.args.max_num_points_intefering:
+                            self.grasp_points.append(GraspPoint(centroid, normal, principal, fd, None, None, [ft, fd, fl]))
+        if len(self.grasp_points) <= 10:
+            min_num_points_in_grasp = min_num_points_in_grasp*0.5
+
+
+def poses(grasp_points):
+    """se3_output of Grasploc.save_result without an origin offset."""
+    out = np.tile(np.identity(4), (len(grasp_points), 1, 1))
+    for pose, grasp in zip(out, grasp_points):
+        pose[:3, 3] = grasp.centroid
+        pose[:3, 0] = grasp.principal
+        pose[:3, 2] = grasp.normal
+        pose[:3, 1] = np.cross(grasp.normal, grasp.principal)
+    return out
+
+
+def point_cloud():
+    if FLAGS.input_file is not None:
+        mesh = o3d.io.read_triangle_mesh(FLAGS.input_file)
+    else:
+        mesh = o3d.geometry.TriangleMesh.create_box(*map(float, FLAGS.box))
+    o3d.utility.random.seed(FLAGS.seed)
+    return mesh.sample_points_poisson_disk(number_of_points=FLAGS.points).voxel_down_sample(voxel_size=FLAGS.voxel_size)
+
+
+def searcher(pcd):
+    args = define_default_args([])
+    args.pcd_sample_voxel_size = FLAGS.voxel_size
+    args.grasp_sample_voxel_size = FLAGS.grasp_voxel_size
+    gl = Grasploc(args)
+    gl.pcd = o3d.geometry.PointCloud(pcd)
+    gl.crop_factor = 1.0
+    return gl
+
+
+def main(argv):
+    pcd = point_cloud()
+
+    ref = searcher(pcd)
+    start = time()
+    reference_find_grasp1(ref)
+    t_ref = time() - start
+
+    new = searcher(pcd)
+    start = time()
+    new.find_grasp1()
+    t_new = time() - start
+
+    ref_poses, new_poses = poses(ref.grasp_points), poses(new.grasp_points)
+    print('%d points, %d grasp samples' % (len(pcd.points), len(new.downpcd.points)))
+    print('grasps: loop %d, batched %d' % (len(ref_poses), len(new_poses)))
+    assert ref_poses.shape == new_poses.shape
+    print('max abs diff of the poses: %.2e' % np.abs(ref_poses - new_poses).max(initial=0))
+    assert np.allclose(ref_poses, new_poses)
+    print('candidate loop : %.2f s' % t_ref)
+    print('batched search : %.2f s (x%.1f)' % (t_new, t_ref / max(t_new, 1e-9)))
+
+
+if __name__ == '__main__':
+  app.run(main)
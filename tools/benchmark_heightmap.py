@@ -0,0 +1,97 @@
+from os.path import join, dirname, abspath
+from time import time
+import sys
+CURRENT_DIR = dirname(abspath(__file__))
+sys.path.insert(0, join(CURRENT_DIR, '..'))
+import numpy as np
+import torch
+
+from cliport.utils.utils import get_heightmap, fuse_heightmaps
+
+from absl import app
+from absl import flags
+
+"""
+Micro-benchmark of the fused heightmap: per-view get_heightmap + fusion loop
+against the single-pass scatter-max fuse_heightmaps (numpy and torch backends).
+"""
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('image_size', 360, 'Square image size of every camera.')
+flags.DEFINE_integer('views', 5, 'Number of cameras.')
+flags.DEFINE_integer('batch', 8, 'Frames fused per batched call.')
+flags.DEFINE_integer('repeats', 10, 'Timed repetitions.')
+
+BOUNDS = np.array([[-0.05, 0.67], [-0.45, 0.45], [0.7, 1.2]])
+PIXEL_SIZE = 5.625e-3
+
+
+def reference_fused_heightmap(colors, points, bounds, pix_size):
+    """The per-view loop get_fused_heightmap used before fuse_heightmaps."""
+    heightmaps, colormaps = [], []
+    for p, i in zip(points, colors):
+        h, c_map = get_heightmap(p, i, bounds, pix_size)
+        heightmaps.append(h)
+        colormaps.append(c_map)
+    colormaps = np.float32(colormaps)
+    heightmaps = np.float32(heightmaps)
+    valid = np.sum(colormaps, axis=3) > 0
+    repeat = np.sum(valid, axis=0)
+    repeat[repeat == 0] = 1
+    cmap = np.sum(colormaps, axis=0) / repeat[Ellipsis, None]
+    cmap = np.uint8(np.round(cmap))
+    hmap = np.max(heightmaps, axis=0)
+    return cmap, hmap
+
+
+def synthetic_frame(views, size):
+    """Points of a table-top scene seen from several cameras, some out of bounds."""
+    low = BOUNDS[:, 0] - 0.1
+    high = BOUNDS[:, 1] + 0.1
+    points = np.random.uniform(low, high, size=(views, size, size, 3))
+    colors = np.random.randint(0, 256, size=(views, size, size, 3), dtype=np.uint8)
+    return colors, points
+
+
+def timeit(fn, repeats):
+    fn()
+    start = time()
+    for _ in range(repeats):
+        fn()
+    return (time() - start) / repeats
+
+
+def main(argv):
+    frames = [synthetic_frame(FLAGS.views, FLAGS.image_size) for _ in range(FLAGS.batch)]
+    colors = np.stack([c for c, _ in frames])
+    points = np.stack([p for _, p in frames])
+
+    # All paths must match the reference exactly.
+    for c, p in frames:
+        ref_cmap, ref_hmap = reference_fused_heightmap(list(c), list(p), BOUNDS, PIXEL_SIZE)
+        cmap, hmap = fuse_heightmaps(c, p, BOUNDS, PIXEL_SIZE)
+        assert np.array_equal(ref_cmap, cmap) and np.array_equal(ref_hmap, hmap)
+        cmap, hmap = fuse_heightmaps(torch.from_numpy(c), torch.from_numpy(p), BOUNDS, PIXEL_SIZE, backend='torch')
+        assert np.array_equal(ref_cmap, cmap.numpy()) and np.array_equal(ref_hmap, hmap.numpy())
+    ref = [reference_fused_heightmap(list(c), list(p), BOUNDS, PIXEL_SIZE) for c, p in frames]
+    cmaps, hmaps = fuse_heightmaps(colors, points, BOUNDS, PIXEL_SIZE)
+    assert np.array_equal(np.stack([c for c, _ in ref]), cmaps)
+    assert np.array_equal(np.stack([h for _, h in ref]), hmaps)
+
+    c, p = frames[0]
+    t_ref = timeit(lambda: reference_fused_heightmap(list(c), list(p), BOUNDS, PIXEL_SIZE), FLAGS.repeats)
+    t_np = timeit(lambda: fuse_heightmaps(c, p, BOUNDS, PIXEL_SIZE), FLAGS.repeats)
+    tc, tp = torch.from_numpy(c), torch.from_numpy(p)
+    t_torch = timeit(lambda: fuse_heightmaps(tc, tp, BOUNDS, PIXEL_SIZE, backend='torch'), FLAGS.repeats)
+    t_batch = timeit(lambda: fuse_heightmaps(colors, points, BOUNDS, PIXEL_SIZE), FLAGS.repeats) / FLAGS.batch
+
+    print('%d views of %dx%d, per frame:' % (FLAGS.views, FLAGS.image_size, FLAGS.image_size))
+    print('get_heightmap loop     : %.2f ms' % (t_ref * 1e3))
+    print('fuse_heightmaps numpy  : %.2f ms (x%.1f)' % (t_np * 1e3, t_ref / t_np))
+    print('fuse_heightmaps torch  : %.2f ms (x%.1f)' % (t_torch * 1e3, t_ref / t_torch))
+    print('fuse_heightmaps batch %d: %.2f ms (x%.1f)' % (FLAGS.batch, t_batch * 1e3, t_ref / t_batch))
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,97 @@
+from os.path import join, dirname, abspath
+from time import time
+import os
+import sys
+import tempfile
+CURRENT_DIR = dirname(abspath(__file__))
+sys.path.insert(0, join(CURRENT_DIR, '..'))
+from pathlib import Path
+import numpy as np
+
+from amsolver.backend.const import LOW_DIM_PICKLE
+from cliport.utils.utils import fuse_heightmaps
+from vlm.scripts.heightmap_cache import HeightmapCache
+
+from absl import app
+from absl import flags
+
+"""
+Compares the fused maps VLM_dataset.__getitem__ computes for every sample
+(fuse_heightmaps of the 5 cameras of the waypoint frames) with reading them
+back from HeightmapCache, on a synthetic episode. Checks the cached maps are
+the ones fused (colors exact, heights in float16) and that touching a source
+of the episode invalidates them, and that a failed write only skips caching.
+"""
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('image_size', 128, 'Square image size of every camera.')
+flags.DEFINE_integer('frames', 8, 'Waypoint frames of a sample.')
+flags.DEFINE_integer('repeats', 5, 'Timed repetitions.')
+
+CAMERAS = ['front', 'wrist', 'left_shoulder', 'right_shoulder', 'overhead']
+BOUNDS = np.array([[-0.05, 0.67], [-0.45, 0.45], [0.7, 1.2]])
+PIXEL_SIZE = 5.625e-3
+
+
+def fuse(colors, points):
+    """VLM_dataset.fuse_maps on the stacked cameras of the frames, quantized as on a cache miss."""
+    return HeightmapCache.quantize(*fuse_heightmaps(colors, points, BOUNDS, PIXEL_SIZE))
+
+
+def timeit(fn, repeats):
+    fn()
+    start = time()
+    for _ in range(repeats):
+        fn()
+    return (time() - start) / repeats
+
+
+def main(argv):
+    size, frames = FLAGS.image_size, FLAGS.frames
+    rng = np.random.RandomState(0)
+    low, high = BOUNDS[:, 0] - 0.1, BOUNDS[:, 1] + 0.1
+    points = rng.uniform(low, high, (frames, len(CAMERAS), size, size, 3))
+    colors = rng.randint(0, 256, (frames, len(CAMERAS), size, size, 3)).astype(np.uint8)
+    inds = np.arange(0, 4 * frames, 4)
+    cache = HeightmapCache(CAMERAS, [size, size])
+
+    with tempfile.TemporaryDirectory() as episode:
+        episode = Path(episode)
+        (episode / LOW_DIM_PICKLE).write_bytes(b'low dim')
+        cmaps, hmaps = fuse(colors, points)
+        assert cache.load(episode, inds, BOUNDS, PIXEL_SIZE) is None
+        assert cache.save(episode, inds, BOUNDS, PIXEL_SIZE, cmaps, hmaps)
+
+        cached = cache.load(episode, inds, BOUNDS, PIXEL_SIZE)
+        assert np.array_equal(cached[0], cmaps) and np.array_equal(cached[1], hmaps)
+        subset = cache.load(episode, inds[1::2], BOUNDS, PIXEL_SIZE)
+        assert np.array_equal(subset[1], hmaps[1::2])
+        assert cache.load(episode, inds + 1, BOUNDS, PIXEL_SIZE) is None
+        assert cache.load(episode, inds, BOUNDS, PIXEL_SIZE * 2) is None
+        float32_hmaps = fuse_heightmaps(colors, points, BOUNDS, PIXEL_SIZE)[1]
+        max_diff = np.abs(float32_hmaps - cached[1].astype(np.float32)).max()
+
+        fuse_time = timeit(lambda: fuse(colors, points), FLAGS.repeats)
+        load_time = timeit(lambda: [np.asarray(m) for m in cache.load(episode, inds, BOUNDS, PIXEL_SIZE)],
+                           FLAGS.repeats)
+
+        stat = os.stat(episode / LOW_DIM_PICKLE)
+        os.utime(episode / LOW_DIM_PICKLE, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        assert cache.load(episode, inds, BOUNDS, PIXEL_SIZE) is None
+
+        # A pack that cannot be written is not cached, and leaves no temporary file.
+        pack = next(episode.glob('cliport_maps_*.pack'))
+        pack.unlink()
+        (pack / 'blocker').mkdir(parents=True)
+        assert not cache.save(episode, inds, BOUNDS, PIXEL_SIZE, cmaps, hmaps)
+        assert not list(episode.glob('*.tmp'))
+
+    print('%d frames x %d cameras of %dx%d, float16 heights max abs diff %.1e m' % (
+        frames, len(CAMERAS), size, size, max_diff))
+    print('fuse_heightmaps : %.1f ms / sample' % (fuse_time * 1e3))
+    print('HeightmapCache  : %.1f ms / sample (x%.0f)' % (load_time * 1e3, fuse_time / load_time))
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,119 @@
+from os.path import join, dirname, abspath
+from pathlib import Path
+from time import time
+import sys
+CURRENT_DIR = dirname(abspath(__file__))
+sys.path.insert(0, join(CURRENT_DIR, '..'))
+import torch
+
+from hiverformer.network import Hiveformer
+
+from absl import app
+from absl import flags
+
+"""
+Replays episodes through Hiveformer on CPU the way the closed-loop
+evaluation runs them: one prediction per new frame. Compares the old loop,
+which concatenates the frames and runs forward over the whole history at
+every step, with Hiveformer.step, checks that they predict the same actions
+and reports the time per episode.
+
+Episodes are read from the hiveformer samples of a split (see
+vlm/scripts/sample_store.py) when --data_dir is given, random frames
+otherwise. Instruction features are random in both cases.
+"""
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('data_dir', None, 'Split with a hiveformer sample manifest.')
+flags.DEFINE_list('cameras', ['left_shoulder', 'right_shoulder', 'wrist'], 'Cameras of the samples.')
+flags.DEFINE_string('mode', 'waypoint', 'Frame selection mode of the samples.')
+flags.DEFINE_integer('img_size', 128, 'Image size of the samples.')
+flags.DEFINE_integer('episodes', 4, 'Episodes replayed.')
+flags.DEFINE_integer('steps', 10, 'Frames per random episode.')
+flags.DEFINE_string('checkpoint', None, 'Hiveformer weights, random ones otherwise.')
+flags.DEFINE_integer('max_episode_length', 10, 'Step embeddings of the model.')
+
+
+def random_episodes(n, steps, num_cams=3, size=128):
+    for _ in range(n):
+        rgbs = torch.rand(steps, num_cams, 4, size, size) * 2 - 1
+        pcds = torch.randn(steps, num_cams, 3, size, size)
+        grippers = torch.rand(steps, 8)
+        yield rgbs, pcds, grippers
+
+
+def stored_episodes(n):
+    from vlm.scripts.sample_store import SampleStore, finish_sample
+    store = SampleStore(Path(FLAGS.data_dir), FLAGS.cameras, FLAGS.mode, [FLAGS.img_size] * 2)
+    for episode in sorted(store.episodes)[:n]:
+        sample = finish_sample(*store.load(episode), FLAGS.max_episode_length)
+        T = sample['valid_length']
+        yield sample['rgbs'][:T], sample['pcds'][:T].float(), sample['gripper'][:T].float()
+
+
+def full_history(model, rgbs, pcds, grippers, instruction):
+    """hiveformerAgent.act before Hiveformer.step: forward over every frame so far."""
+    actions = []
+    for t in range(1, len(rgbs) + 1):
+        padding_mask = torch.ones(1, t, dtype=torch.bool)
+        pred = model(rgbs[None, :t], pcds[None, :t], padding_mask, instruction, grippers[None, :t])
+        actions.append(model.compute_action(pred)[-1])
+    return torch.stack(actions)
+
+
+def incremental(model, rgbs, pcds, grippers, instruction):
+    model.reset_history()
+    actions = []
+    for t in range(len(rgbs)):
+        pred = model.step(rgbs[t:t + 1], pcds[t:t + 1], instruction, grippers[t:t + 1])
+        actions.append(model.compute_action(pred)[-1])
+    return torch.stack(actions)
+
+
+def main(argv):
+    torch.manual_seed(0)
+    model = Hiveformer(
+        depth=4,
+        dim_feedforward=64,
+        hidden_dim=64,
+        instr_size=512,
+        mask_obs_prob=0.0,
+        max_episode_length=FLAGS.max_episode_length,
+        num_words=75,
+        num_layers=1,
+        num_tasks=24,
+    )
+    if FLAGS.checkpoint is not None:
+        model.load_state_dict(torch.load(FLAGS.checkpoint, map_location='cpu')['weight'])
+    model.eval()  # Dropout would differ between the two passes.
+
+    if FLAGS.data_dir is not None:
+        episodes = stored_episodes(FLAGS.episodes)
+    else:
+        episodes = random_episodes(FLAGS.episodes, FLAGS.steps)
+
+    t_full, t_step, n, worst = 0., 0., 0, 0.
+    with torch.no_grad():
+        for rgbs, pcds, grippers in episodes:
+            instruction = torch.randn(1, 75, 512)
+            start = time()
+            ref = full_history(model, rgbs, pcds, grippers, instruction)
+            t_full += time() - start
+            start = time()
+            new = incremental(model, rgbs, pcds, grippers, instruction)
+            t_step += time() - start
+            diff = (ref - new).abs().max().item()
+            assert torch.allclose(ref, new, atol=1e-4), diff
+            worst = max(worst, diff)
+            n += 1
+            print('episode %d: %d frames, max abs diff %.2e' % (n, len(rgbs), diff))
+
+    n = max(n, 1)
+    print('full history    : %.1f ms / episode' % (t_full / n * 1e3))
+    print('Hiveformer.step : %.1f ms / episode (x%.1f)' % (t_step / n * 1e3, t_full / max(t_step, 1e-9)))
+    print('max abs diff    : %.2e' % worst)
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,101 @@
+from os.path import join, dirname, abspath
+from pathlib import Path
+from time import time
+import pickle
+import sys
+CURRENT_DIR = dirname(abspath(__file__))
+sys.path.insert(0, join(CURRENT_DIR, '..'))
+import numpy as np
+
+from amsolver.backend.const import LOW_DIM_PICKLE
+from amsolver.keypoints import keypoint_discovery, low_dim_arrays, keypoints_from_arrays
+
+from absl import app
+from absl import flags
+
+"""
+Checks the array keypoint discovery against the per-observation loop it
+replaced on every stored demo of a data folder, and times both.
+"""
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('data_dir', None, 'Folder searched for low_dim_obs.pkl files.')
+flags.DEFINE_integer('max_episodes', 0, 'Stop after this many episodes (0: all of them).')
+flags.mark_flag_as_required('data_dir')
+
+
+def _is_stopped(demo, i, obs, stopped_buffer):
+    next_is_not_final = i == (len(demo) - 2)
+    gripper_state_no_change = i < (len(demo) - 2) and (
+        obs.gripper_open == demo[i + 1].gripper_open
+        and obs.gripper_open == demo[i - 1].gripper_open
+        and demo[i - 2].gripper_open == demo[i - 1].gripper_open
+    )
+    small_delta = np.allclose(obs.joint_velocities, 0, atol=0.1)
+    stopped = (
+        stopped_buffer <= 0
+        and small_delta
+        and (not next_is_not_final)
+        and gripper_state_no_change
+    )
+    return stopped
+
+
+def reference_keypoint_discovery(demo):
+    """The loop of hiverformer/utils.py and vlm/scripts/utils.py before amsolver.keypoints."""
+    episode_keypoints = []
+    prev_gripper_open = demo[0].gripper_open
+    stopped_buffer = 0
+    for i, obs in enumerate(demo):
+        stopped = _is_stopped(demo, i, obs, stopped_buffer)
+        stopped_buffer = 4 if stopped else stopped_buffer - 1
+        last = i == (len(demo) - 1)
+        if i != 0 and (obs.gripper_open != prev_gripper_open or last or stopped):
+            episode_keypoints.append(i)
+        prev_gripper_open = obs.gripper_open
+    if (
+        len(episode_keypoints) > 1
+        and (episode_keypoints[-1] - 1) == episode_keypoints[-2]
+    ):
+        episode_keypoints.pop(-2)
+    return episode_keypoints
+
+
+def main(argv):
+    paths = sorted(Path(FLAGS.data_dir).rglob(LOW_DIM_PICKLE))
+    if FLAGS.max_episodes:
+        paths = paths[:FLAGS.max_episodes]
+
+    t_ref, t_new, t_arrays, mismatches = 0., 0., 0., 0
+    for path in paths:
+        with open(path, 'rb') as f:
+            demo = pickle.load(f)
+        observations = demo._observations
+
+        start = time()
+        ref = reference_keypoint_discovery(observations)
+        t_ref += time() - start
+        start = time()
+        new = keypoint_discovery(observations)
+        t_new += time() - start
+        arrays = low_dim_arrays(observations)
+        start = time()
+        keypoints_from_arrays(*arrays)
+        t_arrays += time() - start
+
+        if ref != new:
+            mismatches += 1
+            print('%s: %s != %s' % (path.parent, ref, new))
+
+    n = max(len(paths), 1)
+    print('%d episodes, %d mismatches' % (len(paths), mismatches))
+    print('observation loop      : %.3f ms / episode' % (t_ref / n * 1e3))
+    print('keypoint_discovery    : %.3f ms / episode (x%.1f)' % (t_new / n * 1e3, t_ref / max(t_new, 1e-9)))
+    print('keypoints_from_arrays : %.3f ms / episode (x%.1f)' % (t_arrays / n * 1e3, t_ref / max(t_arrays, 1e-9)))
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+  app.run(main)
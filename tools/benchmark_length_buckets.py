@@ -0,0 +1,151 @@
+from os.path import join, dirname, abspath
+from time import time
+import sys
+CURRENT_DIR = dirname(abspath(__file__))
+sys.path.insert(0, join(CURRENT_DIR, '..'))
+import numpy as np
+import torch
+from torch import nn
+from torch.utils.data import BatchSampler, RandomSampler
+
+from hiverformer.length_sampler import LengthBucketBatchSampler, trim_padding_collate
+
+from absl import app
+from absl import flags
+
+"""
+Draws the valid lengths of a synthetic VLMbench split (mostly 3 to 8 key
+frames, a few up to 12, padded to maxAction) and compares three ways of
+batching it for train_hiverformer: random batches padded to maxAction as
+before, random batches cut by trim_padding_collate, and
+LengthBucketBatchSampler batches cut the same way. Reports the share of
+padded frames over an epoch and the episodes per second of a forward and
+backward of a stand-in of the Hiveformer conv encoder, which runs on every
+frame. Also checks the sampler gives every rank the same number of
+disjoint batches, the same ones for the same epoch, and that trimming only
+drops padded frames.
+"""
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('episodes', 4000, 'Episodes of the synthetic split.')
+flags.DEFINE_integer('max_action', 20, 'maxAction, the padded length.')
+flags.DEFINE_integer('batch_size', 16, 'Episodes per batch and rank.')
+flags.DEFINE_integer('replicas', 4, 'Ranks the sampler is checked for.')
+flags.DEFINE_integer('steps', 10, 'Batches timed per batching.')
+flags.DEFINE_integer('img_size', 64, 'Size of the stand-in images.')
+flags.DEFINE_string('device', 'cuda' if torch.cuda.is_available() else 'cpu', 'Device of the stand-in encoder.')
+
+
+def synthetic_lengths(n, max_action):
+    rng = np.random.RandomState(0)
+    values = np.arange(3, 13)
+    p = np.array([15, 25, 20, 15, 10, 8, 3, 2, 1, 1], dtype=np.float64)
+    return np.minimum(rng.choice(values, n, p=p / p.sum()), max_action)
+
+
+def padded_share(batches, lengths, padded_to=None):
+    """Padded frames / frames of `batches`, each padded to `padded_to` or to its longest sample."""
+    frames = valid = 0
+    for batch in batches:
+        batch_lengths = lengths[np.asarray(batch)]
+        frames += len(batch) * (padded_to or batch_lengths.max())
+        valid += batch_lengths.sum()
+    return 1. - valid / frames
+
+
+class StandInEncoder(nn.Module):
+    """The to_feat and feature_encoder convolutions of Hiveformer."""
+
+    def __init__(self):
+        super().__init__()
+        layers = [nn.Conv2d(4, 16, 1), nn.ReLU()]
+        for _ in range(4):
+            layers += [nn.Conv2d(16, 16, 3, stride=2, padding=1), nn.GroupNorm(1, 16), nn.LeakyReLU()]
+        self.net = nn.Sequential(*layers)
+
+    def forward(self, rgbs, padding_mask):
+        b, t, n = rgbs.shape[:3]
+        x = self.net(rgbs.flatten(0, 2)).view(b, t, n, -1)
+        return x[padding_mask].mean()
+
+
+def check_sampler(lengths):
+    samplers = [LengthBucketBatchSampler(lengths, FLAGS.batch_size, FLAGS.replicas, rank, seed=2)
+                for rank in range(FLAGS.replicas)]
+    for epoch in (0, 1):
+        for sampler in samplers:
+            sampler.set_epoch(epoch)
+        batches = [list(sampler) for sampler in samplers]
+        assert len(set(len(b) for b in batches)) == 1 and len(batches[0]) == len(samplers[0])
+        indices = [i for rank_batches in batches for batch in rank_batches for i in batch]
+        assert len(indices) == len(set(indices))
+        assert batches == [list(sampler) for sampler in samplers]
+    samplers[0].set_epoch(0)
+    first = list(samplers[0])
+    samplers[0].set_epoch(1)
+    assert first != list(samplers[0])
+    uneven = LengthBucketBatchSampler(lengths[:-3], FLAGS.batch_size, FLAGS.replicas, 0, drop_last=False)
+    assert all(len(b) == FLAGS.batch_size for b in uneven)
+
+
+def check_trim():
+    samples = []
+    for length in (3, 5, 4):
+        pad = FLAGS.max_action - length
+        samples.append({
+            'rgbs': torch.cat([torch.rand(length, 3, 4, 8, 8), torch.zeros(pad, 3, 4, 8, 8)]),
+            'action': torch.cat([torch.rand(length, 8), torch.zeros(pad, 8)]),
+            'padding_mask': torch.tensor([True] * length + [False] * pad),
+            'language': 'pick up the red cube', 'valid_length': length, 'task': 'pick_cube_color'})
+    full = torch.utils.data._utils.collate.default_collate(samples)
+    trimmed = trim_padding_collate(samples)
+    assert trimmed['rgbs'].shape[1] == trimmed['padding_mask'].shape[1] == 5
+    assert torch.equal(full['rgbs'][full['padding_mask']], trimmed['rgbs'][trimmed['padding_mask']])
+    assert torch.equal(full['action'][:, 5:], torch.zeros_like(full['action'][:, 5:]))
+
+
+def throughput(encoder, batches, lengths, padded_to, device):
+    n = 0
+    start = time()
+    for batch in batches[:FLAGS.steps]:
+        batch_lengths = torch.as_tensor(lengths[np.asarray(batch)])
+        t = padded_to or int(batch_lengths.max())
+        rgbs = torch.rand(len(batch), t, 3, 4, FLAGS.img_size, FLAGS.img_size, device=device)
+        padding_mask = (torch.arange(t)[None] < batch_lengths[:, None]).to(device)
+        encoder.zero_grad()
+        encoder(rgbs, padding_mask).backward()
+        n += len(batch)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return n / (time() - start)
+
+
+def main(argv):
+    lengths = synthetic_lengths(FLAGS.episodes, FLAGS.max_action)
+    check_sampler(lengths)
+    check_trim()
+
+    random_batches = list(BatchSampler(RandomSampler(range(len(lengths)), generator=torch.Generator().manual_seed(0)),
+                                       FLAGS.batch_size, drop_last=True))
+    bucket_batches = list(LengthBucketBatchSampler(lengths, FLAGS.batch_size, 1, 0))
+    device = torch.device(FLAGS.device)
+    torch.manual_seed(0)
+    encoder = StandInEncoder().to(device)
+    throughput(encoder, random_batches[:1], lengths, None, device)  # warm up
+
+    print('%d episodes, mean length %.2f, padded to %d, batches of %d' % (
+        len(lengths), lengths.mean(), FLAGS.max_action, FLAGS.batch_size))
+    runs = (('random, padded to maxAction ', random_batches, FLAGS.max_action),
+            ('random, trim_padding_collate', random_batches, None),
+            ('LengthBucketBatchSampler    ', bucket_batches, None))
+    base = None
+    for label, batches, padded_to in runs:
+        rate = throughput(encoder, batches, lengths, padded_to, device)
+        base = base or rate
+        print('%s : %4.1f%% padded frames, %6.1f episodes/s (x%.2f)' % (
+            label, 100 * padded_share(batches, lengths, padded_to), rate, rate / base))
+
+
+if __name__ == '__main__':
+  app.run(main)
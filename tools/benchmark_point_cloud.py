@@ -0,0 +1,133 @@
+from os.path import join, dirname, abspath
+from time import time
+import sys
+CURRENT_DIR = dirname(abspath(__file__))
+sys.path.insert(0, join(CURRENT_DIR, '..'))
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+from amsolver.point_cloud import pointcloud_from_depth_and_camera_params
+
+from absl import app
+from absl import flags
+
+"""
+Checks amsolver.point_cloud against the per-frame reconstruction of PyRep
+(VisionSensor.pointcloud_from_depth_and_camera_params, copied below) on the
+5 cameras of VLMbench, the wrist one moving every frame, and times both.
+"""
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('frames', 40, 'Frames of the episode.')
+flags.DEFINE_integer('image_size', 128, 'Image size.')
+flags.DEFINE_integer('repeats', 3, 'Timed repetitions.')
+
+CAMERAS = ['left_shoulder', 'right_shoulder', 'overhead', 'wrist', 'front']
+
+
+def _create_uniform_pixel_coords_image(resolution):
+    pixel_x_coords = np.reshape(
+        np.tile(np.arange(resolution[1]), [resolution[0]]),
+        (resolution[0], resolution[1], 1)).astype(np.float32)
+    pixel_y_coords = np.reshape(
+        np.tile(np.arange(resolution[0]), [resolution[1]]),
+        (resolution[1], resolution[0], 1)).astype(np.float32)
+    pixel_y_coords = np.transpose(pixel_y_coords, (1, 0, 2))
+    uniform_pixel_coords = np.concatenate(
+        (pixel_x_coords, pixel_y_coords, np.ones_like(pixel_x_coords)), -1)
+    return uniform_pixel_coords
+
+
+def _transform(coords, trans):
+    h, w = coords.shape[:2]
+    coords = np.reshape(coords, (h * w, -1))
+    coords = np.transpose(coords, (1, 0))
+    transformed_coords_vector = np.matmul(trans, coords)
+    transformed_coords_vector = np.transpose(transformed_coords_vector, (1, 0))
+    return np.reshape(transformed_coords_vector, (h, w, -1))
+
+
+def _pixel_to_world_coords(pixel_coords, cam_proj_mat_inv):
+    h, w = pixel_coords.shape[:2]
+    pixel_coords = np.concatenate([pixel_coords, np.ones((h, w, 1))], -1)
+    world_coords = _transform(pixel_coords, cam_proj_mat_inv)
+    world_coords_homo = np.concatenate([world_coords, np.ones((h, w, 1))], axis=-1)
+    return world_coords_homo
+
+
+def reference_pointcloud(depth, extrinsics, intrinsics):
+    """VisionSensor.pointcloud_from_depth_and_camera_params of PyRep."""
+    upc = _create_uniform_pixel_coords_image(depth.shape)
+    pc = upc * np.expand_dims(depth, -1)
+    C = np.expand_dims(extrinsics[:3, 3], 0).T
+    R = extrinsics[:3, :3]
+    R_inv = R.T
+    R_inv_C = np.matmul(R_inv, C)
+    extrinsics = np.concatenate((R_inv, -R_inv_C), -1)
+    cam_proj_mat = np.matmul(intrinsics, extrinsics)
+    cam_proj_mat_homo = np.concatenate([cam_proj_mat, [np.array([0, 0, 0, 1])]])
+    cam_proj_mat_inv = np.linalg.inv(cam_proj_mat_homo)[0:3]
+    world_coords_homo = np.expand_dims(_pixel_to_world_coords(pc, cam_proj_mat_inv), 0)
+    return world_coords_homo[..., :-1][0]
+
+
+def random_extrinsics(rng):
+    extrinsics = np.identity(4)
+    extrinsics[:3, :3] = Rotation.random(random_state=rng).as_matrix()
+    extrinsics[:3, 3] = rng.uniform(-1, 1, 3) + [0, 0, 1.5]
+    return extrinsics
+
+
+def main(argv):
+    rng = np.random.RandomState(0)
+    size, frames = FLAGS.image_size, FLAGS.frames
+    # Same shape as the intrinsics stored by VLMbench: negative focal lengths.
+    focal = -size / (2 * np.tan(np.deg2rad(60) / 2))
+    intrinsics = np.array([[focal, 0, size / 2], [0, focal, size / 2], [0, 0, 1]])
+    cameras = {}
+    for cam in CAMERAS:
+        if cam == 'wrist':
+            extrinsics = np.stack([random_extrinsics(rng) for _ in range(frames)])
+        else:
+            extrinsics = np.repeat(random_extrinsics(rng)[np.newaxis], frames, 0)
+        cameras[cam] = (rng.uniform(0.5, 3., (frames, size, size)), extrinsics)
+
+    max_diff = 0.
+    for cam, (depth, extrinsics) in cameras.items():
+        ref = np.stack([reference_pointcloud(d, e, intrinsics) for d, e in zip(depth, extrinsics)])
+        new = pointcloud_from_depth_and_camera_params(depth, extrinsics, intrinsics)
+        single = pointcloud_from_depth_and_camera_params(depth[0], extrinsics[0], intrinsics)
+        assert new.shape == ref.shape and np.allclose(ref, new, rtol=1e-6, atol=1e-6)
+        assert np.allclose(ref[0], single, rtol=1e-6, atol=1e-6)
+        max_diff = max(max_diff, np.abs(ref - new).max())
+
+    def run_reference():
+        for depth, extrinsics in cameras.values():
+            [reference_pointcloud(d, e, intrinsics) for d, e in zip(depth, extrinsics)]
+
+    def run_per_frame():
+        for depth, extrinsics in cameras.values():
+            [pointcloud_from_depth_and_camera_params(d, e, intrinsics) for d, e in zip(depth, extrinsics)]
+
+    def run_batched():
+        for depth, extrinsics in cameras.values():
+            pointcloud_from_depth_and_camera_params(depth, extrinsics, intrinsics)
+
+    timings = []
+    for fn in (run_reference, run_per_frame, run_batched):
+        fn()
+        start = time()
+        for _ in range(FLAGS.repeats):
+            fn()
+        timings.append((time() - start) / FLAGS.repeats / (frames * len(CAMERAS)))
+
+    print('%d frames x %d cameras of %dx%d, max abs diff %.2e m' % (
+        frames, len(CAMERAS), size, size, max_diff))
+    print('PyRep        : %.3f ms / image' % (timings[0] * 1e3))
+    print('cached rays  : %.3f ms / image (x%.1f)' % (timings[1] * 1e3, timings[0] / timings[1]))
+    print('batched      : %.3f ms / image (x%.1f)' % (timings[2] * 1e3, timings[0] / timings[2]))
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,88 @@
+from os.path import join, dirname, abspath
+from time import time
+import sys
+CURRENT_DIR = dirname(abspath(__file__))
+sys.path.insert(0, join(CURRENT_DIR, '..'))
+import numpy as np
+import torch
+import kornia
+
+from cliport.utils.utils import ImageRotator
+
+from absl import app
+from absl import flags
+
+"""
+Micro-benchmark of ImageRotator on CPU: the per-rotation kornia.warp_affine
+loop against the batched, grid-cached rotator, as called by Attention
+(rotate the input, un-rotate the logits).
+"""
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('n_rotations', 36, 'Number of rotations.')
+flags.DEFINE_integer('batch', 2, 'Batch size.')
+flags.DEFINE_integer('channels', 6, 'Channels of the rotated input.')
+flags.DEFINE_integer('image_size', 320, 'Square (padded) image size.')
+flags.DEFINE_integer('repeats', 5, 'Timed repetitions.')
+
+
+def reference_rotate(angles, x_list, pivot, reverse=False):
+    """The kornia loop ImageRotator used before batching, with kornia's default align_corners."""
+    rot_x_list = []
+    for i, angle in enumerate(angles):
+        x = x_list[:, i]
+        b, _, h, w = x.shape
+        alpha = angle if not reverse else (-1.0 * angle)
+        angle = torch.ones(b) * alpha
+        center = torch.from_numpy(pivot).to(dtype=torch.float)
+        scale = torch.ones(b, 2)
+        M = kornia.get_rotation_matrix2d(center, angle, scale)
+        rot_x_list.append(kornia.warp_affine(x.float(), M.to(x.device), dsize=(h, w)))
+    return rot_x_list
+
+
+def timeit(fn, repeats):
+    fn()
+    start = time()
+    for _ in range(repeats):
+        fn()
+    return (time() - start) / repeats
+
+
+def main(argv):
+    torch.set_grad_enabled(False)
+    rotator = ImageRotator(FLAGS.n_rotations)
+    size = FLAGS.image_size
+    x = torch.rand(FLAGS.batch, 1, FLAGS.channels, size, size).repeat(1, FLAGS.n_rotations, 1, 1, 1)
+    logits = torch.rand(FLAGS.batch, FLAGS.n_rotations, 1, size, size)
+    pivots = [np.full((FLAGS.batch, 2), size // 2, dtype=np.float64),
+              np.random.randint(0, size, size=(FLAGS.batch, 2)).astype(np.float64)]
+
+    # Both directions and off-center pivots must match the reference.
+    for pv in pivots:
+        for reverse in (False, True):
+            ref = torch.stack(reference_rotate(rotator.angles, x, pv, reverse), 1)
+            out = torch.stack(rotator(x, pivot=pv, reverse=reverse), 1)
+            assert torch.allclose(ref, out, atol=1e-4), (ref - out).abs().max()
+
+    pv = pivots[0]
+
+    def loop():
+        reference_rotate(rotator.angles, x, pv)
+        reference_rotate(rotator.angles, logits, pv, reverse=True)
+
+    def batched():
+        rotator(x, pivot=pv)
+        rotator(logits, pivot=pv, reverse=True)
+
+    t_ref = timeit(loop, FLAGS.repeats)
+    t_batch = timeit(batched, FLAGS.repeats)
+    print('%d rotations of %dx%dx%dx%d, rotate + un-rotate:' % (
+        FLAGS.n_rotations, FLAGS.batch, FLAGS.channels, size, size))
+    print('kornia loop   : %.2f ms' % (t_ref * 1e3))
+    print('batched       : %.2f ms (x%.1f)' % (t_batch * 1e3, t_ref / t_batch))
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,81 @@
+from os.path import join, dirname, abspath
+from time import time
+import sys
+CURRENT_DIR = dirname(abspath(__file__))
+sys.path.insert(0, join(CURRENT_DIR, '..'))
+import numpy as np
+import torch
+
+import cliport.utils.utils as utils
+from cliport.models.clip_lingunet_lat import CLIPLingUNetLat
+from cliport.models.core.clip import tokenize
+from cliport.models.core.text_cache import text_cache_stats
+
+from absl import app
+from absl import flags
+
+"""
+Encodes the language goals of cliport training batches the way the
+attention, transport (key and query) and rpz streams of an agent do, once
+with the tokenize + CLIP text transformer CLIPLingUNetLat ran on every
+call, once through its text cache. Checks both give the same encodings and
+reports the time per step and the hit rate.
+"""
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('steps', 20, 'Training steps.')
+flags.DEFINE_integer('batch_size', 16, 'Samples per batch.')
+flags.DEFINE_integer('waypoints', 3, 'Waypoint steps of a sample, each with its own goal.')
+flags.DEFINE_integer('instructions', 40, 'Distinct high level instructions of the dataset.')
+flags.DEFINE_integer('calls', 5, 'encode_text calls per step (attention, transport key and query, rpz).')
+flags.DEFINE_string('device', 'cuda' if torch.cuda.is_available() else 'cpu', 'Device of the agent.')
+
+CFG = {'train': {'batchnorm': False, 'lang_fusion_type': 'mult'}}
+
+
+def reference_encode_text(stream, x):
+    """CLIPLingUNetLat.encode_text before the cache."""
+    with torch.no_grad():
+        tokens = tokenize(x).to(stream.device)
+        text_feat, text_emb = stream.clip_rn50.encode_text_with_embeddings(tokens)
+    text_mask = torch.where(tokens==0, tokens, 1)
+    return text_feat, text_emb, text_mask
+
+
+def main(argv):
+    device = torch.device(FLAGS.device)
+    stream = CLIPLingUNetLat((320, 160, 6), 1, CFG, device, utils.preprocess).to(device).eval()
+    rng = np.random.RandomState(0)
+    words = ['red', 'green', 'blue', 'cube', 'pen', 'drawer', 'left', 'right', 'big', 'small']
+    instructions = [' '.join(rng.choice(words, 6)) + '.' for _ in range(FLAGS.instructions)]
+    batches = []
+    for _ in range(FLAGS.steps):
+        goals = rng.choice(instructions, FLAGS.batch_size)
+        batches.append(['%s Step %d.' % (g, i) for g in goals for i in range(FLAGS.waypoints)])
+
+    for goal in batches[:2]:
+        for x, y in zip(reference_encode_text(stream, goal), stream.encode_text(goal)):
+            assert torch.allclose(x, y, rtol=1e-4, atol=1e-5)
+    stream.encode_text(['warm up'])
+
+    timings = []
+    for encode in (lambda l: reference_encode_text(stream, l), stream.encode_text):
+        start = time()
+        for goal in batches:
+            for _ in range(FLAGS.calls):
+                encode(goal)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        timings.append((time() - start) / FLAGS.steps)
+
+    stats = text_cache_stats()[(('clip', 'RN50'), str(device))]
+    print('%d steps of %d goals, %d calls per step on %s' % (
+        FLAGS.steps, FLAGS.batch_size * FLAGS.waypoints, FLAGS.calls, device))
+    print('encode every call : %.1f ms / step' % (timings[0] * 1e3))
+    print('text cache        : %.1f ms / step (x%.1f), hit rate %.3f, %d entries' % (
+        timings[1] * 1e3, timings[0] / timings[1], stats['hit_rate'], stats['entries']))
+
+
+if __name__ == '__main__':
+  app.run(main)
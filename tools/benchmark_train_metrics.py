@@ -0,0 +1,143 @@
+from os.path import join, dirname, abspath
+from contextlib import redirect_stdout
+from time import time
+import io
+import os
+import sys
+CURRENT_DIR = dirname(abspath(__file__))
+sys.path.insert(0, join(CURRENT_DIR, '..'))
+import torch
+from torch import nn
+
+from hiverformer.metrics import AsyncScalarWriter, DeviceMeter
+
+from absl import app
+from absl import flags
+
+"""
+Runs the same training steps of a small stand-in of Hiveformer, once with the
+loss bookkeeping train_hiverformer.training did (live loss tensors summed
+into total_loss, a progress line formatted from a tensor on every batch),
+once with hiverformer.metrics (DeviceMeter per interval and per epoch,
+AsyncScalarWriter). Checks the epoch means agree, that no autograd node is
+kept by the meters and that the memory of the process stays flat over the
+steps, and reports both memory growths and the time per step.
+"""
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('steps', 20000, 'Training steps of both runs.')
+flags.DEFINE_integer('log_every', 50, 'Steps between two reads of the interval meter.')
+flags.DEFINE_integer('batch_size', 32, 'Samples per step.')
+flags.DEFINE_float('max_growth_mb', 8., 'Memory growth over the second half of the steps allowed for the meters.')
+flags.DEFINE_string('device', 'cuda' if torch.cuda.is_available() else 'cpu', 'Device of the model.')
+
+
+class StandIn(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.encoder = nn.Sequential(nn.Linear(32, 128), nn.ReLU(), nn.Linear(128, 128), nn.ReLU())
+        self.position = nn.Linear(128, 3)
+        self.gripper = nn.Linear(128, 1)
+
+    def forward(self, x):
+        h = self.encoder(x)
+        return {'position': self.position(h), 'gripper': torch.sigmoid(self.gripper(h))}
+
+
+def losses_and_metrics(pred, position, gripper):
+    losses = {'position': nn.functional.mse_loss(pred['position'], position) * 3,
+              'gripper': nn.functional.mse_loss(pred['gripper'], gripper)}
+    losses['total'] = sum(losses.values())
+    metrics = {'position': (((pred['position'] - position) ** 2).sum(1).sqrt() < 0.5).float().mean(),
+               'gripper': ((pred['gripper'] > 0.5) == gripper.bool()).float().mean()}
+    return losses, metrics
+
+
+def memory_bytes(device):
+    if device.type == 'cuda':
+        return torch.cuda.memory_allocated(device)
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def graph_nodes(tensors):
+    """Autograd nodes reachable from `tensors`."""
+    seen, stack = set(), [t.grad_fn for t in tensors if torch.is_tensor(t) and t.grad_fn is not None]
+    while stack:
+        node = stack.pop()
+        if node is None or node in seen:
+            continue
+        seen.add(node)
+        stack.extend(n for n, _ in node.next_functions)
+    return len(seen)
+
+
+def run(meters, device):
+    torch.manual_seed(0)
+    model = StandIn().to(device)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-3)
+    x = torch.randn(FLAGS.batch_size, 32, device=device)
+    position = torch.randn(FLAGS.batch_size, 3, device=device)
+    gripper = torch.rand(FLAGS.batch_size, 1, device=device).round()
+    total_loss, total_metrics = {}, {}
+    epoch_meter, interval_meter = DeviceMeter(device), DeviceMeter(device)
+    scalar_writer = AsyncScalarWriter(None)
+    memory = []
+    start = time()
+    with redirect_stdout(io.StringIO()):
+        for step in range(FLAGS.steps):
+            optimizer.zero_grad()
+            losses, metrics = losses_and_metrics(model(x), position, gripper)
+            if meters:
+                values = {f'train-loss/{n}': l for n, l in losses.items()}
+                values.update({f'train-metrics/{n}': l for n, l in metrics.items()})
+                epoch_meter.update(values)
+                interval_meter.update({'total': losses['total']})
+            else:
+                for n, l in losses.items():
+                    total_loss.setdefault(n, 0)
+                    total_loss[n] += l
+                for n, l in metrics.items():
+                    total_metrics.setdefault(n, 0)
+                    total_metrics[n] += l
+            losses['total'].backward()
+            optimizer.step()
+            if not meters:
+                print('Batch: [{}/{}] total loss: {}'.format(step + 1, FLAGS.steps, losses['total']))
+            elif (step + 1) % FLAGS.log_every == 0:
+                print('Batch: [{}/{}] total loss: {:.5f}'.format(step + 1, FLAGS.steps, interval_meter.means()['total']))
+            if step + 1 in (FLAGS.steps // 2, FLAGS.steps):
+                memory.append(memory_bytes(device))
+    if meters:
+        means = epoch_meter.means()
+        kept = graph_nodes(epoch_meter.sums.values())
+    else:
+        means = {f'train-loss/{n}': float(l.detach()) / FLAGS.steps for n, l in total_loss.items()}
+        means.update({f'train-metrics/{n}': float(l.detach()) / FLAGS.steps for n, l in total_metrics.items()})
+        kept = graph_nodes(list(total_loss.values()) + list(total_metrics.values()))
+    scalar_writer.add_scalars(means, 1)
+    scalar_writer.close()
+    return means, kept, memory[1] - memory[0], (time() - start) / FLAGS.steps
+
+
+def main(argv):
+    device = torch.device(FLAGS.device)
+    ref_means, ref_kept, ref_growth, ref_time = run(False, device)
+    new_means, new_kept, new_growth, new_time = run(True, device)
+
+    assert ref_means.keys() == new_means.keys()
+    for name, value in ref_means.items():
+        assert abs(value - new_means[name]) <= 1e-4 * max(abs(value), 1.), (name, value, new_means[name])
+    assert new_kept == 0, new_kept
+    assert new_growth <= FLAGS.max_growth_mb * 2 ** 20, new_growth
+
+    print('%d steps on %s, memory growth over the second half of them' % (FLAGS.steps, device))
+    print('live loss tensors : %+.1f MB, %d autograd nodes kept, %.2f ms / step' % (
+        ref_growth / 2 ** 20, ref_kept, ref_time * 1e3))
+    print('DeviceMeter       : %+.1f MB, %d autograd nodes kept, %.2f ms / step' % (
+        new_growth / 2 ** 20, new_kept, new_time * 1e3))
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,31 @@
+from os.path import join, dirname, abspath
+from pathlib import Path
+import sys
+CURRENT_DIR = dirname(abspath(__file__))
+sys.path.insert(0, join(CURRENT_DIR, '..'))  # Use local amsolver rather than installed
+from amsolver.low_dim_index import INDEX_FILE, LowDimIndex
+
+from absl import app
+from absl import flags
+
+"""
+Index the low dimensional data of every episode of a dataset split into
+low_dim_index.pack, read by amsolver.low_dim_index.LowDimIndex.
+"""
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('data_path',
+                    '/home/liuchang/DATA/rlbench_data/train',
+                    'The dataset split to index.')
+flags.DEFINE_integer('processes', 8,
+                     'The number of parallel reading processes.')
+
+
+def main(argv):
+    index = LowDimIndex.open(FLAGS.data_path, processes=FLAGS.processes)
+    print('%d episodes indexed in %s' % (len(index), Path(FLAGS.data_path) / INDEX_FILE))
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,36 @@
+from os.path import join, dirname, abspath
+from argparse import Namespace
+import sys
+CURRENT_DIR = dirname(abspath(__file__))
+sys.path.insert(0, join(CURRENT_DIR, '..'))  # Use local amsolver rather than installed
+from vlm.scripts.VLDataloader import VLM_dataset
+
+from absl import app
+from absl import flags
+
+"""
+Scan every episode of a dataset split for pick or place points out of the
+map bounds and store the validity bitmap read by VLM_dataset (see
+vlm/scripts/validity_index.py). Builds the low dimensional index on the way.
+"""
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('data_dir',
+                    '/home/liuchang/DATA/rlbench_data',
+                    'The dataset root.')
+flags.DEFINE_string('setd', 'train', 'The split to scan.')
+flags.DEFINE_bool('renew_obs', True, 'The --renew_obs of the training run.')
+flags.DEFINE_bool('use_fail_cases', False, 'Also scan the fail cases.')
+
+
+def main(argv):
+    args = Namespace(relative=False, renew_obs=FLAGS.renew_obs, add_low_lang=False, heightmap_cache=False)
+    dataset = VLM_dataset(FLAGS.data_dir, FLAGS.setd, unused_camera_list=[None], preprocess=False,
+                          use_fail_cases=FLAGS.use_fail_cases, args=args)
+    print('%d valid and %d invalid episodes in %s' % (
+        len(dataset.episode_list), len(dataset.invalid_episodes), dataset.validity.path))
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -1,4 +1,4 @@
-from multiprocessing import Process, Manager
+import shutil
 from time import time
 
 from pyrep.const import RenderMode
@@ -14,11 +14,12 @@ import amsolver.backend.task as task
 
 import os
 import pickle
-from PIL import Image
-from amsolver.backend import utils
 from amsolver.backend.const import *
 import numpy as np
 from pathlib import Path
+from generation_scheduler import Scheduler
+from demo_writer import (DEFAULT_COMPRESS_LEVEL, DemoWriter, check_and_make, demo_images,
+                         write_image, write_low_dim)
 
 from absl import app
 from absl import flags
@@ -52,7 +53,7 @@ flags.DEFINE_enum('renderer',  'opengl', ['opengl', 'opengl3'],
                   'The renderer to use. opengl does not include shadows, '
                   'but is faster.')
 flags.DEFINE_integer('processes', 12,
-                     'The number of parallel processes during collection.')
+                     'The number of parallel simulator processes during collection.')
 flags.DEFINE_integer('episodes_per_task', 100,
                      'The number of episodes to collect per task.')
 flags.DEFINE_integer('variations', -1,
@@ -61,12 +62,23 @@ flags.DEFINE_bool('save_configs', True,
                      'whether also save the config for replay.')
 flags.DEFINE_integer('seed', 1,
                      'dataset collection seed')
+flags.DEFINE_integer('attempts', 10,
+                     'Demos tried per episode before the episode counts as failed.')
+flags.DEFINE_integer('max_retries', 3,
+                     'Times a failed episode is handed to another process.')
+flags.DEFINE_float('report_every', 60.,
+                   'Seconds between throughput reports.')
+flags.DEFINE_integer('writer_workers', 4,
+                     'Threads (or processes) per simulator encoding and writing the images of '
+                     'collected demos in the background. 0 writes them on the simulator process.')
+flags.DEFINE_bool('writer_processes', False,
+                  'Encode the images in processes rather than threads.')
+flags.DEFINE_integer('writer_queue', 1024,
+                     'Images waiting to be written before the simulator waits for the writer.')
+flags.DEFINE_integer('png_compress_level', DEFAULT_COMPRESS_LEVEL,
+                     'zlib level of the saved PNGs, 0 (fastest, largest) to 9.')
 
 
-def check_and_make(dir):
-    if not os.path.exists(dir):
-        os.makedirs(dir)
-
 def save_configs(task_base, waypoint_sets, config, example_path):
     check_and_make(example_path)
     # Save the low-dimension data
@@ -75,135 +87,17 @@ def save_configs(task_base, waypoint_sets, config, example_path):
     task_base.save_model(os.path.join(example_path, "task_base.ttm"))
     waypoint_sets.save_model(os.path.join(example_path, "waypoint_sets.ttm"))
 
-def save_demo(demo, example_path):
-
-    # Save image data first, and then None the image data, and pickle
-    left_shoulder_rgb_path = os.path.join(
-        example_path, LEFT_SHOULDER_RGB_FOLDER)
-    left_shoulder_depth_path = os.path.join(
-        example_path, LEFT_SHOULDER_DEPTH_FOLDER)
-    left_shoulder_mask_path = os.path.join(
-        example_path, LEFT_SHOULDER_MASK_FOLDER)
-    right_shoulder_rgb_path = os.path.join(
-        example_path, RIGHT_SHOULDER_RGB_FOLDER)
-    right_shoulder_depth_path = os.path.join(
-        example_path, RIGHT_SHOULDER_DEPTH_FOLDER)
-    right_shoulder_mask_path = os.path.join(
-        example_path, RIGHT_SHOULDER_MASK_FOLDER)
-    overhead_rgb_path = os.path.join(
-        example_path, OVERHEAD_RGB_FOLDER)
-    overhead_depth_path = os.path.join(
-        example_path, OVERHEAD_DEPTH_FOLDER)
-    overhead_mask_path = os.path.join(
-        example_path, OVERHEAD_MASK_FOLDER)
-    wrist_rgb_path = os.path.join(example_path, WRIST_RGB_FOLDER)
-    wrist_depth_path = os.path.join(example_path, WRIST_DEPTH_FOLDER)
-    wrist_mask_path = os.path.join(example_path, WRIST_MASK_FOLDER)
-    front_rgb_path = os.path.join(example_path, FRONT_RGB_FOLDER)
-    front_depth_path = os.path.join(example_path, FRONT_DEPTH_FOLDER)
-    front_mask_path = os.path.join(example_path, FRONT_MASK_FOLDER)
-
-    check_and_make(left_shoulder_rgb_path)
-    check_and_make(left_shoulder_depth_path)
-    check_and_make(left_shoulder_mask_path)
-    check_and_make(right_shoulder_rgb_path)
-    check_and_make(right_shoulder_depth_path)
-    check_and_make(right_shoulder_mask_path)
-    check_and_make(overhead_rgb_path)
-    check_and_make(overhead_depth_path)
-    check_and_make(overhead_mask_path)
-    check_and_make(wrist_rgb_path)
-    check_and_make(wrist_depth_path)
-    check_and_make(wrist_mask_path)
-    check_and_make(front_rgb_path)
-    check_and_make(front_depth_path)
-    check_and_make(front_mask_path)
-
-    for i, obs in enumerate(demo):
-        left_shoulder_rgb = Image.fromarray(obs.left_shoulder_rgb)
-        left_shoulder_depth = utils.float_array_to_rgb_image(
-            obs.left_shoulder_depth, scale_factor=DEPTH_SCALE)
-        left_shoulder_mask = Image.fromarray(
-            (obs.left_shoulder_mask * 255).astype(np.uint8))
-        right_shoulder_rgb = Image.fromarray(obs.right_shoulder_rgb)
-        right_shoulder_depth = utils.float_array_to_rgb_image(
-            obs.right_shoulder_depth, scale_factor=DEPTH_SCALE)
-        right_shoulder_mask = Image.fromarray(
-            (obs.right_shoulder_mask * 255).astype(np.uint8))
-        overhead_rgb = Image.fromarray(obs.overhead_rgb)
-        overhead_depth = utils.float_array_to_rgb_image(
-            obs.overhead_depth, scale_factor=DEPTH_SCALE)
-        overhead_mask = Image.fromarray(
-            (obs.overhead_mask * 255).astype(np.uint8))
-        wrist_rgb = Image.fromarray(obs.wrist_rgb)
-        wrist_depth = utils.float_array_to_rgb_image(
-            obs.wrist_depth, scale_factor=DEPTH_SCALE)
-        wrist_mask = Image.fromarray((obs.wrist_mask * 255).astype(np.uint8))
-        front_rgb = Image.fromarray(obs.front_rgb)
-        front_depth = utils.float_array_to_rgb_image(
-            obs.front_depth, scale_factor=DEPTH_SCALE)
-        front_mask = Image.fromarray((obs.front_mask * 255).astype(np.uint8))
-
-        left_shoulder_rgb.save(
-            os.path.join(left_shoulder_rgb_path, IMAGE_FORMAT % i))
-        left_shoulder_depth.save(
-            os.path.join(left_shoulder_depth_path, IMAGE_FORMAT % i))
-        left_shoulder_mask.save(
-            os.path.join(left_shoulder_mask_path, IMAGE_FORMAT % i))
-        right_shoulder_rgb.save(
-            os.path.join(right_shoulder_rgb_path, IMAGE_FORMAT % i))
-        right_shoulder_depth.save(
-            os.path.join(right_shoulder_depth_path, IMAGE_FORMAT % i))
-        right_shoulder_mask.save(
-            os.path.join(right_shoulder_mask_path, IMAGE_FORMAT % i))
-        overhead_rgb.save(
-            os.path.join(overhead_rgb_path, IMAGE_FORMAT % i))
-        overhead_depth.save(
-            os.path.join(overhead_depth_path, IMAGE_FORMAT % i))
-        overhead_mask.save(
-            os.path.join(overhead_mask_path, IMAGE_FORMAT % i))
-        wrist_rgb.save(os.path.join(wrist_rgb_path, IMAGE_FORMAT % i))
-        wrist_depth.save(os.path.join(wrist_depth_path, IMAGE_FORMAT % i))
-        wrist_mask.save(os.path.join(wrist_mask_path, IMAGE_FORMAT % i))
-        front_rgb.save(os.path.join(front_rgb_path, IMAGE_FORMAT % i))
-        front_depth.save(os.path.join(front_depth_path, IMAGE_FORMAT % i))
-        front_mask.save(os.path.join(front_mask_path, IMAGE_FORMAT % i))
-
-        # We save the images separately, so set these to None for pickling.
-        obs.left_shoulder_rgb = None
-        obs.left_shoulder_depth = None
-        obs.left_shoulder_point_cloud = None
-        obs.left_shoulder_mask = None
-        obs.right_shoulder_rgb = None
-        obs.right_shoulder_depth = None
-        obs.right_shoulder_point_cloud = None
-        obs.right_shoulder_mask = None
-        obs.overhead_rgb = None
-        obs.overhead_depth = None
-        obs.overhead_point_cloud = None
-        obs.overhead_mask = None
-        obs.wrist_rgb = None
-        obs.wrist_depth = None
-        obs.wrist_point_cloud = None
-        obs.wrist_mask = None
-        obs.front_rgb = None
-        obs.front_depth = None
-        obs.front_point_cloud = None
-        obs.front_mask = None
-
-    # Save the low-dimension data
-    with open(os.path.join(example_path, LOW_DIM_PICKLE), 'wb') as f:
-        pickle.dump(demo, f)
-
-
-def run(i, lock, task_index, variation_count, results, file_lock, tasks):
-    """Each thread will choose one task and variation, and then gather
-    all the episodes_per_task for that variation."""
+def save_demo(demo, example_path, writer=None, compress_level=DEFAULT_COMPRESS_LEVEL):
+    """Saves the images of a demo, then its low dimensional data; in the background if a writer is given."""
+    if writer is not None:
+        writer.save(demo, example_path)
+        return
+    for path, kind, array in demo_images(demo, example_path):
+        write_image(path, kind, array, compress_level)
+    write_low_dim(demo, example_path)
 
-    # Initialise each thread with random seed
-    np.random.seed(None)
-    num_tasks = len(tasks)
 
+def make_obs_config():
     img_size = list(map(int, FLAGS.image_size))
 
     obs_config = ObservationConfig()
@@ -234,133 +128,93 @@ def run(i, lock, task_index, variation_count, results, file_lock, tasks):
         obs_config.overhead_camera.render_mode = RenderMode.OPENGL
         obs_config.wrist_camera.render_mode = RenderMode.OPENGL
         obs_config.front_camera.render_mode = RenderMode.OPENGL
-
-    amsolver_env = Environment(
-        action_mode=ActionMode(),
-        obs_config=obs_config,
-        headless=True) # set headless=False, if user want to visualize the simulator 
-    amsolver_env.launch()
-
-    task_env = None
-
-    tasks_with_problems = results[i] = ''
-
-    while True:
-        # Figure out what task/variation this thread is going to do
-        with lock:
-
-            if task_index.value >= num_tasks:
-                print('Process', i, 'finished')
-                break
-
-            my_variation_count = variation_count.value
-            t = tasks[task_index.value]
-            task_env = amsolver_env.get_task(t)
-            var_target = task_env.variation_count()
-            if FLAGS.variations >= 0:
-                var_target = np.minimum(FLAGS.variations, var_target)
-            if my_variation_count >= var_target:
-                # If we have reached the required number of variations for this
-                # task, then move on to the next task.
-                variation_count.value = my_variation_count = 0
-                task_index.value += 1
-
-            variation_count.value += 1
-            if task_index.value >= num_tasks:
-                print('Process', i, 'finished')
-                break
-            t = tasks[task_index.value]
-
-        task_env = amsolver_env.get_task(t)
-        task_env.set_variation(my_variation_count)
-
-        variation_path = os.path.join(
-            FLAGS.save_path, task_env.get_name(),
-            VARIATIONS_FOLDER % my_variation_count)
-
-        check_and_make(variation_path)
-
-        episodes_path = os.path.join(variation_path, EPISODES_FOLDER)
-        check_and_make(episodes_path)
-        current_episodes = list(Path(episodes_path).rglob("low_dim*"))
-
-        fails_path = os.path.join(variation_path, 'fail_cases')
-        check_and_make(fails_path)
-
-        abort_variation = False
-        ex_idx = len(current_episodes)
-        # ex_idx = 20
-        fail_idx = 0
-        need_fail_case = False
-        # for ex_idx in range(FLAGS.episodes_per_task):
-        while ex_idx<FLAGS.episodes_per_task:
-            print('Process', i, '// Task:', task_env.get_name(),
-                  '// Variation:', my_variation_count, '// Demo:', ex_idx)
-            attempts = 10
-            while attempts > 0:
-                try:
-                    # TODO: for now we do the explicit looping.
-                    t0 = time()
-                    demo_success= task_env.get_demos(
-                        amount=1,
-                        live_demos=True)
-                    if len(demo_success)==2:
-                        demo = demo_success[0][0]
-                        success = demo_success[1][0]
-                    else:
-                        demo = demo_success[0][0]
-                    print(f"one demo for {task_env.get_name()} // Variation {my_variation_count}: {time()-t0}, success: {success}")
-                except Exception as e:
-                    print(e)
-                    attempts -= 1
-                    if attempts > 0:
-                        continue
-                    problem = (
-                        'Process %d failed collecting task %s (variation: %d, '
-                        'example: %d). Skipping this task/variation.\n%s\n' % (
-                            i, task_env.get_name(), my_variation_count, ex_idx,
-                            str(e))
-                    )
-                    print(problem)
-                    tasks_with_problems += problem
-                    abort_variation = True
-                    break
-                if success:
-                    episode_path = os.path.join(episodes_path, EPISODE_FOLDER % (ex_idx))
-                    # with file_lock:
-                    save_demo(demo, episode_path)
-                    if FLAGS.save_configs:
-                        task_base, waypoint_sets, config = task_env.read_config(demo.high_level_instructions)
-                        # with file_lock:
-                        save_configs(task_base, waypoint_sets, config, episode_path)
-                    ex_idx += 1
-                    break
-                else:
-                    if need_fail_case:
-                        if fail_idx<FLAGS.episodes_per_task:
-                            fail_path = os.path.join(fails_path, EPISODE_FOLDER % fail_idx)
-                            with file_lock:
-                                save_demo(demo, fail_path)
-                            fail_idx+=1
-                        else:
-                            attempts -= 1
-                            if attempts > 0:
-                                continue
-                            problem = (
-                            'Process %d failed collecting task %s (variation: %d, '
-                            'example: %d). Skipping this task/variation.\n' % (
-                                i, task_env.get_name(), my_variation_count, ex_idx)
-                            )
-                            print(problem)
-                            tasks_with_problems += problem
-                            abort_variation = True
-                    else:
-                        attempts -= 1
-            if abort_variation:
-                break
-
-    results[i] = tasks_with_problems
-    amsolver_env.shutdown()
+    return obs_config
+
+
+def episode_path(task_name, variation, episode):
+    return os.path.join(FLAGS.save_path, task_name, VARIATIONS_FOLDER % variation,
+                        EPISODES_FOLDER, EPISODE_FOLDER % episode)
+
+
+class DemoCollector(object):
+    """One simulator, collecting the episodes the scheduler hands to its process."""
+
+    def __init__(self, worker_id):
+        # Initialise each process with random seed
+        np.random.seed(None)
+        self.worker_id = worker_id
+        self.env = Environment(
+            action_mode=ActionMode(),
+            obs_config=make_obs_config(),
+            headless=True) # set headless=False, if user want to visualize the simulator
+        self.env.launch()
+        # Environment.get_task unloads the scene of the previous task env, so
+        # only the env of the last loaded task can be used.
+        self.task_name = None
+        self.task_env = None
+        self.writer = None
+        if FLAGS.writer_workers > 0:
+            self.writer = DemoWriter(FLAGS.writer_workers, FLAGS.writer_queue,
+                                     FLAGS.png_compress_level, FLAGS.writer_processes)
+
+    def get_task(self, task_name):
+        if task_name != self.task_name:
+            task_class = task_file_to_task_class(task_name, parent_folder = 'vlm')
+            self.task_name = None
+            self.task_env = self.env.get_task(task_class)
+            self.task_name = task_name
+        return self.task_env
+
+    def variation_count(self, task_name):
+        return self.get_task(task_name).variation_count()
+
+    def collect(self, task_name, variation, episode):
+        task_env = self.get_task(task_name)
+        task_env.set_variation(variation)
+        example_path = episode_path(task_name, variation, episode)
+        # Drop what a crashed attempt left behind.
+        if os.path.exists(example_path):
+            shutil.rmtree(example_path)
+
+        print('Process', self.worker_id, '// Task:', task_env.get_name(),
+              '// Variation:', variation, '// Demo:', episode)
+        error = None
+        for _ in range(FLAGS.attempts):
+            try:
+                t0 = time()
+                demos, successes = task_env.get_demos(
+                    amount=1,
+                    live_demos=True)
+                demo, success = demos[0], successes[0]
+                print(f"one demo for {task_env.get_name()} // Variation {variation}: {time()-t0}, success: {success}")
+            except Exception as e:
+                print(e)
+                error = e
+                continue
+            if success:
+                # Configs first: once the demo is queued the writer owns the folder, and a
+                # retry elsewhere must not remove it while the writer is still in it.
+                if FLAGS.save_configs:
+                    task_base, waypoint_sets, config = task_env.read_config(demo.high_level_instructions)
+                    save_configs(task_base, waypoint_sets, config, example_path)
+                save_demo(demo, example_path, self.writer, FLAGS.png_compress_level)
+                return
+        raise RuntimeError('No successful demo in %d attempts (last error: %s)' % (FLAGS.attempts, error))
+
+    def shutdown(self):
+        if self.writer is not None:
+            # Episodes whose writes failed have no low_dim_obs.pkl and are collected
+            # again by the next run, see is_collected.
+            try:
+                self.writer.close()
+            except RuntimeError as e:
+                print(e)
+        self.env.shutdown()
+
+
+def is_collected(item):
+    """Episodes whose low_dim_obs.pkl, written after all their images, is on disk."""
+    return isfile(os.path.join(episode_path(item.task, item.variation, item.episode), LOW_DIM_PICKLE))
 
 
 def main(argv):
@@ -375,30 +229,16 @@ def main(argv):
                 raise ValueError('Task %s not recognised!.' % t)
         task_files = FLAGS.tasks
 
-    tasks = [task_file_to_task_class(t, parent_folder = 'vlm') for t in task_files]
-
-    manager = Manager()
-
-    result_dict = manager.dict()
-    file_lock = manager.Lock()
-
-    task_index = manager.Value('i', 0)
-    variation_count = manager.Value('i', 0)
-    lock = manager.Lock()
-
-    check_and_make(FLAGS.save_path)
-
-    processes = [Process(
-        target=run, args=(
-            i, lock, task_index, variation_count, result_dict, file_lock,
-            tasks))
-        for i in range(FLAGS.processes)]
-    [t.start() for t in processes]
-    [t.join() for t in processes]
+    # Work is handed out per (task, variation, episode), see generation_scheduler.
+    scheduler = Scheduler(FLAGS.save_path, task_files, DemoCollector, FLAGS.processes,
+                          FLAGS.episodes_per_task, variations=FLAGS.variations,
+                          max_retries=FLAGS.max_retries, report_every=FLAGS.report_every,
+                          is_collected=is_collected)
+    problems = scheduler.run()
 
     print('Data collection done!')
-    for i in range(FLAGS.processes):
-        print(result_dict[i])
+    for problem in problems:
+        print(problem)
 
 
 if __name__ == '__main__':
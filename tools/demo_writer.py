@@ -0,0 +1,154 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import os
+import pickle
+import threading
+from os.path import join, dirname, abspath
+import sys
+CURRENT_DIR = dirname(abspath(__file__))
+sys.path.insert(0, join(CURRENT_DIR, '..'))  # Use local amsolver rather than installed
+
+import numpy as np
+from PIL import Image
+
+from amsolver.backend import utils
+from amsolver.backend.const import *
+
+"""
+Writer of the images and low dimensional data of collected demos.
+
+Every frame of a demo has an rgb, a depth (24-bit, see
+utils.float_array_to_rgb_image) and a mask image for each of the 5 cameras.
+DemoWriter encodes and writes them on a pool of threads (or processes) while
+the simulator moves on to the next demo. At most `max_pending` images wait in
+memory; past that, save blocks the simulator until the pool catches up.
+Once all images of an episode are written and fsynced, low_dim_obs.pkl is
+written to a temporary file, fsynced and renamed, so an episode folder with a
+low_dim_obs.pkl always has all its images.
+"""
+
+# (observation attribute prefix, rgb folder, depth folder, mask folder)
+CAMERA_FOLDERS = [
+    ('left_shoulder', LEFT_SHOULDER_RGB_FOLDER, LEFT_SHOULDER_DEPTH_FOLDER, LEFT_SHOULDER_MASK_FOLDER),
+    ('right_shoulder', RIGHT_SHOULDER_RGB_FOLDER, RIGHT_SHOULDER_DEPTH_FOLDER, RIGHT_SHOULDER_MASK_FOLDER),
+    ('overhead', OVERHEAD_RGB_FOLDER, OVERHEAD_DEPTH_FOLDER, OVERHEAD_MASK_FOLDER),
+    ('wrist', WRIST_RGB_FOLDER, WRIST_DEPTH_FOLDER, WRIST_MASK_FOLDER),
+    ('front', FRONT_RGB_FOLDER, FRONT_DEPTH_FOLDER, FRONT_MASK_FOLDER),
+]
+
+# PIL's default zlib level for PNG
+DEFAULT_COMPRESS_LEVEL = 6
+
+
+def check_and_make(dir):
+    if not os.path.exists(dir):
+        os.makedirs(dir)
+
+
+def encode_image(kind, array):
+    if kind == 'rgb':
+        return Image.fromarray(array)
+    if kind == 'depth':
+        return utils.float_array_to_rgb_image(array, scale_factor=DEPTH_SCALE)
+    return Image.fromarray((array * 255).astype(np.uint8))
+
+
+def write_image(path, kind, array, compress_level=DEFAULT_COMPRESS_LEVEL):
+    image = encode_image(kind, array)
+    with open(path, 'wb') as f:
+        image.save(f, format='PNG', compress_level=compress_level)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def write_low_dim(demo, example_path):
+    path = os.path.join(example_path, LOW_DIM_PICKLE)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(demo, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    fd = os.open(example_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def demo_images(demo, example_path):
+    """(path, kind, array) of every image of a demo, with the images removed from the observations."""
+    for _, rgb_folder, depth_folder, mask_folder in CAMERA_FOLDERS:
+        for folder in (rgb_folder, depth_folder, mask_folder):
+            check_and_make(os.path.join(example_path, folder))
+
+    images = []
+    for i, obs in enumerate(demo):
+        for camera, rgb_folder, depth_folder, mask_folder in CAMERA_FOLDERS:
+            for kind, folder in (('rgb', rgb_folder), ('depth', depth_folder), ('mask', mask_folder)):
+                images.append((os.path.join(example_path, folder, IMAGE_FORMAT % i),
+                               kind, getattr(obs, '%s_%s' % (camera, kind))))
+            # We save the images separately, so set these to None for pickling.
+            for kind in ('rgb', 'depth', 'point_cloud', 'mask'):
+                setattr(obs, '%s_%s' % (camera, kind), None)
+    return images
+
+
+class DemoWriter(object):
+    """Writes demos in the background, see the module docstring."""
+
+    def __init__(self, workers=4, max_pending=1024, compress_level=DEFAULT_COMPRESS_LEVEL,
+                 processes=False):
+        self.compress_level = compress_level
+        executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        self._pool = executor(max_workers=workers)
+        # Episodes wait for their images here, one at a time and in order.
+        self._finisher = ThreadPoolExecutor(max_workers=1)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._episodes = []
+        self._errors = []
+        self._lock = threading.Lock()
+
+    def _submit_image(self, path, kind, array):
+        self._slots.acquire()
+        try:
+            future = self._pool.submit(write_image, path, kind, array, self.compress_level)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def _finish(self, demo, example_path, futures):
+        try:
+            for future in futures:
+                future.result()
+            write_low_dim(demo, example_path)
+        except Exception as e:
+            with self._lock:
+                self._errors.append('%s: %r' % (example_path, e))
+            print('Could not write %s: %r' % (example_path, e))
+
+    def save(self, demo, example_path):
+        """Queues the images and low dimensional data of a demo; its observations lose their images."""
+        futures = [self._submit_image(*image) for image in demo_images(demo, example_path)]
+        episode = self._finisher.submit(self._finish, demo, example_path, futures)
+        with self._lock:
+            self._episodes = [e for e in self._episodes if not e.done()] + [episode]
+
+    def wait(self):
+        """Blocks until every queued demo is on disk, and raises if one could not be written."""
+        with self._lock:
+            episodes, self._episodes = self._episodes, []
+        for episode in episodes:
+            episode.result()
+        with self._lock:
+            errors, self._errors = self._errors, []
+        if errors:
+            raise RuntimeError('Demos not written: ' + '; '.join(errors))
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self._finisher.shutdown()
+            self._pool.shutdown()
@@ -0,0 +1,448 @@
+from collections import deque, namedtuple
+import json
+import multiprocessing as mp
+import os
+import pickle
+import queue
+from time import time, sleep
+from os.path import join, dirname, abspath, exists
+import sys
+CURRENT_DIR = dirname(abspath(__file__))
+sys.path.insert(0, join(CURRENT_DIR, '..'))  # Use local amsolver rather than installed
+
+import numpy as np
+
+"""
+Work-queue scheduler for dataset generation.
+
+Work is split into items: one planning item per task, which asks the
+simulator for its number of variations, then one item per (task, variation,
+episode). A dispatcher in the main process (Dispatcher, which
+vlm/scripts/eval_scheduler.py shares) hands items to the simulator
+processes one at a time, so a slow variation never leaves the other
+processes idle. Every state change (inflight, done, failed) is appended to
+a json-lines ledger in the save folder and replayed on restart: done items
+are skipped (if they are on disk, when the scheduler is given is_collected)
+and items that were in flight when the run died are collected again. A
+failed item is retried up to `max_retries` times, on another process when
+there is one, and a process that dies is replaced, unless it died
+`max_retries` times in a row without collecting an item.
+
+A collector, built once per process by `make_collector(worker_id)`, does
+the simulator work:
+    variation_count(task) -> int
+    collect(task, variation, episode)   raises if no demo could be saved
+    shutdown()
+
+FakeEnvironment stands in for the simulator, to run the scheduler without
+CoppeliaSim:
+    python tools/generation_scheduler.py --save_path /tmp/fake_data --processes 4
+"""
+
+LEDGER_FILE = 'generation_ledger.jsonl'
+
+WorkItem = namedtuple('WorkItem', ['task', 'variation', 'episode'])
+
+
+def item_key(item):
+    if item.variation is None:
+        return item.task
+    return '%s/variation%d/episode%d' % (item.task, item.variation, item.episode)
+
+
+class Ledger(object):
+    """Append-only record of the state of every work item."""
+
+    def __init__(self, path):
+        self.path = path
+        self.states = {}
+        self.infos = {}
+        if exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # Line cut by a crash.
+                    self.states[entry['key']] = entry['state']
+                    self.infos[entry['key']] = entry
+        self._file = open(path, 'a')
+
+    def record(self, key, state, **info):
+        entry = dict(info, key=key, state=state, time=time())
+        self.states[key] = state
+        self.infos[key] = entry
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def done(self, key):
+        return self.states.get(key) == 'done'
+
+    def close(self):
+        self._file.close()
+
+
+def _worker(worker_id, make_worker, work, inbox, results):
+    try:
+        worker = make_worker(worker_id)
+    except Exception as e:
+        results.put(('dead', worker_id, None, repr(e)))
+        return
+    results.put(('ready', worker_id, None, None))
+    while True:
+        item = inbox.get()
+        if item is None:
+            break
+        try:
+            results.put(('done', worker_id, item, work(worker, item)))
+        except Exception as e:
+            results.put(('failed', worker_id, item, repr(e)))
+    worker.shutdown()
+
+
+class Dispatcher(object):
+    """Hands work items to long-lived worker processes, one at a time.
+
+    `make_worker(worker_id)` builds the worker of a process, on which
+    `work(worker, item)` returns the info of an item or raises. A failed item
+    is retried up to `max_retries` times, on another process when there is
+    one, then given up. A process that dies is replaced, unless it died
+    `max_retries` times in a row without getting an item done. With
+    `same_task_first`, a process is handed items of the task it had last
+    whenever there are some, so it rarely has to load another task.
+
+    Subclasses set `ledger` before `dispatch` and define `item_key`; they
+    hear of the outcome of items through `done` and `give_up`.
+    """
+
+    def __init__(self, make_worker, work, processes, max_retries=3, report_every=60.,
+                 same_task_first=False):
+        self.make_worker = make_worker
+        self.work = work
+        self.processes = processes
+        self.max_retries = max_retries
+        self.report_every = report_every
+        self.same_task_first = same_task_first
+        self.ledger = None
+        self.started = None
+
+    def item_key(self, item):
+        raise NotImplementedError
+
+    def done(self, worker_id, item, info):
+        """Called with the info of every item done; returns the items it adds to the work."""
+        return []
+
+    def give_up(self, worker_id, item, error, attempts):
+        """Called with the items that failed more than max_retries times."""
+        pass
+
+    def report(self, pending, inflight):
+        pass
+
+    def dispatch(self, items, processes=None):
+        """Runs the items on `processes` (default: self.processes) processes; returns the
+        number of items left when no process is."""
+        pending = deque((item, None) for item in items)
+        attempts = {}
+        inflight = {}
+        last_task = {}
+        idle = set()
+        results = mp.Queue()
+        inboxes, procs = {}, {}
+
+        def start(worker_id):
+            inboxes[worker_id] = mp.Queue()
+            procs[worker_id] = mp.Process(
+                target=_worker, args=(worker_id, self.make_worker, self.work, inboxes[worker_id], results))
+            procs[worker_id].start()
+
+        def hand_out(worker_id, force=False):
+            candidates = [k for k, (item, excluded) in enumerate(pending) if force or excluded != worker_id]
+            if not candidates:
+                idle.add(worker_id)
+                return
+            if self.same_task_first:
+                # Stay on the loaded task when there is work left for it.
+                same_task = [k for k in candidates if pending[k][0].task == last_task.get(worker_id)]
+                candidates = same_task or candidates
+            k = candidates[0]
+            item = pending[k][0]
+            del pending[k]
+            inflight[worker_id] = item
+            last_task[worker_id] = item.task
+            self.ledger.record(self.item_key(item), 'inflight', worker=worker_id)
+            inboxes[worker_id].put(item)
+            idle.discard(worker_id)
+
+        def fail(worker_id, item, error):
+            key = self.item_key(item)
+            attempts[key] = attempts.get(key, 0) + 1
+            if attempts[key] <= self.max_retries:
+                self.ledger.record(key, 'failed', worker=worker_id, error=error, attempt=attempts[key])
+                pending.append((item, worker_id))
+            else:
+                self.give_up(worker_id, item, error, attempts[key])
+
+        for worker_id in range(self.processes if processes is None else processes):
+            start(worker_id)
+
+        self.started = last_report = time()
+        # Consecutive deaths of each process, reset by every item it gets done.
+        restarts = {}
+        while (pending or inflight) and procs:
+            try:
+                kind, worker_id, item, info = results.get(timeout=1.)
+            except queue.Empty:
+                kind = None
+            if kind in ('ready', 'done', 'failed'):
+                inflight.pop(worker_id, None)
+                if kind == 'done':
+                    restarts.pop(worker_id, None)
+                    pending.extend((i, None) for i in self.done(worker_id, item, info))
+                elif kind == 'failed':
+                    fail(worker_id, item, info)
+                hand_out(worker_id)
+            elif kind == 'dead':
+                print('Process %d could not start: %s' % (worker_id, info))
+
+            # Processes only exit on their own when they crash: hand their item
+            # to someone else and replace them.
+            for worker_id, proc in list(procs.items()):
+                if proc.is_alive():
+                    continue
+                proc.join()
+                idle.discard(worker_id)
+                last_task.pop(worker_id, None)
+                if worker_id in inflight:
+                    fail(worker_id, inflight.pop(worker_id), 'process died')
+                restarts[worker_id] = restarts.get(worker_id, 0) + 1
+                if restarts[worker_id] <= self.max_retries:
+                    start(worker_id)
+                else:
+                    del procs[worker_id]
+                    print('Process %d died %d times in a row, not restarting it' % (worker_id, restarts[worker_id]))
+
+            for worker_id in sorted(idle):
+                if pending:
+                    hand_out(worker_id)
+            # Items left only for the process they failed on.
+            if pending and not inflight and idle:
+                hand_out(min(idle), force=True)
+
+            if time() - last_report >= self.report_every:
+                last_report = time()
+                self.report(len(pending), len(inflight))
+
+        left = len(pending) + len(inflight)
+        for worker_id in procs:
+            inboxes[worker_id].put(None)
+        for proc in procs.values():
+            proc.join()
+        self.report(0, 0)
+        return left
+
+
+def _collect(collector, item):
+    if item.variation is None:
+        return {'variations': int(collector.variation_count(item.task))}
+    collector.collect(item.task, item.variation, item.episode)
+    return {}
+
+
+class Scheduler(Dispatcher):
+    """Dispatches (task, variation, episode) items to collector processes."""
+
+    def __init__(self, save_path, tasks, make_collector, processes, episodes_per_task,
+                 variations=-1, max_retries=3, report_every=60., is_collected=None):
+        super(Scheduler, self).__init__(make_collector, _collect, processes,
+                                        max_retries=max_retries, report_every=report_every)
+        self.save_path = save_path
+        self.tasks = list(tasks)
+        self.episodes_per_task = episodes_per_task
+        self.variations = variations
+        # Whether an episode is on disk. Done items are collected again if not, as
+        # collectors may still be writing an item they reported done when a run dies;
+        # items on disk that are not done, e.g. saved by an older run, are skipped.
+        self.is_collected = is_collected
+        self.problems = []
+        self.collected = {}
+
+    def item_key(self, item):
+        return item_key(item)
+
+    def expand(self, task, variation_count):
+        """Episode items of a planned task that still have to be collected."""
+        if self.variations >= 0:
+            variation_count = min(self.variations, variation_count)
+        items = []
+        for v in range(variation_count):
+            for e in range(self.episodes_per_task):
+                item = WorkItem(task, v, e)
+                done = self.ledger.done(item_key(item))
+                if self.is_collected is None:
+                    if done:
+                        continue
+                elif self.is_collected(item):
+                    if not done:
+                        self.ledger.record(item_key(item), 'done', resumed=True)
+                    continue
+                items.append(item)
+        return items
+
+    def initial_items(self):
+        items = []
+        for task in self.tasks:
+            if self.ledger.done(task):
+                items += self.expand(task, self.ledger.infos[task]['variations'])
+            else:
+                items.append(WorkItem(task, None, None))
+        return items
+
+    def done(self, worker_id, item, info):
+        self.ledger.record(item_key(item), 'done', worker=worker_id, **info)
+        if item.variation is None:
+            return self.expand(item.task, info['variations'])
+        self.collected[item.task] = self.collected.get(item.task, 0) + 1
+        return []
+
+    def give_up(self, worker_id, item, error, attempts):
+        key = item_key(item)
+        self.ledger.record(key, 'failed', worker=worker_id, error=error, attempt=attempts)
+        self.problems.append('%s failed %d times, last error: %s' % (key, attempts, error))
+        print(self.problems[-1])
+
+    def run(self):
+        if not exists(self.save_path):
+            os.makedirs(self.save_path)
+        self.ledger = Ledger(join(self.save_path, LEDGER_FILE))
+        self.collected = {}
+        left = self.dispatch(self.initial_items())
+        if left:
+            self.problems.append('No process left, %d items not collected' % left)
+            print(self.problems[-1])
+        self.ledger.close()
+        return self.problems
+
+    def report(self, pending, inflight):
+        minutes = max(time() - self.started, 1e-6) / 60.
+        total = sum(self.collected.values())
+        print('Collected %d demos in %.1f min (%.1f demos/min), %d pending, %d in flight' % (
+            total, minutes, total / minutes, pending, inflight))
+        for task in sorted(self.collected):
+            print('    %s: %d demos, %.1f demos/min' % (
+                task, self.collected[task], self.collected[task] / minutes))
+
+
+class FakeTaskEnvironment(object):
+    """The part of TaskEnvironment the collectors use, without a simulator."""
+
+    def __init__(self, name, variations, failure_rate, step_time):
+        self._name = name
+        self._variations = variations
+        self._failure_rate = failure_rate
+        self._step_time = step_time
+        self._variation = 0
+
+    def get_name(self):
+        return self._name
+
+    def variation_count(self):
+        return self._variations
+
+    def set_variation(self, v):
+        self._variation = v
+
+    def get_demos(self, amount, live_demos=True):
+        sleep(self._step_time * np.random.uniform(0.5, 2.))
+        if np.random.rand() < self._failure_rate / 2:
+            raise RuntimeError('Fake planning error')
+        success = np.random.rand() >= self._failure_rate / 2
+        demo = {'task': self._name, 'variation': self._variation, 'steps': np.random.randint(20, 60)}
+        return [demo], [success]
+
+
+class FakeEnvironment(object):
+    """Stands in for amsolver.environment.Environment."""
+
+    def __init__(self, variations=3, failure_rate=0.2, step_time=0.05):
+        self.variations = variations
+        self.failure_rate = failure_rate
+        self.step_time = step_time
+
+    def launch(self):
+        pass
+
+    def get_task(self, task):
+        return FakeTaskEnvironment(task, self.variations, self.failure_rate, self.step_time)
+
+    def shutdown(self):
+        pass
+
+
+class FakeCollector(object):
+    """Collects fake demos, with the retry loop of the real collector."""
+
+    def __init__(self, save_path, attempts=10, crash_rate=0., **env_kwargs):
+        self.save_path = save_path
+        self.attempts = attempts
+        self.crash_rate = crash_rate
+        self.env = FakeEnvironment(**env_kwargs)
+        self.env.launch()
+
+    def variation_count(self, task):
+        return self.env.get_task(task).variation_count()
+
+    def collect(self, task, variation, episode):
+        if np.random.rand() < self.crash_rate:
+            os._exit(1)  # A simulator crash takes the whole process down.
+        task_env = self.env.get_task(task)
+        task_env.set_variation(variation)
+        for _ in range(self.attempts):
+            try:
+                demos, successes = task_env.get_demos(amount=1, live_demos=True)
+            except RuntimeError:
+                continue
+            if successes[0]:
+                episode_path = join(self.save_path, task, 'variation%d' % variation,
+                                    'episodes', 'episode%d' % episode)
+                if not exists(episode_path):
+                    os.makedirs(episode_path)
+                with open(join(episode_path, 'low_dim_obs.pkl'), 'wb') as f:
+                    pickle.dump(demos[0], f)
+                return
+        raise RuntimeError('No successful demo in %d attempts' % self.attempts)
+
+    def shutdown(self):
+        self.env.shutdown()
+
+
+def main(argv):
+    from absl import flags
+    FLAGS = flags.FLAGS
+    np.random.seed(None)
+
+    def make_collector(worker_id):
+        np.random.seed((os.getpid() * 7919 + worker_id) % 2 ** 32)
+        return FakeCollector(FLAGS.save_path, failure_rate=FLAGS.failure_rate,
+                             crash_rate=FLAGS.crash_rate, step_time=FLAGS.step_time)
+
+    scheduler = Scheduler(FLAGS.save_path, FLAGS.tasks, make_collector, FLAGS.processes,
+                          FLAGS.episodes_per_task, report_every=FLAGS.report_every)
+    problems = scheduler.run()
+    print('Fake collection done, %d items given up' % len(problems))
+
+
+if __name__ == '__main__':
+    from absl import app
+    from absl import flags
+    flags.DEFINE_string('save_path', '/tmp/fake_rlbench_data', 'Where to save the fake demos.')
+    flags.DEFINE_list('tasks', ['pick_cube_color', 'open_drawer'], 'Fake task names.')
+    flags.DEFINE_integer('processes', 4, 'The number of parallel processes.')
+    flags.DEFINE_integer('episodes_per_task', 10, 'Episodes per variation.')
+    flags.DEFINE_float('failure_rate', 0.2, 'Chance a fake demo attempt fails.')
+    flags.DEFINE_float('crash_rate', 0., 'Chance a fake process dies on an item.')
+    flags.DEFINE_float('step_time', 0.05, 'Mean seconds per fake demo.')
+    flags.DEFINE_float('report_every', 5., 'Seconds between throughput reports.')
+    app.run(main)
@@ -2,10 +2,14 @@ import open3d as o3d
 import argparse
 import numpy as np
 from itertools import combinations
+from multiprocessing import Pool
 import pickle
 import os
 from distutils.util import strtobool
 
+# Positions of the grasp centroid along the normal, as fractions of the finger length
+FINGER_PERCENTS = [0.1, 0.2, 0.4, 0.5]
+
 class GraspPoint:
     def __init__(self, centroid, normal, principal, shell_r, shell_h, idx, bbox3d):
         self.centroid = centroid
@@ -16,6 +20,76 @@ class GraspPoint:
         self.neighbor_idx = idx
         self.bbox3d = bbox3d # x, y, z: x is length along normal, z is length along principal
 
+def grasp_frames(points, normals, finger_length, rotation_sample, finger_percents=FINGER_PERCENTS):
+    """
+    Frames of every grasp candidate of the sample points (S, 3) and their normals (S, 3).
+    Grasps go along the normal and its opposite, as the estimated normal is not always
+    pointing inwards, with the centroid at several depths and the principal (the axis
+    of finger thickness) rotated about the normal.
+    Returns centroids (S, 2, F, 3), normals (S, 2, 3) and principals (S, 2, R, 3).
+    """
+    normals = np.stack([normals, -normals], axis=1)
+    normals = normals / np.linalg.norm(normals, axis=-1, keepdims=True)
+    offsets = finger_length * np.asarray(finger_percents)
+    centroids = points[:, None, None, :] + offsets[None, None, :, None] * normals[:, :, None, :]
+    tmp = np.array([1, 0, 0])
+    principal = tmp - (normals @ tmp)[..., None] * normals
+    principal = principal / np.linalg.norm(principal, axis=-1, keepdims=True)
+    theta = np.pi * 2 / rotation_sample
+    angles = np.arange(rotation_sample) * theta
+    principals = np.cos(angles)[:, None] * principal[:, :, None, :] \
+        + np.sin(angles)[:, None] * np.cross(principal, normals)[:, :, None, :]
+    principals = principals / np.linalg.norm(principals, axis=-1, keepdims=True)
+    return centroids, normals, principals
+
+
+def count_grasp_points(points, centroids, normals, principals, ft, fd, fw, fl, chunk=256):
+    """
+    Points of the cloud (P, 3) between the fingers and interfering with them, for every
+    candidate of grasp_frames. The volume between the fingers is a cuboid of finger length
+    along the normal, finger thickness along the principal and finger distance along
+    their cross product; the interfering volume extends it by the finger width along
+    the cross product and behind the fingers.
+    The neighbourhoods of `chunk` centroids are found in one radius search, then all
+    rotations of a centroid are scored with one matrix product.
+    Returns n_between and n_around, (S, 2, F, R) each.
+    """
+    S, _, F, _ = centroids.shape
+    R = principals.shape[2]
+    radius = np.sqrt(ft**2 + (fd + 2*fw)**2 + fl**2) / 2
+    nns = o3d.core.nns.NearestNeighborSearch(o3d.core.Tensor(points))
+    nns.fixed_radius_index(radius)
+    flat_centroids = centroids.reshape(-1, 3)
+    flat_normals = normals.reshape(-1, 3)
+    flat_principals = principals.reshape(-1, R, 3)
+    flat_crosses = np.cross(flat_normals[:, None, :], flat_principals)
+    n_between = np.zeros((len(flat_centroids), R), dtype=np.int64)
+    n_around = np.zeros((len(flat_centroids), R), dtype=np.int64)
+    for start in range(0, len(flat_centroids), chunk):
+        idx, dist, splits = nns.fixed_radius_search(
+            o3d.core.Tensor(flat_centroids[start:start + chunk]), radius, sort=False)
+        idx, dist, splits = idx.numpy(), dist.numpy(), splits.numpy()
+        for j in range(start, min(start + chunk, len(flat_centroids))):
+            first, last = splits[j - start], splits[j - start + 1]
+            if last - first < 2:
+                continue
+            # The nearest neighbour is left out, as by the per-centroid search this replaces
+            neighbours = np.delete(idx[first:last], np.argmin(dist[first:last]))
+            pt_offset = np.take(points, neighbours, axis=0) - flat_centroids[j]
+            k = j // F
+            along_normal = pt_offset @ flat_normals[k]
+            rows = (along_normal < fl / 2) & (along_normal > -fl / 2 - fw)
+            pt_offset, along_normal = pt_offset[rows], along_normal[rows]
+            # (R, points) so that the counts reduce contiguous rows
+            inside_thickness = np.abs(flat_principals[k] @ pt_offset.T) < ft / 2
+            along_cross = np.abs(flat_crosses[k] @ pt_offset.T)
+            between = (np.abs(along_normal) < fl / 2) & inside_thickness & (along_cross < fd / 2)
+            around = inside_thickness & (along_cross < fd / 2 + fw)
+            n_between[j] = np.count_nonzero(between, axis=1)
+            n_around[j] = np.count_nonzero(around, axis=1) - n_between[j]
+    return n_between.reshape(S, 2, F, R), n_around.reshape(S, 2, F, R)
+
+
 class Grasploc:
     def __init__(self, args):
         self.args = args
@@ -77,7 +151,6 @@ class Grasploc:
 
     def find_grasp1(self):
         self.pcd.estimate_normals()
-        pcd_tree = o3d.geometry.KDTreeFlann(self.pcd)
         ft, fd, fw, fl = self.args.finger_thickness, self.args.finger_max_distance, self.args.finger_width, self.args.finger_length
         # The minimum number of points that are required to be inside of a grasp
         self.downpcd = self.pcd.voxel_down_sample(voxel_size=self.args.grasp_sample_voxel_size)
@@ -85,66 +158,29 @@ class Grasploc:
             self.args.grasp_sample_voxel_size = self.args.grasp_sample_voxel_size*1.2
             self.downpcd = self.pcd.voxel_down_sample(voxel_size=self.args.grasp_sample_voxel_size)
         self.downpcd.paint_uniform_color([1, 0, 0])
-        # if self.args.vis_debug:
-        #     geoms = []
-        #     self.pcd.paint_uniform_color([0.8, 0.8, 0.8])
-        #     geoms.append(self.pcd)
-        #     geoms.append(self.downpcd)
-        #     o3d.visualization.draw_geometries(geoms, point_show_normal=True)
-        # for pt, nm in zip(self.pcd.points[::dr], self.pcd.normals[::dr]):
         print('num of samples:', len(self.downpcd.points))
         min_num_points_in_grasp = (fd*fl + fl*ft + fd*ft) / self.args.pcd_sample_voxel_size**2 * self.args.min_num_points_between_proportion
         min_num_points_in_grasp *= self.crop_factor / 2
+
+        # Every candidate is scored once, the passes below only relax the threshold.
+        centroids, normals, principals = grasp_frames(
+            np.asarray(self.downpcd.points), np.asarray(self.downpcd.normals), fl, self.args.rotation_sample)
+        n_between, n_around = count_grasp_points(
+            np.asarray(self.pcd.points), centroids, normals, principals, ft, fd, fw, fl,
+            chunk=self.args.grasp_search_chunk)
+        interfering_ok = n_around < self.args.max_num_points_intefering
+        if not np.any(interfering_ok & (n_between > 0)):
+            print('No grasp candidate has points between the fingers without interfering points')
+            return
         while len(self.grasp_points) <= 10:
-            for i, (pt, nm) in enumerate(zip(self.downpcd.points, self.downpcd.normals)):
-                print(i, '/', len(self.downpcd.points))
-                # grasp along negative normal, aka pointing inward object orthogonal to local surface
-                # do it for positive and negative direction as calculated normal is not always pointing inwards
-                for normal in [nm, -nm]:
-                    # create a cuboid of the volume between two fingers ((finger distance + 2*finger width) * finger_thickness * finger length), 
-                    # here finger distance can be 0-max distance
-                    # rotate about normal to find axis connecting two fingers that has blank space on both sides for fingers while has points between, 
-                    # (optional) the side surface direction should be consistent with finger's direction
-                    # 1. generate principal samples on orthogonal plane of normal
-                    normal = normal / np.linalg.norm(normal)
-                    finger_percents=[0.1, 0.2,0.4,0.5]
-                    for f_p in finger_percents:
-                        centroid = pt + fl*f_p * normal
-                        tmp = np.array([1, 0, 0])
-                        principal = tmp - np.dot(tmp, normal) * normal
-                        principal = principal / np.linalg.norm(principal)
-                        theta = np.pi * 2 / self.args.rotation_sample
-                        principals = [np.cos(i*theta) * principal + np.sin(i*theta) * np.cross(principal, normal) for i in range(self.args.rotation_sample)]
-                        principals = [p / np.linalg.norm(p) for p in principals]
-                        # 2. create cuboid along normal and principal direction, normal <-> finger length; principal <-> finger thickness; cross <-> grasp aperture
-                        # check point num between two fingers and on two sides
-                        radius = np.sqrt(ft**2 + (fd + 2*fw)**2 + fl**2) / 2
-                        _, idx, _ = pcd_tree.search_radius_vector_3d(centroid, radius=radius)
-                        pt_offset = np.asarray(self.pcd.points)[idx[1:], :] - centroid
-                        for principal in principals:
-                            cross = np.cross(normal, principal)
-                            # for aperture in np.linspace(self.args.min_grasp_distance, fd, 10):
-                            between_conditions = [np.abs(pt_offset @ normal) < fl / 2, np.abs(pt_offset @ principal) < ft / 2, np.abs(pt_offset @ cross) < fd / 2]
-                            # extend between area distance of finger width along +/-cross and -normal
-                            around_conditions = [pt_offset @ normal < fl / 2, pt_offset @ normal > -fl / 2 - fw, np.abs(pt_offset @ principal) < ft / 2, np.abs(pt_offset @ cross) < fd / 2 + fw]
-                            n_between = np.sum(np.bitwise_and.reduce(between_conditions))
-                            n_around = np.sum(np.bitwise_and.reduce(around_conditions)) - n_between
-                            # print(n_between, min_num_points_in_grasp, n_around, self.args.max_num_points_intefering)
-                            if n_between > min_num_points_in_grasp and n_around < self.args.max_num_points_intefering:
-                                grasp = GraspPoint(centroid, normal, principal, fd, None, None, [ft, fd, fl])
-                                self.grasp_points.append(grasp)
-                                # grasp.normal = -grasp.normal
-                                # grasp.principal = -grasp.principal
-                                # self.grasp_points.append(grasp)
-                                # print('found a grasp')
-                                # self.visual_check(grasp, vis_bbox=True)
+            # A pass keeps the grasps of the previous ones and adds the candidates
+            # passing its threshold, in the order of (sample, +/-normal, finger offset, rotation).
+            for s, n, f, r in zip(*np.nonzero((n_between > min_num_points_in_grasp) & interfering_ok)):
+                grasp = GraspPoint(centroids[s, n, f], normals[s, n], principals[s, n, r], fd, None, None, [ft, fd, fl])
+                self.grasp_points.append(grasp)
             if len(self.grasp_points)<=10:
                 min_num_points_in_grasp = min_num_points_in_grasp*0.5
                 print('Release the min_num_points_in_grasp to {}'.format(min_num_points_in_grasp))
-            elif len(self.grasp_points) == 0:
-                self.args.grasp_sample_voxel_size = self.args.grasp_sample_voxel_size*0.8
-                self.downpcd = self.pcd.voxel_down_sample(voxel_size=self.args.grasp_sample_voxel_size)
-                print('Grasp poses are too litte. Resample the point cloud with {}'.format(self.args.grasp_sample_voxel_size))
         print('grasp candidates:', len(self.grasp_points))
         
     def visual_check(self, grasp=None, vis_bbox=False):
@@ -213,7 +249,10 @@ class Grasploc:
             grasp_pose[:3, 2] = grasp.normal
             grasp_pose[:3, 1] = np.cross(grasp.normal, grasp.principal)
             self.se3_output.append(grasp_pose)
-        self.se3_output = np.array(self.se3_output)
+        # (0, 4, 4) when no grasp was found, so the offset below still applies.
+        self.se3_output = np.array(self.se3_output).reshape(-1, 4, 4)
+        if len(self.se3_output) == 0:
+            print('no grasp pose found for', self.args.input_file)
         if origin_offset is not None:
             self.se3_output = np.einsum('ij,kjl->kil', np.linalg.inv(origin_offset), self.se3_output)
         with open(self.args.output_file, 'wb') as f:
@@ -227,7 +266,23 @@ class Grasploc:
         print('grasp poses loaded from', self.args.output_file)
 
 
-def define_default_args():
+def run_grasploc(job):
+    """Runs the grasp search of one object, job is (args, origin_offset)."""
+    args, origin_offset = job
+    gl = Grasploc(args)
+    gl.run(origin_offset)
+    return gl.se3_output
+
+
+def run_grasploc_jobs(jobs, processes=1):
+    """se3_output of every (args, origin_offset) job, with one object per process."""
+    if processes <= 1:
+        return [run_grasploc(job) for job in jobs]
+    with Pool(processes) as pool:
+        return pool.map(run_grasploc, jobs)
+
+
+def define_default_args(argv=None):
     parser = argparse.ArgumentParser()
     # point cloud, grasp sample density
     parser.add_argument('--use_meshlab',type=lambda x:bool(strtobool(x)), default=True, help='whether use meshlab to sample the mesh')
@@ -243,6 +298,7 @@ def define_default_args():
     parser.add_argument('--finger_thickness', type=float, default=0.02, help='distance between front and back side of fingers')
     parser.add_argument('--rotation_sample', type=int, default=16, help='grasp sample rotated about normal axis')
     parser.add_argument('--finger_length', type=float, default=0.045, help='finger length')
+    parser.add_argument('--grasp_search_chunk', type=int, default=256, help='grasp centroids whose neighbours are searched at once')
     
     # input point cloud grasp search region
     parser.add_argument('--crop_x_min', type=float, default=-0.1, help='x min for cropping the point cloud')
@@ -261,7 +317,7 @@ def define_default_args():
     parser.add_argument('--meshlab_sampling_file', type=str, default='./tools/meshlab_stratified_sampling.mlx', help='sampling script using meshlab')
     parser.add_argument('--vis_debug', type=lambda x:bool(strtobool(x)), default=False, help='visualize temporary results for debugging')
     parser.add_argument('--frame_size', type=float, default=0.01, help='coordinate frame size in visualization')
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     return args
 
 
@@ -0,0 +1,53 @@
+from multiprocessing import Pool
+from os.path import join, dirname, abspath
+from pathlib import Path
+import sys
+CURRENT_DIR = dirname(abspath(__file__))
+sys.path.insert(0, join(CURRENT_DIR, '..'))  # Use local amsolver rather than installed
+from amsolver.backend.const import LOW_DIM_PICKLE
+from amsolver.episode_store import pack_episode
+
+from absl import app
+from absl import flags
+
+"""
+Pack every episodes/episodeN (and fail_cases/episodeN) folder of a dataset split
+into a single memory-mapped episode.pack, read by amsolver.episode_store.get_stored_demos_packed.
+"""
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('data_path',
+                    '/home/liuchang/DATA/rlbench_data/train',
+                    'The dataset split to pack.')
+flags.DEFINE_integer('processes', 8,
+                     'The number of parallel packing processes.')
+flags.DEFINE_bool('overwrite', False,
+                  'Repack episodes that already have an episode.pack.')
+
+
+def _pack(example_path):
+    try:
+        pack_episode(example_path, overwrite=FLAGS.overwrite)
+    except Exception as e:
+        return '%s: %s' % (example_path, e)
+    return None
+
+
+def main(argv):
+    episodes = sorted(str(p.parent) for p in Path(FLAGS.data_path).rglob(LOW_DIM_PICKLE))
+    print('Packing %d episodes from %s' % (len(episodes), FLAGS.data_path))
+    problems = []
+    with Pool(FLAGS.processes) as pool:
+        for i, problem in enumerate(pool.imap_unordered(_pack, episodes)):
+            if problem is not None:
+                problems.append(problem)
+            if (i + 1) % 100 == 0:
+                print('Packed %d/%d' % (i + 1, len(episodes)))
+    print('Packing done!')
+    for problem in problems:
+        print(problem)
+
+
+if __name__ == '__main__':
+  app.run(main)
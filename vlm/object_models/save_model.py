@@ -4,16 +4,21 @@ from pyrep.objects.shape import Shape
 from pyrep.pyrep import PyRep
 
 from amsolver.backend.utils import WriteCustomDataBlock, get_local_grasp_pose
+from tools.grasploc import run_grasploc_jobs
 
 class Model_Modifer(object):
-    def __init__(self, all_model_dir) -> None:
+    def __init__(self, all_model_dir, processes=1) -> None:
         super().__init__()
         self.pr = PyRep()
         self.pr.launch('', headless=True)
         self.all_model_dir = all_model_dir
+        # The meshes of the manipulated parts are exported from the scene first, then
+        # their grasp poses are searched in `processes` processes.
+        self.processes = processes
 
     def import_model(self, model_config):
         models = []
+        grasp_jobs = []
         class_name = model_config["class"]
         object_name = model_config["name"]
         save_path = os.path.join(self.all_model_dir, class_name, object_name)
@@ -28,8 +33,9 @@ class Model_Modifer(object):
                 grasp_mesh_path = os.path.join(save_path, f"{part_name}.ply")
                 # m["local_grasp_pose_path"] = grasp_mesh_path.replace('ply','pkl')
                 m["local_grasp_pose_path"] = f"{part_name}.pkl"
-                self.extra_grasp_poses(part, grasp_mesh_path)
+                self.extra_grasp_poses(part, grasp_mesh_path, grasp_jobs)
             models.append(part)
+        run_grasploc_jobs(grasp_jobs, self.processes)
         with open(os.path.join(save_path, f"{object_name}.json"), "w") as f:
             json.dump(model_config, f, indent=1)
         need_save_part = models[model_config["highest_part"]]
@@ -37,6 +43,7 @@ class Model_Modifer(object):
     
     def extra_from_ttm(self, model_config, ttm_path):
         self.pr.import_model(ttm_path)
+        grasp_jobs = []
         class_name = model_config["class"]
         object_name = model_config["name"]
         save_path = os.path.join(self.all_model_dir, class_name, object_name)
@@ -69,7 +76,8 @@ class Model_Modifer(object):
                 else:
                     grasp_mesh_path = os.path.join(save_path, f"{part_name}.ply")
                     m["local_grasp_pose_path"] = f"{part_name}.pkl"
-                self.extra_grasp_poses(part, grasp_mesh_path)
+                self.extra_grasp_poses(part, grasp_mesh_path, grasp_jobs)
+        run_grasploc_jobs(grasp_jobs, self.processes)
 
         with open(os.path.join(save_path, f"{object_name}.json"), "w") as f:
             json.dump(model_config, f, indent=1)
@@ -82,7 +90,7 @@ class Model_Modifer(object):
         need_save_part.save_model(os.path.join(save_path, f"{object_name}.ttm"))
 
     @staticmethod
-    def extra_grasp_poses(grasp_obj, mesh_path):
+    def extra_grasp_poses(grasp_obj, mesh_path, jobs=None):
         need_rebuild= True if not os.path.exists(mesh_path) else False
         crop_box = None
         for m in grasp_obj.get_objects_in_tree(exclude_base=True, first_generation_only=True):
@@ -90,7 +98,7 @@ class Model_Modifer(object):
                 crop_box = m
                 break
         grasp_pose = get_local_grasp_pose(grasp_obj, mesh_path, grasp_pose_path=os.path.dirname(mesh_path),
-                need_rebuild = need_rebuild, crop_box=crop_box, use_meshlab=True)
+                need_rebuild = need_rebuild, crop_box=crop_box, use_meshlab=True, jobs=jobs)
     
     def object_json(self):
         obj_property = {
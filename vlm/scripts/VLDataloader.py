@@ -1,15 +1,18 @@
 import os
-from random import sample
 import numpy as np
 from torch.utils.data import Dataset
 import torch
 import cv2
 from pathlib import Path
 import pickle
-from cliport.utils.utils import get_fused_heightmap
+from cliport.utils.utils import fuse_heightmaps
 pickle.DEFAULT_PROTOCOL=pickle.HIGHEST_PROTOCOL
 from amsolver.observation_config import ObservationConfig
 from amsolver.utils import get_stored_demos
+from amsolver.episode_store import get_stored_demos_packed
+from amsolver.low_dim_index import LowDimIndex
+from vlm.scripts.heightmap_cache import HeightmapCache
+from vlm.scripts.validity_index import ValidityIndex
 import time
 import copy
 from scipy.spatial.transform import Rotation as R
@@ -40,7 +43,6 @@ class VLM_dataset(Dataset):
             self.episode_list += self.fail_cases_list
         #only train selected tasks
 
-        self.valid_episodes, self.invalid_episodes = [],[]
         self.sample_numbers = sample_numbers
         self.random_sample = random_sample
         self.img_size = img_size
@@ -70,10 +72,21 @@ class VLM_dataset(Dataset):
         self.relative = False
         self.renew_obs = False
         self.add_low_lang = False
+        heightmap_cache = True
         if args is not None:
             self.relative = args.relative
             self.renew_obs = args.renew_obs
             self.add_low_lang = args.add_low_lang
+            heightmap_cache = getattr(args, 'heightmap_cache', True)
+        # fused maps of get_cliport_gt, kept next to the episodes
+        self.heightmap_cache = HeightmapCache(self.views, self.img_size) if heightmap_cache else None
+        # frame selection and ground truth never unpickle low_dim_obs.pkl
+        self.low_dim_index = LowDimIndex.open(self.dataset_path, self.episode_list)
+        # episodes with pick or place points out of the map bounds are left out upfront
+        self.validity = ValidityIndex.open(self.dataset_path, {'renew_obs': self.renew_obs},
+                                           self.episode_list, self.low_dim_index, self.episode_valid)
+        self.invalid_episodes = [e for e in self.episode_list if not self.validity[e]]
+        self.episode_list = [e for e in self.episode_list if self.validity[e]]
 
     def read_lists(self):
         tasks_list_path = self.dataset_path / '{}_list.pkl'.format(self.setd)#pkl的路径
@@ -107,18 +120,13 @@ class VLM_dataset(Dataset):
                 self.fail_cases_list = info_dict['fail_cases_list']
 
     def __getitem__(self, index):
-        if index in self.invalid_episodes:
-            index = sample(self.valid_episodes, 1)[0]
         episode = self.episode_list[index]
         variation_path = episode.parents[1]
         task_name = episode.parents[2]
         fail_cases = 'fail_cases' in str(episode)
 
-        low_dim_obs = self.dataset_path/episode/"low_dim_obs.pkl"#打开的是一条轨迹的episode
-        with open(low_dim_obs, 'rb') as f:
-            demo_temple = pickle.load(f)
-        
-        sequence_length = len(demo_temple._observations)
+        low_dim = self.low_dim_index[episode]
+        sequence_length = len(low_dim)
         obs_select_inds = np.arange(sequence_length)
         if self.sample_numbers:
             if self.random_sample:
@@ -127,33 +135,30 @@ class VLM_dataset(Dataset):
                 obs_select_inds = obs_select_inds[0:self.sample_numbers]
         split_by_waypoint = True
         if split_by_waypoint:
-            obs_select_inds = [0]
-            previous_waypoint="waypoint0"
-            self.all_waypoints = [previous_waypoint]
-            for i, obs in enumerate(demo_temple._observations):
-                if obs.current_waypoint_name == previous_waypoint:
-                    continue
-                else:
-                    previous_waypoint = obs.current_waypoint_name
-                    self.all_waypoints.append(previous_waypoint)
-                    obs_select_inds.append(i)
+            obs_select_inds = low_dim.waypoint_starts()
             # for i in range(len(obs_select_inds)):
             #     if i+1<len(obs_select_inds):
             #         random_i = np.random.randint(obs_select_inds[i], obs_select_inds[i+1])
             #     else:
             #         random_i = np.random.randint(obs_select_inds[i], sequence_length)
             #     obs_select_inds[i] = random_i
-        if self.preprocess:
+        bounds, pixel_size = self.map_bounds(episode)
+        maps = None
+        if self.heightmap_cache is not None:
+            maps = self.heightmap_cache.load(self.dataset_path/episode, obs_select_inds, bounds, pixel_size)
+        if maps is None and self.preprocess:
             preprocess_data_folder = self.dataset_path/episode/'preprocess_data'
 
             need_rebuild = False
             if not preprocess_data_folder.is_dir():
                 preprocess_data_folder.mkdir()
                 need_rebuild = True
-            if not hasattr(demo_temple, 'observation_config'):
+            config_path = preprocess_data_folder/'observation_config.pkl'
+            if not config_path.is_file():
                 need_rebuild = True
             else:
-                need_rebuild = not (demo_temple.observation_config == self.obs_config)
+                with open(config_path, 'rb') as f:
+                    need_rebuild = not (pickle.load(f) == self.obs_config)
             obs_list = os.listdir(preprocess_data_folder)
             if len(obs_list)<len(obs_select_inds):
                 need_rebuild=True
@@ -174,7 +179,7 @@ class VLM_dataset(Dataset):
             if need_rebuild:
                 episode_name = episode.name
                 variation_number = int(variation_path.name.replace('variation',''))
-                demos = get_stored_demos(1, False, self.dataset_path, variation_number, 
+                demos = get_stored_demos_packed(1, False, self.dataset_path, variation_number, 
                                     task_name, self.obs_config, episode_name, fail_cases)
                 data = demos[0]
                 obs = data._observations
@@ -183,59 +188,67 @@ class VLM_dataset(Dataset):
                     with open(file_name, 'wb') as f:
                         pickle.dump(obs[i], f)
                 print('Finish {} preprocess!'.format(episode))
-                demo_temple.observation_config = self.obs_config
-                with open(low_dim_obs, 'wb') as f:
-                    pickle.dump(demo_temple, f)
+                with open(config_path, 'wb') as f:
+                    pickle.dump(self.obs_config, f)
                 obs = [obs[i] for i in obs_select_inds]
-        else:
+        elif maps is None:
             # episode_number = int(episode.name.replace('episode',''))
             episode_name = episode.name
             variation_number = int(variation_path.name.replace('variation',''))
-            demos = get_stored_demos(1, False, self.dataset_path, variation_number, 
+            demos = get_stored_demos_packed(1, False, self.dataset_path, variation_number, 
                                     task_name, self.obs_config, episode_name, fail_cases, obs_select_inds)
             data = demos[0]
             obs = data._observations
             obs = [obs[i] for i in obs_select_inds]
-        output_dict = self.get_cliport_gt(obs, demo_temple.high_level_instructions, episode)
-        if output_dict['valid']:
-            self.valid_episodes.append(index)
-        else:
-            self.invalid_episodes.append(index)
-            if len(self.valid_episodes) == 0:
-                other_indexs = list(set(range(self.__len__())) - set(self.invalid_episodes))
-                valid_index = sample(other_indexs, 1)[0]
-            else:
-                valid_index = sample(self.valid_episodes, 1)[0]
-            output_dict = self.__getitem__(valid_index)
+        if maps is None:
+            maps = self.fuse_maps(obs, bounds, pixel_size)
+            if self.heightmap_cache is not None:
+                # Misses see the maps quantized as hits do, whether they could be cached or not.
+                maps = self.heightmap_cache.quantize(*maps)
+                self.heightmap_cache.save(self.dataset_path/episode, obs_select_inds, bounds, pixel_size, *maps)
+        objects = copy.deepcopy([low_dim.object_informations[i] for i in obs_select_inds])
+        output_dict = self.get_cliport_gt(maps, objects, low_dim.instructions, episode, low_dim.waypoints())
         return output_dict
 
-    def get_cliport_gt(self, data, languages, episode):
+    @staticmethod
+    def map_bounds(episode):
+        """Bounds and pixel size of the fused maps of an episode."""
         z_max = 1.2
         if 'door' in str(episode) or 'drawer' in str(episode):
             z_max = 1.8
         bounds = np.array([[-0.05,0.67],[-0.45, 0.45], [0.7, z_max]])
         pixel_size = 5.625e-3
+        return bounds, pixel_size
+
+    @staticmethod
+    def fuse_maps(obs, bounds, pixel_size):
+        """uint8 color and float32 height maps of the observations."""
+        colors = np.stack([[o.front_rgb, o.wrist_rgb, o.left_shoulder_rgb, o.right_shoulder_rgb, o.overhead_rgb]
+                           for o in obs])
+        pcds = np.stack([[o.front_point_cloud, o.wrist_point_cloud, o.left_shoulder_point_cloud,
+                          o.right_shoulder_point_cloud, o.overhead_point_cloud] for o in obs])
+        return fuse_heightmaps(colors, pcds, bounds, pixel_size)
+
+    def cliport_steps(self, objects, waypoints):
+        """[waypoint, frame, target object, related rotation] of every pick or place step of an episode.
+
+        objects: object informations of the frames where the waypoints start.
+        """
         target_obj = None
-        cmaps, hmaps = [], []
-        high_l = np.random.choice(languages, 1)[0]
-        if high_l[-1]!=".":
-            high_l+="."
-        language_instructions, target_points = [], []
-        attention_points = []
         step_list, point_list = [], []
-        attention_id = data[0].object_informations["waypoint0"]["target_obj"]
+        attention_id = objects[0]["waypoint0"]["target_obj"]
         step_img_id = 0
-        for i, wp in enumerate(self.all_waypoints):
-            waypoint_info = data[0].object_informations[wp]
+        for i, wp in enumerate(waypoints):
+            waypoint_info = objects[0][wp]
             waypoint_type = waypoint_info['waypoint_type']
             if "pre" in waypoint_type:
-                focus_wp = self.all_waypoints[i+1]
+                focus_wp = waypoints[i+1]
             elif "post" in waypoint_type:
-                focus_wp = self.all_waypoints[i-1]
+                focus_wp = waypoints[i-1]
             else:
                 focus_wp = wp
             if focus_wp not in point_list:
-                focus_info = data[0].object_informations[focus_wp]
+                focus_info = objects[0][focus_wp]
                 focus_type = focus_info['waypoint_type']
                 # attention_id = waypoint_info["target_obj"]
                 if "grasp" in focus_type:
@@ -249,34 +262,46 @@ class VLM_dataset(Dataset):
                     step_list.append([focus_wp, i, attention_id, related_rotation])
                 else:
                     step_list.append([focus_wp, step_img_id, attention_id, related_rotation])
-        
-        for i, step in enumerate(step_list):
-            # if i == 0:
-            #     continue
+
+        for step in step_list:
             current_waypoint, index, attention_id, related_rotation = step
-            obs = data[index]
-            waypoint_info = obs.object_informations[current_waypoint]
-            for name, obj in obs.object_informations.items():
+            for name, obj in objects[index].items():
                 if "id" in obj and "waypoint" not in name:
                     if obj["id"] == attention_id:
                         target_obj = name
-            front_rgb = obs.front_rgb
-            wrist_rgb = obs.wrist_rgb
-            left_rgb = obs.left_shoulder_rgb
-            right_rgb = obs.right_shoulder_rgb
-            overhead_rgb = obs.overhead_rgb
+            step[2] = target_obj
+        return step_list
 
-            front_point_cloud = obs.front_point_cloud
-            wrist_point_cloud = obs.wrist_point_cloud
-            left_point_cloud = obs.left_shoulder_point_cloud
-            right_point_cloud = obs.right_shoulder_point_cloud
-            overhead_point_cloud = obs.overhead_point_cloud
+    def episode_valid(self, episode, low_dim):
+        """Whether every pick and place point of get_cliport_gt lies within the map bounds."""
+        bounds, _ = self.map_bounds(episode)
+        objects = [low_dim.object_informations[i] for i in low_dim.waypoint_starts()]
+        points = []
+        for current_waypoint, index, target_obj, _ in self.cliport_steps(objects, low_dim.waypoints()):
+            points.append(objects[index][current_waypoint]["pose"][0][:2])
+            points.append(objects[index][target_obj]["pose"][:2])
+        points = np.array(points)
+        return not ((points > bounds[:2, 1]).any() or (points < bounds[:2, 0]).any())
+
+    def get_cliport_gt(self, maps, objects, languages, episode, waypoints):
+        """maps: fused (cmaps, hmaps) of the selected frames, see fuse_maps."""
+        bounds, pixel_size = self.map_bounds(episode)
+        cmaps, hmaps = [], []
+        high_l = np.random.choice(languages, 1)[0]
+        if high_l[-1]!=".":
+            high_l+="."
+        language_instructions, target_points = [], []
+        attention_points = []
+        step_list = self.cliport_steps(objects, waypoints)
 
-            colors = [front_rgb, wrist_rgb, left_rgb, right_rgb, overhead_rgb]
-            pcds = [front_point_cloud, wrist_point_cloud, left_point_cloud, right_point_cloud, overhead_point_cloud]
-            cmap, hmap = get_fused_heightmap(colors, pcds, bounds, pixel_size)
-            cmaps.append(cmap)
-            hmaps.append(hmap)
+        for i, step in enumerate(step_list):
+            # if i == 0:
+            #     continue
+            current_waypoint, index, target_obj, related_rotation = step
+            object_informations = objects[index]
+            waypoint_info = object_informations[current_waypoint]
+            cmaps.append(maps[0][index])
+            hmaps.append(maps[1][index].astype(np.float32))
             lang = high_l+f" Step {num2words(i)}."
             if self.add_low_lang:
                 lang += waypoint_info['low_level_descriptions']
@@ -284,13 +309,13 @@ class VLM_dataset(Dataset):
             # language_instructions.append(obs.object_informations[obs.current_waypoint_name]['low_level_descriptions'])
             target_point = waypoint_info["pose"][0]
             if related_rotation:
-                prev_target_pose = obs.object_informations[step_list[i-1][0]]["pose"][0]
+                prev_target_pose = object_informations[step_list[i-1][0]]["pose"][0]
                 prev_rot = R.from_quat(prev_target_pose[3:])
                 current_rot = R.from_quat(target_point[3:])
                 delta_r = prev_rot.inv()*current_rot
                 target_point[3:] = delta_r.as_quat()
             target_points.append(target_point)
-            attention_point = obs.object_informations[target_obj]["pose"]#[0]
+            attention_point = object_informations[target_obj]["pose"]#[0]
             attention_points.append(attention_point)
         cmaps = np.stack(cmaps, axis=0)
         hmaps = np.tile((np.stack(hmaps, axis=0))[..., None], (1,1,1,3))
@@ -12,13 +12,16 @@ import pickle
 from cliport.utils.utils import get_fused_heightmap
 from amsolver.observation_config import ObservationConfig
 from amsolver.utils import get_stored_demos,get_stored_demos_nodepth
+from amsolver.episode_store import get_stored_demos_packed
+from amsolver.low_dim_index import LowDimIndex
+from vlm.scripts.sample_store import SampleStore, finish_sample
 import time
 import copy
 from scipy.spatial.transform import Rotation as R
 from num2words import num2words
 pickle.DEFAULT_PROTOCOL=pickle.HIGHEST_PROTOCOL
 import random
-from vlm.scripts.utils import keypoint_discovery,mask_tokens,max_sperate_index
+from vlm.scripts.utils import mask_tokens,max_sperate_index
 from pytorch_transformers import  BertTokenizer
 # add hiverformer
 from torch.nn import functional as F
@@ -100,6 +103,12 @@ class VLM_dataset(Dataset):
             self.relative = args.relative
             self.renew_obs = args.renew_obs
             self.add_low_lang = args.add_low_lang
+        # frame selection never unpickles low_dim_obs.pkl
+        self.low_dim_index = LowDimIndex.open(self.dataset_path, self.episode_list)
+        # episodes built offline by vlm.scripts.sample_store only need to be mmapped and augmented
+        self.sample_store = None
+        if args is not None and not preprocess:
+            self.sample_store = SampleStore(self.dataset_path, self.cameras, self.mode, self.img_size)
         self.tokenizer = BertTokenizer.from_pretrained('/home/liuchang/projects/VLMbench/VLMbench/vlm/scripts/base-no-labels/ep_67_588997')
 
     def read_lists(self):
@@ -148,17 +157,19 @@ class VLM_dataset(Dataset):
         return output_dict
 
     def get_episode(self,episode,fake):
+        if self.sample_store is not None:
+            sample = self.sample_store.load(episode)
+            if sample is not None:
+                return finish_sample(*sample, self.args.maxAction, self._transform)
+
         variation_path = episode.parents[1]
         task_name = episode.parents[2]
         fail_cases = 'fail_cases' in str(episode)
 
-        low_dim_obs = self.dataset_path/episode/"low_dim_obs.pkl"
-        with open(low_dim_obs, 'rb') as f:
-            demo_temple = pickle.load(f)
-        
-        sequence_length = len(demo_temple._observations)
+        low_dim = self.low_dim_index[episode]
+        sequence_length = len(low_dim)
         obs_select_inds = np.arange(sequence_length)
-        lang = demo_temple.high_level_instructions[0]
+        lang = low_dim.instructions[0]
         
         if self.sample_numbers:
             if self.random_sample:
@@ -169,19 +180,9 @@ class VLM_dataset(Dataset):
         # 根据watpoints切分
         # obs_select_inds：选择出每个waypoint的开始index
         if split_by_waypoint:
-            # lang = demo_temple.high_level_instructions[0]
-            obs_select_inds = [0]
-            previous_waypoint="waypoint0"
             # all_way_points只存了分割点的waypoint
-            self.all_waypoints = [previous_waypoint]
-            for i, obs in enumerate(demo_temple._observations):
-                if obs.current_waypoint_name == previous_waypoint:
-                    continue
-                else:
-                    previous_waypoint = obs.current_waypoint_name
-                    self.all_waypoints.append(previous_waypoint)
-                    obs_select_inds.append(i)
-                    # lang+=str(f" Step {num2words(obs_select_inds.index(i))}:"+obs.low_level_description)
+            obs_select_inds = low_dim.waypoint_starts()
+            self.all_waypoints = low_dim.waypoints()
         if self.preprocess:
             preprocess_data_folder = self.dataset_path/episode/'preprocess_data'
 
@@ -189,10 +190,12 @@ class VLM_dataset(Dataset):
             if not preprocess_data_folder.is_dir():
                 preprocess_data_folder.mkdir()
                 need_rebuild = True
-            if not hasattr(demo_temple, 'observation_config'):
+            config_path = preprocess_data_folder/'observation_config.pkl'
+            if not config_path.is_file():
                 need_rebuild = True
             else:
-                need_rebuild = not (demo_temple.observation_config == self.obs_config)
+                with open(config_path, 'rb') as f:
+                    need_rebuild = not (pickle.load(f) == self.obs_config)
             obs_list = os.listdir(preprocess_data_folder)
             if len(obs_list)<len(obs_select_inds):
                 need_rebuild=True
@@ -213,7 +216,7 @@ class VLM_dataset(Dataset):
             if need_rebuild:
                 episode_name = episode.name
                 variation_number = int(variation_path.name.replace('variation',''))
-                demos = get_stored_demos(1, False, self.dataset_path, variation_number, 
+                demos = get_stored_demos_packed(1, False, self.dataset_path, variation_number, 
                                     task_name, self.obs_config, episode_name, fail_cases)
                 data = demos[0]
                 obs = data._observations
@@ -222,32 +225,17 @@ class VLM_dataset(Dataset):
                     with open(file_name, 'wb') as f:
                         pickle.dump(obs[i], f)
                 print('Finish {} preprocess!'.format(episode))
-                demo_temple.observation_config = self.obs_config
-                with open(low_dim_obs, 'wb') as f:
-                    pickle.dump(demo_temple, f)
+                with open(config_path, 'wb') as f:
+                    pickle.dump(self.obs_config, f)
                 obs = [obs[i] for i in obs_select_inds]
         else:
             # episode_number = int(episode.name.replace('episode',''))
             episode_name = episode.name
             variation_number = int(variation_path.name.replace('variation',''))
 
-            if self.mode == 'waypoint':
-                key_frames = obs_select_inds
-            else:
-                key_frames = keypoint_discovery(demo_temple._observations)
-
-            select_frames=[]
-
             # 获取抽样轨迹  
             max_traj_len= self.args.maxAction
-            if 0 not in key_frames:
-                select_frames.append(0)
-            for frame in key_frames:
-                if frame not in select_frames:
-                    select_frames.append(frame)
-            # add end obs to max_traj_len
-            if (sequence_length-1) not in select_frames:
-                select_frames.append(sequence_length-1)
+            select_frames = self.select_frames(low_dim)
             
             # if self.mode == 'keyframe':
             #     sperate_index = max_sperate_index(select_frames)
@@ -261,7 +249,7 @@ class VLM_dataset(Dataset):
 
             valid_action_length = len(select_frames) - 1
 
-            demos = get_stored_demos(1, False, self.dataset_path, variation_number, 
+            demos = get_stored_demos_packed(1, False, self.dataset_path, variation_number, 
                                      task_name, self.obs_config , episode_name,selected_frame=select_frames)   
 
             rgbs = torch.Tensor([])
@@ -349,6 +337,30 @@ class VLM_dataset(Dataset):
             }
             return output_dict
     
+    def select_frames(self, low_dim):
+        """Frames of the sample of an episode: the first one, the key frames (the
+        waypoint starts in waypoint mode) and the last one."""
+        if self.mode == 'waypoint':
+            key_frames = low_dim.waypoint_starts()
+        else:
+            key_frames = low_dim.keypoints
+
+        select_frames=[]
+        if 0 not in key_frames:
+            select_frames.append(0)
+        for frame in key_frames:
+            if frame not in select_frames:
+                select_frames.append(frame)
+        # add end obs to max_traj_len
+        if (len(low_dim)-1) not in select_frames:
+            select_frames.append(len(low_dim)-1)
+        return select_frames
+
+    def valid_lengths(self):
+        """valid_length of the sample of every episode, from the low dimensional index only."""
+        return [min(len(self.select_frames(self.low_dim_index[episode])) - 1, self.args.maxAction)
+                for episode in self.episode_list]
+
     @staticmethod
     def depth2normal(d_im):
         d_im = d_im.astype("float32")
@@ -0,0 +1,95 @@
+"""
+Batches of VLM_dataset samples for the cliport baselines.
+
+CliportCollate builds the input of TransporterAgent_6Dof.forward out of a
+list of samples, so that it runs in the DataLoader workers rather than on
+the training process: the images are concatenated into one contiguous
+float32 tensor (pinned by the DataLoader with pin_memory), the pick and
+place points are converted to pixels, heights and euler angles in one go.
+The pixels, heights and angles stay numpy arrays, the agents build their
+labels and crops from them on the host.
+
+prefetch_to_device then copies the images of the next batch to the GPU on
+a side stream while the current batch is used.
+"""
+from contextlib import nullcontext
+
+import numpy as np
+import torch
+from scipy.spatial.transform import Rotation as R
+
+
+class CliportCollate(object):
+    """Collate function of VLM_dataset for the cliport agents, picklable for the DataLoader workers.
+
+    Bounds and pixel size are the ones of the first sample, as the training
+    loop always did. `euler` is the scipy sequence of the rotation labels.
+    """
+
+    def __init__(self, euler='zyx'):
+        self.euler = euler
+
+    def __call__(self, batch):
+        if len(batch) == 0:
+            return None
+        bounds, pixel_size = batch[0]['bounds'], batch[0]['pixel_size']
+        img = np.concatenate([data['img'] for data in batch], axis=0)
+        attention_points = np.concatenate([data['attention_points'] for data in batch], axis=0)
+        target_points = np.concatenate([data['target_points'] for data in batch], axis=0)
+        language_instructions = []
+        for data in batch:
+            language_instructions += data['language']
+
+        in_bounds = not ((attention_points[:, :2] > bounds[:2, 1]).any() or (attention_points[:, :2] < bounds[:2, 0]).any()
+                         or (target_points[:, :2] > bounds[:2, 1]).any() or (target_points[:, :2] < bounds[:2, 0]).any())
+        # (row, column) pixels
+        p0 = np.ascontiguousarray(np.int16((attention_points[:, :2] - bounds[:2, 0]) / pixel_size)[:, ::-1])
+        p1 = np.ascontiguousarray(np.int16((target_points[:, :2] - bounds[:2, 0]) / pixel_size)[:, ::-1])
+        rotations = R.from_quat(np.concatenate([attention_points[:, 3:], target_points[:, 3:]], axis=0))
+        p0_rotation, p1_rotation = np.split(rotations.as_euler(self.euler, degrees=True), 2)
+
+        return {'img': torch.from_numpy(img.astype(np.float32)),
+                'lang_goal': language_instructions,
+                'p0': p0, 'p0_z': attention_points[:, 2:3] - bounds[2, 0], 'p0_rotation': p0_rotation,
+                'p1': p1, 'p1_z': target_points[:, 2:3] - bounds[2, 0], 'p1_rotation': p1_rotation,
+                'in_bounds': in_bounds}
+
+
+def _to_device(batch, device):
+    return {k: v.to(device, non_blocking=True) if torch.is_tensor(v) else v for k, v in batch.items()}
+
+
+def prefetch_to_device(batches, device):
+    """Yields the batches (None for empty ones) with their tensors on device.
+
+    On a GPU the copy of batch n+1 is queued on a side stream before batch n
+    is handed out, so it overlaps the step on batch n when the tensors are
+    pinned.
+    """
+    device = torch.device(device)
+    stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+    pending = None
+    for batch in batches:
+        ready = None
+        if batch is not None:
+            with torch.cuda.stream(stream) if stream is not None else nullcontext():
+                batch = _to_device(batch, device)
+                if stream is not None:
+                    ready = torch.cuda.Event()
+                    ready.record(stream)
+        if pending is not None:
+            yield _wait(*pending, device)
+        pending = (batch, ready)
+    if pending is not None:
+        yield _wait(*pending, device)
+
+
+def _wait(batch, ready, device):
+    if ready is not None:
+        current = torch.cuda.current_stream(device)
+        current.wait_event(ready)
+        for value in batch.values():
+            if torch.is_tensor(value):
+                # The side stream allocated them, keep them until the step is done.
+                value.record_stream(current)
+    return batch
@@ -76,7 +76,8 @@ class CliportAgent(object):
                 'trans_stream_fusion_type': 'conv',
                 'lang_fusion_type': 'mult',
                 'n_rotations':36,
-                'batchnorm':False
+                'batchnorm':False,
+                'attn_rotation_chunk':12  # rotations per attention pass at inference
             }
         }
         device = torch.device(device_id)
@@ -0,0 +1,197 @@
+from collections import namedtuple
+import os
+import zlib
+from time import time, sleep
+from os.path import join, dirname, abspath, exists
+import sys
+CURRENT_DIR = dirname(abspath(__file__))
+sys.path.insert(0, join(CURRENT_DIR, '../..'))  # For tools, as vlm_test.py is run from anywhere
+
+import numpy as np
+
+from tools.generation_scheduler import Dispatcher, Ledger
+
+"""
+Work-queue scheduler for the evaluation of vlm_test.py.
+
+Every test episode (a configs.pkl folder of load_test_config) is one item.
+A dispatcher in the main process (tools/generation_scheduler.Dispatcher)
+hands items to long-lived evaluator processes, each with its own simulator
+and agent, one at a time and preferably of the task the process evaluated last, so a process rarely
+has to switch tasks. Every result is appended to a json-lines ledger (see
+tools/generation_scheduler.Ledger) in the output folder, and a run that
+died is resumed by evaluating only the episodes that are not done. An
+episode whose evaluation raised is retried up to `max_retries` times, then
+counted as a failure; a process that dies is replaced, unless it died
+`max_retries` times in a row without evaluating an episode.
+
+An evaluator, built once per process by `make_evaluator(worker_id)`, does
+the simulator work:
+    evaluate(task, episode) -> {'success': bool, 'grasp_success': bool, 'steps': int, ...}
+    shutdown()
+
+FakeEvaluator stands in for the simulator and the agent, to run the
+scheduler without CoppeliaSim:
+    python vlm/scripts/eval_scheduler.py --output_path /tmp/fake_eval --processes 4
+"""
+
+LEDGER_FILE = 'eval_ledger.jsonl'
+
+EvalItem = namedtuple('EvalItem', ['task', 'episode'])
+
+
+def item_key(item):
+    return '%s:%s' % (item.task, item.episode)
+
+
+def _evaluate(evaluator, item):
+    return dict(evaluator.evaluate(item.task, item.episode))
+
+
+def aggregate(ledger, items=None):
+    """{task: {'episodes', 'success', 'grasp_success', 'success_rate', 'grasp_success_rate'}}
+    of the done `items` (default: every done item of the ledger), with the totals under None."""
+    if items is None:
+        keys = [key for key, state in ledger.states.items() if state == 'done']
+    else:
+        keys = [item_key(item) for item in items if ledger.done(item_key(item))]
+    stats = {}
+    for key in keys:
+        info = ledger.infos[key]
+        for task in (info['task'], None):
+            s = stats.setdefault(task, {'episodes': 0, 'success': 0, 'grasp_success': 0})
+            s['episodes'] += 1
+            s['success'] += int(info['success'])
+            s['grasp_success'] += int(info['grasp_success'])
+    for s in stats.values():
+        s['success_rate'] = s['success'] / s['episodes']
+        s['grasp_success_rate'] = s['grasp_success'] / s['episodes']
+    return stats
+
+
+class EvalScheduler(Dispatcher):
+    """Dispatches (task, episode) items to evaluator processes."""
+
+    def __init__(self, output_path, items, make_evaluator, processes, max_retries=2, report_every=60.):
+        super(EvalScheduler, self).__init__(make_evaluator, _evaluate, processes, max_retries=max_retries,
+                                            report_every=report_every, same_task_first=True)
+        self.output_path = output_path
+        self.items = list(items)
+        self.problems = []
+        self.evaluated = 0
+
+    def item_key(self, item):
+        return item_key(item)
+
+    def done(self, worker_id, item, info):
+        self.ledger.record(item_key(item), 'done', worker=worker_id,
+                           task=item.task, episode=item.episode, **info)
+        self.evaluated += 1
+        return []
+
+    def give_up(self, worker_id, item, error, attempts):
+        key = item_key(item)
+        # Counted as a failed episode rather than left out of the rates.
+        self.ledger.record(key, 'done', worker=worker_id, task=item.task, episode=item.episode,
+                           success=False, grasp_success=False, steps=0, error=error)
+        self.problems.append('%s failed %d times, last error: %s' % (key, attempts, error))
+        print(self.problems[-1])
+
+    def run(self):
+        """Evaluates the items not done yet; returns the aggregate of all the items."""
+        if not exists(self.output_path):
+            os.makedirs(self.output_path)
+        self.ledger = Ledger(join(self.output_path, LEDGER_FILE))
+        self.evaluated = 0
+        items = [item for item in self.items if not self.ledger.done(item_key(item))]
+        left = self.dispatch(items, processes=min(self.processes, len(items)))
+        if left:
+            self.problems.append('No process left, %d episodes not evaluated' % left)
+            print(self.problems[-1])
+        stats = aggregate(self.ledger, self.items)
+        self.ledger.close()
+        return stats
+
+    def report(self, pending, inflight):
+        minutes = max(time() - self.started, 1e-6) / 60.
+        print('Evaluated %d episodes in %.1f min (%.1f episodes/min), %d pending, %d in flight' % (
+            self.evaluated, minutes, self.evaluated / minutes, pending, inflight))
+
+
+def format_stats(stats):
+    """Lines of the success and grasp success rates of every task, then of all of them."""
+    lines = []
+    for task in sorted(t for t in stats if t is not None) + [None]:
+        if task not in stats:
+            continue
+        s = stats[task]
+        lines.append('%s: grasp success: %d, success: %d, total %d episodes, '
+                     'grasp success rate: %.2f%%, success rate: %.2f%%' % (
+                         'all' if task is None else task, s['grasp_success'], s['success'], s['episodes'],
+                         s['grasp_success_rate'] * 100, s['success_rate'] * 100))
+    return lines
+
+
+class FakeEvaluator(object):
+    """Evaluates fake episodes: a task load on switches and maxAction fake steps."""
+
+    def __init__(self, max_action=3, success_rate=0.5, grasp_rate=0.7, error_rate=0., crash_rate=0.,
+                 step_time=0.02, load_time=0.1):
+        self.max_action = max_action
+        self.success_rate = success_rate
+        self.grasp_rate = grasp_rate
+        self.error_rate = error_rate
+        self.crash_rate = crash_rate
+        self.step_time = step_time
+        self.load_time = load_time
+        self.task = None
+
+    def evaluate(self, task, episode):
+        if np.random.rand() < self.crash_rate:
+            os._exit(1)  # A simulator crash takes the whole process down.
+        if np.random.rand() < self.error_rate:
+            raise RuntimeError('Fake configuration error')
+        if task != self.task:
+            sleep(self.load_time)
+            self.task = task
+        # The outcome only depends on the episode, as with a deterministic agent.
+        rng = np.random.RandomState(zlib.crc32(item_key(EvalItem(task, episode)).encode()))
+        grasp_success = bool(rng.rand() < self.grasp_rate)
+        success = grasp_success and bool(rng.rand() < self.success_rate / self.grasp_rate)
+        steps = self.max_action if not success else rng.randint(1, self.max_action + 1)
+        sleep(self.step_time * steps)
+        return {'success': success, 'grasp_success': grasp_success, 'steps': steps}
+
+    def shutdown(self):
+        pass
+
+
+def main(argv):
+    from absl import flags
+    FLAGS = flags.FLAGS
+
+    def make_evaluator(worker_id):
+        np.random.seed((os.getpid() * 7919 + worker_id) % 2 ** 32)
+        return FakeEvaluator(error_rate=FLAGS.error_rate, crash_rate=FLAGS.crash_rate,
+                             step_time=FLAGS.step_time)
+
+    items = [EvalItem(task, 'fake/%s/variation%d/episodes/episode%d' % (task, e % 3, e))
+             for task in FLAGS.tasks for e in range(FLAGS.episodes_per_task)]
+    scheduler = EvalScheduler(FLAGS.output_path, items, make_evaluator, FLAGS.processes,
+                              report_every=FLAGS.report_every)
+    stats = scheduler.run()
+    print('\n'.join(format_stats(stats)))
+
+
+if __name__ == '__main__':
+    from absl import app
+    from absl import flags
+    flags.DEFINE_string('output_path', '/tmp/fake_eval', 'Where to keep the results.')
+    flags.DEFINE_list('tasks', ['pick_cube_color', 'open_drawer'], 'Fake task names.')
+    flags.DEFINE_integer('processes', 4, 'The number of parallel processes.')
+    flags.DEFINE_integer('episodes_per_task', 20, 'Test episodes per task.')
+    flags.DEFINE_float('error_rate', 0., 'Chance a fake evaluation raises.')
+    flags.DEFINE_float('crash_rate', 0., 'Chance a fake process dies on an episode.')
+    flags.DEFINE_float('step_time', 0.02, 'Seconds per fake step.')
+    flags.DEFINE_float('report_every', 5., 'Seconds between throughput reports.')
+    app.run(main)
@@ -0,0 +1,293 @@
+"""
+Preprocessed hiveformer samples of VLM_dataset (renjie variant).
+
+Everything `VLM_dataset.get_episode` computes before the random crop only
+depends on the episode, so it is built once per episode into a pack file
+(see amsolver.episode_store) next to the episode:
+    rgb    uint8   T, N, H, W, 3   left_shoulder, right_shoulder, wrist
+    pcd    float32 T, N, H, W, 3
+    states float64 T+1, 8          gripper pose and open state of every selected frame
+    uv     int64   T, C, 2         gripper projection for every camera of `cameras`
+and a json manifest of the split lists the episodes that were built. At
+train time a sample is memory-mapped and only normalised, padded and
+augmented by `finish_sample`.
+
+The build is incremental: an episode is rebuilt only when the stamp (mtime
+and size) of its low_dim_obs.pkl, episode.pack or image folders changed.
+    python -m vlm.scripts.sample_store --data_dir /path/to/train --processes 8
+"""
+import hashlib
+import json
+import os
+import pickle
+from collections import OrderedDict
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import tap
+import torch
+from torch.nn import functional as F
+from tqdm import tqdm
+
+from amsolver.backend.const import LOW_DIM_PICKLE
+from amsolver.episode_store import get_stored_demos_packed, read_pack, write_pack
+from amsolver.episode_store import source_stamp as episode_source_stamp
+from amsolver.observation_config import ObservationConfig
+from hiverformer.utils import obs_to_attn
+from amsolver.keypoints import episode_keypoints
+
+SAMPLE_VERSION = 1
+SAMPLE_CAMERAS = ['left_shoulder', 'right_shoulder', 'wrist']
+MAX_OPEN_SAMPLES = 256
+
+
+def sample_key(cameras: Sequence[str], mode: str, img_size: Sequence[int]) -> str:
+    """Short key of everything a sample depends on besides the episode itself."""
+    config = json.dumps([SAMPLE_VERSION, list(cameras), mode, list(img_size)])
+    return hashlib.sha1(config.encode('utf-8')).hexdigest()[:10]
+
+
+def sample_path(example_path: Path, key: str) -> Path:
+    return Path(example_path) / f'hiveformer_{key}.pack'
+
+
+def manifest_path(dataset_path: Path, key: str) -> Path:
+    return Path(dataset_path) / f'hiveformer_samples_{key}.json'
+
+
+def source_stamp(example_path: Path) -> List[Tuple[str, int, int]]:
+    """(name, mtime, size) of every source a sample is built from."""
+    return episode_source_stamp(example_path, SAMPLE_CAMERAS)
+
+
+def make_obs_config(img_size: Sequence[int]) -> ObservationConfig:
+    """Only what a sample needs: rgb and point cloud of SAMPLE_CAMERAS and low dim state."""
+    obs_config = ObservationConfig()
+    obs_config.set_all(True)
+    for cam in ['left_shoulder', 'right_shoulder', 'overhead', 'wrist', 'front']:
+        camera = getattr(obs_config, f'{cam}_camera')
+        camera.image_size = img_size
+        if cam in SAMPLE_CAMERAS:
+            camera.depth = False
+            camera.mask = False
+        else:
+            camera.set_all(False)
+    return obs_config
+
+
+def select_frames(example_path: Path, demo, mode: str) -> List[int]:
+    """Start of the episode, its keyframes (or waypoints) and its last frame."""
+    if mode == 'waypoint':
+        key_frames = [0]
+        previous_waypoint = "waypoint0"
+        for i, obs in enumerate(demo._observations):
+            if obs.current_waypoint_name != previous_waypoint:
+                previous_waypoint = obs.current_waypoint_name
+                key_frames.append(i)
+    else:
+        key_frames = episode_keypoints(example_path, demo._observations)
+
+    frames = [] if 0 in key_frames else [0]
+    for frame in key_frames:
+        if frame not in frames:
+            frames.append(frame)
+    if len(demo) - 1 not in frames:
+        frames.append(len(demo) - 1)
+    return frames
+
+
+def build_sample(dataset_path: Path, episode: Path, obs_config: ObservationConfig,
+                 cameras: Sequence[str], mode: str) -> Tuple[Dict, Dict[str, np.ndarray]]:
+    """Header and arrays of the deterministic part of a sample."""
+    with open(Path(dataset_path) / episode / LOW_DIM_PICKLE, 'rb') as f:
+        demo = pickle.load(f)
+    frames = select_frames(Path(dataset_path) / episode, demo, mode)
+
+    variation_number = int(episode.parents[1].name.replace('variation', ''))
+    demos = get_stored_demos_packed(1, False, dataset_path, variation_number,
+                                    episode.parents[2], obs_config, episode.name,
+                                    'fail_cases' in str(episode), selected_frame=frames)
+    obs = [demos[0]._observations[f] for f in frames]
+
+    arrays = OrderedDict()
+    arrays['rgb'] = np.stack([
+        np.stack([getattr(o, f'{cam}_rgb') for cam in SAMPLE_CAMERAS]) for o in obs[:-1]])
+    arrays['pcd'] = np.stack([
+        np.stack([getattr(o, f'{cam}_point_cloud') for cam in SAMPLE_CAMERAS]) for o in obs[:-1]
+    ]).astype(np.float32)
+    arrays['states'] = np.stack([np.append(o.gripper_pose, o.gripper_open) for o in obs]).astype(np.float64)
+    arrays['uv'] = np.array(
+        [[obs_to_attn(o, cam) for cam in cameras] for o in obs[:-1]], dtype=np.int64
+    ).reshape(len(obs) - 1, len(cameras), 2)
+
+    header = {
+        'version': SAMPLE_VERSION,
+        'language': str(demo.high_level_instructions[0]),
+        'task': str(episode.parents[2]),
+        'frames': [int(f) for f in frames],
+    }
+    return header, arrays
+
+
+def finish_sample(header: Dict, arrays: Dict[str, np.ndarray], max_traj_len: int,
+                  transform=None) -> Dict:
+    """Normalise, pad and augment a sample, as the output of VLM_dataset.get_episode."""
+    states = torch.from_numpy(np.array(arrays['states']))
+    valid_action_length = len(states) - 1
+    action = states[1:]         # except for the start index action
+    gripper = states[:-1]       # except for the end index action
+
+    rgbs = torch.from_numpy(np.array(arrays['rgb'])).float().permute(0, 1, 4, 2, 3)
+    pcds = torch.from_numpy(np.array(arrays['pcd'])).permute(0, 1, 4, 2, 3)
+    # normalise to [-1, 1]
+    rgbs = rgbs / 255.0
+    rgbs = 2 * (rgbs - 0.5)
+
+    pad_len = max_traj_len - valid_action_length
+    padding_mask = torch.tensor([True] * valid_action_length + [False] * pad_len)
+
+    # padding
+    img_pad_vec = [0, 0] * rgbs.dim()
+    img_pad_vec[-1] = pad_len
+    rgbs = F.pad(rgbs, img_pad_vec, value=0)
+    pcds = F.pad(pcds, img_pad_vec, value=0)
+
+    action_pad_vec = [0, 0] * action.dim()
+    action_pad_vec[-1] = pad_len
+    action = F.pad(action, action_pad_vec, value=0)
+    gripper = F.pad(gripper, action_pad_vec, value=0)
+
+    # one-hot gripper attention of every camera, num cameras 1 128 128
+    uv = torch.from_numpy(np.array(arrays['uv']))
+    t, c = uv.shape[:2]
+    attns = torch.zeros((t, c, 1, 128, 128))
+    u, v = uv[..., 0], uv[..., 1]
+    inside = (u >= 0) & (u <= 127) & (v >= 0) & (v <= 127)
+    ti, ci = torch.nonzero(inside, as_tuple=True)
+    attns[ti, ci, 0, v[inside], u[inside]] = 1
+    pad_vec = [0] * (2 * attns.dim())
+    pad_vec[-1] = pad_len
+    attns = F.pad(attns, pad_vec)
+    rgbs = torch.cat([rgbs, attns], 2)
+
+    # data augmentation
+    if transform is not None:
+        modals = transform(rgbs=rgbs, pcds=pcds)
+        rgbs = modals["rgbs"]
+        pcds = modals["pcds"]
+
+    return {
+        # instruction
+        "language": header['language'],
+        # img and pcd
+        "rgbs": rgbs,
+        "pcds": pcds,
+        # state
+        "action": action,
+        "gripper": gripper,
+        # others
+        "padding_mask": padding_mask,
+        "valid_length": valid_action_length,
+        "task": header['task'],
+    }
+
+
+class SampleStore:
+    """Memory-mapped samples of the episodes listed in the manifest of a split."""
+
+    def __init__(self, dataset_path: Path, cameras: Sequence[str], mode: str, img_size: Sequence[int]):
+        self.dataset_path = Path(dataset_path)
+        self.key = sample_key(cameras, mode, img_size)
+        path = manifest_path(self.dataset_path, self.key)
+        self.episodes = set()
+        if path.is_file():
+            with open(path) as f:
+                self.episodes = set(json.load(f)['episodes'])
+        self._open: "OrderedDict[str, Tuple[Dict, Dict[str, np.ndarray]]]" = OrderedDict()
+
+    def __contains__(self, episode) -> bool:
+        return str(episode) in self.episodes
+
+    def __len__(self) -> int:
+        return len(self.episodes)
+
+    def load(self, episode) -> Optional[Tuple[Dict, Dict[str, np.ndarray]]]:
+        name = str(episode)
+        if name not in self.episodes:
+            return None
+        if name in self._open:
+            self._open.move_to_end(name)
+            return self._open[name]
+        sample = read_pack(sample_path(self.dataset_path / name, self.key))
+        self._open[name] = sample
+        if len(self._open) > MAX_OPEN_SAMPLES:
+            self._open.popitem(last=False)
+        return sample
+
+
+def _build(job) -> Tuple[str, str]:
+    dataset_path, episode, cameras, mode, img_size, key, overwrite = job
+    path = sample_path(dataset_path / episode, key)
+    stamp = [list(s) for s in source_stamp(dataset_path / episode)]
+    if path.is_file() and not overwrite:
+        try:
+            if read_pack(path)[0].get('stamp') == stamp:
+                return str(episode), 'skipped'
+        except (RuntimeError, ValueError, KeyError):
+            pass
+    try:
+        header, arrays = build_sample(dataset_path, episode, make_obs_config(img_size), cameras, mode)
+    except Exception as e:
+        return str(episode), f'failed: {e}'
+    header['stamp'] = stamp
+    write_pack(path, arrays, header)
+    return str(episode), 'built'
+
+
+def build_samples(dataset_path: Path, cameras: Sequence[str], mode: str, img_size: Sequence[int],
+                  processes: int = 8, overwrite: bool = False) -> Path:
+    """Builds the samples of every episode of a split in parallel and writes its manifest."""
+    dataset_path = Path(dataset_path)
+    key = sample_key(cameras, mode, img_size)
+    episodes = sorted(p.parent.relative_to(dataset_path) for p in dataset_path.rglob(LOW_DIM_PICKLE))
+    jobs = [(dataset_path, e, list(cameras), mode, list(img_size), key, overwrite) for e in episodes]
+
+    built, status = [], {}
+    with Pool(processes) as pool:
+        for episode, result in tqdm(pool.imap_unordered(_build, jobs), total=len(jobs)):
+            status[result.split(':')[0]] = status.get(result.split(':')[0], 0) + 1
+            if result.startswith('failed'):
+                print(episode, result)
+            else:
+                built.append(episode)
+
+    path = manifest_path(dataset_path, key)
+    manifest = {
+        'version': SAMPLE_VERSION,
+        'cameras': list(cameras),
+        'mode': mode,
+        'img_size': list(img_size),
+        'episodes': sorted(built),
+    }
+    tmp = path.with_suffix(f'.{os.getpid()}.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp, path)
+    print(', '.join(f'{n} {s}' for s, n in sorted(status.items())))
+    return path
+
+
+class Arguments(tap.Tap):
+    data_dir: Path
+    cameras: List[str] = ['left_shoulder', 'right_shoulder', 'wrist']
+    mode: str = 'keyframe'
+    img_size: List[int] = [128, 128]
+    processes: int = 8
+    overwrite: bool = False
+
+
+if __name__ == "__main__":
+    args = Arguments().parse_args()
+    print(f"Manifest written to {build_samples(args.data_dir, args.cameras, args.mode, args.img_size, args.processes, args.overwrite)}")
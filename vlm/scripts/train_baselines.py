@@ -3,8 +3,6 @@ from email.policy import strict
 import os
 from pickle import NONE
 import time
-import numpy as np
-from scipy.spatial.transform import Rotation as R
 import torch
 from torch._C import device
 import torch.multiprocessing as mp
@@ -26,6 +24,7 @@ import torch.nn.functional as F
 
 from vlm.scripts.VLDataloader import VLM_dataset
 from vlm.scripts.eval_sampler import DistributedEvalSampler
+from vlm.scripts.cliport_batch import CliportCollate, prefetch_to_device
 
 class AverageMeter(object):
     """Computes and stores the average and current value"""
@@ -50,9 +49,6 @@ class AverageMeter(object):
         fmtstr = '{name} {val' + self.fmt + '} ({avg' + self.fmt + '})'
         return fmtstr.format(**self.__dict__)
 
-def collate_fn(batch):
-    return batch
-
 def save_checkpoint(state, is_best, filename='checkpoint.pth'):
     torch.save(state, filename+'.pth')
     if is_best:
@@ -143,7 +139,8 @@ def main_worker(gpu, ngpus_per_node, args):
                 'trans_stream_fusion_type': 'conv',
                 'lang_fusion_type': 'mult',
                 'n_rotations':36,
-                'batchnorm':False
+                'batchnorm':False,
+                'attn_rotation_chunk':12  # rotations per attention pass at inference
             }
         }
     device = torch.device(args.gpu)
@@ -219,12 +216,12 @@ def main_worker(gpu, ngpus_per_node, args):
     train_loader = torch.utils.data.DataLoader(
         train_dataset, batch_size=args.batch_size, shuffle=(train_sampler is None),
         num_workers=args.workers, pin_memory=args.pin_memory, sampler=train_sampler, 
-        drop_last=True, collate_fn = collate_fn, persistent_workers=True)
+        drop_last=True, collate_fn = CliportCollate('zyx'), persistent_workers=True)
 
     val_loader = torch.utils.data.DataLoader(
         val_dataset, batch_size=args.batch_size, shuffle=(val_sampler is None),
         num_workers=args.workers, pin_memory=args.pin_memory, sampler=val_sampler, 
-        drop_last=True, collate_fn = collate_fn, persistent_workers=True)
+        drop_last=True, collate_fn = CliportCollate('zxy'), persistent_workers=True)
 
     if args.wandb_entity is not None and args.rank==0:
         import wandb
@@ -294,35 +291,12 @@ def train(data_loader, model, optimizer, scheduler, epoch, losses, args, timer,
     model.train()
     bce_loss = torch.nn.BCELoss(reduction='mean')
     end = time.time()
-    for batch_step, batch_data in enumerate(data_loader):
+    # Batches are assembled by CliportCollate in the loader workers.
+    for batch_step, inp in enumerate(prefetch_to_device(data_loader, args.gpu)):
         data_time.update(time.time() - end)
         loss_dict = {}
-        if len(batch_data)==0:
+        if inp is None:
             continue
-        bounds, pixel_size = batch_data[0]['bounds'], batch_data[0]['pixel_size']
-        img, language_instructions = [], []
-        attention_points, target_points = [], []
-        for data in batch_data:
-            img.append(data['img'])
-            language_instructions += data['language']
-            attention_points.append(data['attention_points'])
-            target_points.append(data['target_points'])
-        img =  np.concatenate(img, axis=0)
-        attention_points =  np.concatenate(attention_points, axis=0)
-        target_points =  np.concatenate(target_points, axis=0)
-        p0 = np.int16((attention_points[:, :2]-bounds[:2,0])/pixel_size)
-        p0_z = attention_points[:, 2:3]-bounds[2,0]
-        p0_rotation = R.from_quat(attention_points[:, 3:])
-        p1 = np.int16((target_points[:, :2]-bounds[:2,0])/pixel_size)
-        p1_z = target_points[:, 2:3]-bounds[2,0]
-        p1_rotation = R.from_quat(target_points[:, 3:])
-        p0 = p0[:,::-1]
-        p1 = p1[:,::-1]
-        p0_rotation = p0_rotation.as_euler('zyx', degrees=True)
-        p1_rotation = p1_rotation.as_euler('zyx', degrees=True)
-        inp = {'img':img, 'lang_goal': language_instructions,
-            'p0':p0, 'p0_z':p0_z, 'p0_rotation':p0_rotation,
-            'p1':p1, 'p1_z':p1_z, 'p1_rotation':p1_rotation}
         loss_dict = model(inp)
 
         if losses == {}:
@@ -368,36 +342,9 @@ def val(data_loader, model, args, epoch):
     losses= {}
     total_loss = []
     model.eval()
-    for batch_step, batch_data in enumerate(data_loader):
-        if len(batch_data)==0:
-            continue
-        bounds, pixel_size = batch_data[0]['bounds'], batch_data[0]['pixel_size']
-        img, language_instructions = [], []
-        attention_points, target_points = [], []
-        for data in batch_data:
-            img.append(data['img'])
-            language_instructions += data['language']
-            attention_points.append(data['attention_points'])
-            target_points.append(data['target_points'])
-        img =  np.concatenate(img, axis=0)
-        attention_points =  np.concatenate(attention_points, axis=0)
-        target_points =  np.concatenate(target_points, axis=0)
-        if (attention_points[:, :2]>bounds[:2,1]).any() or (attention_points[:, :2]<bounds[:2,0]).any() \
-            or (target_points[:, :2]>bounds[:2,1]).any() or (target_points[:, :2]<bounds[:2,0]).any():
+    for batch_step, inp in enumerate(prefetch_to_device(data_loader, args.gpu)):
+        if inp is None or not inp['in_bounds']:
             continue
-        p0 = np.int16((attention_points[:, :2]-bounds[:2,0])/pixel_size)
-        p0_z = attention_points[:, 2:3]-bounds[2,0]
-        # p0_theta = R.from_quat(target_points1[:, 3:]).as_euler('zxy', degrees=True)[:, 0]
-        # p0_theta = np.int8((p0_theta+180)/10)
-        p0_rotation = R.from_quat(attention_points[:, 3:])
-        p1 = np.int16((target_points[:, :2]-bounds[:2,0])/pixel_size)
-        p1_z = target_points[:, 2:3]-bounds[2,0]
-        p1_rotation = R.from_quat(target_points[:, 3:])
-        p0 = p0[:,::-1]
-        p1 = p1[:,::-1]
-        inp = {'img':img, 'lang_goal': language_instructions,
-            'p0':p0, 'p0_z':p0_z, 'p0_rotation':p0_rotation.as_euler('zxy', degrees=True),
-            'p1':p1, 'p1_z':p1_z, 'p1_rotation':p1_rotation.as_euler('zxy', degrees=True)}
         with torch.no_grad():
             loss_dict = model(inp)
         if losses == {}:
@@ -445,6 +392,8 @@ if __name__=="__main__":
     parser.add_argument('--relative', type=lambda x:bool(strtobool(x)), default=False)
     parser.add_argument('--renew_obs', type=lambda x:bool(strtobool(x)), default=True)
     parser.add_argument('--add_low_lang', type=lambda x:bool(strtobool(x)), default=False)
+    parser.add_argument('--heightmap_cache', type=lambda x:bool(strtobool(x)), default=True,
+                        help="keep the fused maps of every episode next to it, see vlm/scripts/heightmap_cache.py")
     #traning
     parser.add_argument('--start_epoch', default=0, type=int)
     parser.add_argument('--epochs', default=15, type=int,
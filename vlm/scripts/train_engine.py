@@ -0,0 +1,117 @@
+"""
+Gradient accumulation under DistributedDataParallel for train_hiverformer.py.
+
+training() steps the optimizer once every accumulate_grad_batches
+micro-batches. GradientAccumulator runs the forward and backward of the
+micro-batches before the last one of a step under DDP's no_sync, so the
+gradients are summed locally and all-reduced once per optimizer step
+instead of after every backward. The average over the ranks of the local
+sums is the sum of the per micro-batch averages, the step is the same.
+
+find_unused_parameters makes DDP traverse the autograd graph after every
+forward, for the parameters that will not get a gradient. Which ones these
+are depends on the architecture and its arguments, not on the batch, so
+wrap_ddp finds them once instead, with a forward and backward of a copy of
+the model (see unused_parameters), and wraps the model without the
+traversal, with DDP ignoring them. They stay trainable: they never had a
+gradient and AdamW skips parameters without one, so training is unchanged.
+Should one get a gradient after all, it would not be all-reduced, so
+GradientAccumulator raises before the optimizer step rather than letting
+the ranks drift apart.
+
+The batches are copied to the GPU with cliport_batch.prefetch_to_device.
+"""
+import copy
+from contextlib import contextmanager, nullcontext
+from typing import Callable, List, Optional, Sequence
+
+import torch
+import torch.distributed as dist
+from torch import nn
+from torch.nn.parallel import DistributedDataParallel
+
+
+def unused_parameters(model: nn.Module, step: Callable[[nn.Module], None]) -> List[str]:
+    """Names of the trainable parameters of `model` left without a gradient by
+    step(copy of model), a forward and backward on a batch.
+
+    The model itself, its buffers and the random state are left untouched.
+    With torch.distributed initialized, a parameter used on any rank counts as
+    used, so every rank gets the same list.
+    """
+    probe = copy.deepcopy(model)
+    for parameter in probe.parameters():
+        parameter.grad = None
+    device = next(model.parameters()).device
+    with torch.random.fork_rng(devices=[device.index] if device.type == 'cuda' else []):
+        step(probe)
+    names, used = [], []
+    for name, parameter in probe.named_parameters():
+        if parameter.requires_grad:
+            names.append(name)
+            used.append(parameter.grad is not None)
+    used = torch.tensor(used, dtype=torch.int32, device=device)
+    if dist.is_available() and dist.is_initialized():
+        dist.all_reduce(used, op=dist.ReduceOp.MAX)
+    return [name for name, u in zip(names, used.tolist()) if not u]
+
+
+def wrap_ddp(model: nn.Module, device_ids: Optional[Sequence[int]] = None,
+             probe_step: Optional[Callable[[nn.Module], None]] = None) -> DistributedDataParallel:
+    """DistributedDataParallel of `model`.
+
+    With `probe_step` (see unused_parameters), DDP ignores the unused
+    parameters and runs without find_unused_parameters; without, it traverses
+    the graph after every forward as train_hiverformer always did.
+    """
+    if probe_step is None:
+        return DistributedDataParallel(model, device_ids=device_ids, find_unused_parameters=True)
+    unused = unused_parameters(model, probe_step)
+    if unused:
+        print('DDP ignores %d parameters without a gradient: %s' % (len(unused), ', '.join(unused)))
+        DistributedDataParallel._set_params_and_buffers_to_ignore_for_model(model, unused)
+    return DistributedDataParallel(model, device_ids=device_ids, find_unused_parameters=False)
+
+
+def check_ignored_unused(model: nn.Module) -> None:
+    """Raises if a parameter the DistributedDataParallel `model` ignores has a gradient."""
+    if not isinstance(model, DistributedDataParallel) or not model.parameters_to_ignore:
+        return
+    used = [name for name, parameter in model.module.named_parameters()
+            if name in model.parameters_to_ignore and parameter.grad is not None]
+    if used:
+        raise RuntimeError('Parameters found unused by wrap_ddp got a gradient, which DDP does not '
+                           'synchronize; run with find_unused_parameters: %s' % ', '.join(used))
+
+
+class GradientAccumulator(object):
+    """Optimizer steps over `accumulate_grad_batches` micro-batches:
+
+        for batch_step, sample in enumerate(loader):
+            with accumulator.micro_batch(batch_step):
+                loss = compute_loss(model(...))
+                loss.backward()
+
+    zero_grad before the first micro-batch of a step, optimizer.step after the
+    last one, as training() did, with the forward and backward of the others
+    under no_sync when `model` is a DistributedDataParallel, and with the
+    parameters it ignores checked for gradients first (see wrap_ddp).
+    """
+
+    def __init__(self, model: nn.Module, optimizer: torch.optim.Optimizer, accumulate_grad_batches: int = 1):
+        self.model = model
+        self.optimizer = optimizer
+        self.accumulate_grad_batches = accumulate_grad_batches
+
+    @contextmanager
+    def micro_batch(self, batch_step: int):
+        first = batch_step % self.accumulate_grad_batches == 0
+        last = batch_step % self.accumulate_grad_batches == self.accumulate_grad_batches - 1
+        if first:
+            self.optimizer.zero_grad()
+        sync = last or not isinstance(self.model, DistributedDataParallel)
+        with nullcontext() if sync else self.model.no_sync():
+            yield
+        if last:
+            check_ignored_unused(self.model)
+            self.optimizer.step()
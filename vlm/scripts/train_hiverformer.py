@@ -19,7 +19,7 @@ import numpy as np
 from tqdm import tqdm, trange
 from filelock import FileLock
 import tap
-from hiverformer.process_instructions import get_language_feat
+from hiverformer.language_features import get_language_feat
 from hiverformer.network import Hiveformer
 from hiverformer.utils import (
     LossAndMetrics,
@@ -31,6 +31,10 @@ from hiverformer.utils import (
     Actioner,
 )
 from vlm.scripts.VLDataloader_renjie import VLM_dataset
+from vlm.scripts.cliport_batch import prefetch_to_device
+from vlm.scripts.train_engine import GradientAccumulator, wrap_ddp
+from hiverformer.metrics import AsyncScalarWriter, DeviceMeter
+from hiverformer.length_sampler import LengthBucketBatchSampler, trim_padding_collate
 import torch.multiprocessing as mp
 import torch.distributed as dist
 
@@ -63,6 +67,8 @@ class Arguments(tap.Tap):
     val_freq: int = 200     # 200
     val_batch_size: int = 16
     jitter: bool = False
+    log_every: int = 50  # batches between two progress lines, the only device syncs of the loop
+    length_buckets: bool = False  # batch episodes of the same number of key frames together
     
     # 自己加的
     train_dir: Path = "/home/liuchang/DATA/rlbench_data"
@@ -93,6 +99,7 @@ class Arguments(tap.Tap):
     gpu_number: int = 0
     ngpus_per_node: int = 0
     distributed: bool = False
+    find_unused_parameters: bool = False  # DDP graph traversal every step instead of the unused parameters found once
 
     # tests
     headless: bool = True
@@ -110,6 +117,19 @@ class Arguments(tap.Tap):
     mode: str = 'keyframe'
 
 
+def model_inputs(sample, device, args: Arguments):
+    """The arguments of Hiveformer.forward for a batch of VLM_dataset."""
+    rgbs = sample["rgbs"].to(device, non_blocking=True).float() # B 4key_frame 3camera 4channel(rgb+attn) 128 128 except for the end index img
+    pcds = sample["pcds"].to(device, non_blocking=True).float() # B 4key_frame 3camera 3channel 128 128 except for the end index pcd
+
+    gripper = sample["gripper"].to(device, non_blocking=True).float() # B 4key_frame 8(action_ls[:-1]) except for the end index action
+    padding_mask = sample["padding_mask"].to(device, non_blocking=True)
+
+    instr = sample["language"] # B 75 512
+    lang_feat = get_language_feat(instr, "clip", args.num_words, device).float().to(device)  # B 75 512
+    return rgbs, pcds, padding_mask, lang_feat, gripper
+
+
 def training(
     model: nn.Module,
     optimizer,
@@ -124,61 +144,45 @@ def training(
     # iter_loader = iter(train_loader)
     device = next(model.parameters()).device
 
+    accumulator = GradientAccumulator(model, optimizer, args.accumulate_grad_batches)
+    scalar_writer = AsyncScalarWriter(writer)
+
     timer = {"batch_time":AverageMeter('Time', ':6.3f')}
     print('---------------------------------------------start------------------------------------------------------')
     for epoch in range(0, args.epochs+1):
-        if args.distributed:
+        if train_sampler is not None:
                 train_sampler.set_epoch(epoch)
 
-        # 累计每一个 epoch 的所有 loss
-        total_loss = {"position":0, "rotation":0, "gripper":0, "task":0, "total":0}
-        total_metrics = {"position":0, "rotation":0, "gripper":0, "task":0, "total":0}
+        # 累计每一个 epoch 的所有 loss，留在 GPU 上，每 log_every 个 batch 才读回来一次
+        epoch_meter = DeviceMeter(device)
+        interval_meter = DeviceMeter(device)
 
         batch_time = timer["batch_time"]
         end = time.time()
         
-        for batch_step, batch_data in enumerate(train_loader):
+        # The tensors of the pinned batches are already on their way to the GPU during the previous step.
+        for batch_step, batch_data in enumerate(prefetch_to_device(train_loader, device)):
             sample = batch_data
-            
-            rgbs = sample["rgbs"].float().to(device) # B 4key_frame 3camera 4channel(rgb+attn) 128 128 except for the end index img
-            pcds = sample["pcds"].float().to(device) # B 4key_frame 3camera 3channel 128 128 except for the end index pcd
-
-            gripper = sample["gripper"].float().to(device) # B 4key_frame 8(action_ls[:-1]) except for the end index action
-            padding_mask = sample["padding_mask"].to(device)
-
-            instr = sample["language"] # B 75 512
-            lang_feat = get_language_feat(instr, "clip", args.num_words, device).float().to(device)  # B 75 512
-
-            if batch_step % args.accumulate_grad_batches == 0:
-                optimizer.zero_grad()
-
-            pred = model(
-                rgbs,    
-                pcds,
-                padding_mask,
-                lang_feat,
-                gripper,
-            )
-
-            train_losses = loss_and_metrics.compute_loss(pred, sample)
-            train_losses["total"] = sum(list(train_losses.values()))  # type: ignore
 
-            for n, l in train_losses.items():
-                total_loss[n] += l
+            with accumulator.micro_batch(batch_step):
+                pred = model(*model_inputs(sample, device, args))
 
-            metrics = loss_and_metrics.compute_metrics(pred, sample)
-            for n, l in metrics.items():
-                total_metrics[n] += l
+                train_losses = loss_and_metrics.compute_loss(pred, sample)
+                train_losses["total"] = sum(list(train_losses.values()))  # type: ignore
 
-            train_losses["total"].backward()  # type: ignore
+                metrics = loss_and_metrics.compute_metrics(pred, sample)
+                values = {f"train-loss/{n}": l for n, l in train_losses.items()}
+                values.update({f"train-metrics/{n}": l for n, l in metrics.items()})
+                epoch_meter.update(values)
+                interval_meter.update({"total": train_losses["total"]})
 
-            if batch_step % args.accumulate_grad_batches == args.accumulate_grad_batches - 1:
-                optimizer.step()
+                train_losses["total"].backward()  # type: ignore
 
-            # tbar.set_postfix(l=float(train_losses["total"]))
-            # 计算时间
+            # 计算时间 (without syncs, the time to queue the batch until the next progress line)
             batch_time.update(time.time() - end)
             end = time.time()
+            if (batch_step + 1) % args.log_every != 0 and batch_step + 1 != len(train_loader):
+                continue
             time_per_epoch = batch_time.avg * len(train_loader)
             epochs_left = args.epochs - epoch - 1
             batches_left = len(train_loader) - batch_step - 1
@@ -191,8 +195,8 @@ def training(
                     'rank: {}  ' \
                     'Elapsed: {}  ' \
                     'ETA: {} / {}  '\
-                    'total loss: {}  '.format(epoch+1, args.epochs, batch_step+1, len(train_loader), args.rank,
-            time_elapsed, time_left, time_estimate, train_losses["total"])
+                    'total loss: {:.5f}  '.format(epoch+1, args.epochs, batch_step+1, len(train_loader), args.rank,
+            time_elapsed, time_left, time_estimate, interval_meter.means()["total"])
 
             print(tmp_str)
 
@@ -214,13 +218,11 @@ def training(
             if args.rank == 0 and checkpointer is not None:
                 checkpointer(val_metrics)
 
-        # 写入Tensorboard
-        if writer is not None:
-            for key, value in total_loss.items():
-                writer.add_scalar(f"train-loss/{key}", value/len(train_loader), epoch+1)
-            for key, value in total_metrics.items():
-                writer.add_scalar(f"train-metrics/{key}", value/len(train_loader), epoch+1)
-            
+        # 写入Tensorboard，所有进程的平均值，每个 epoch 只 all_reduce 一次
+        scalar_writer.add_scalars(epoch_meter.means(all_reduce=args.distributed), epoch+1)
+
+    scalar_writer.close()
+
 def get_log_dir(args: Arguments) -> Path:
     log_dir = args.xp / args.name
     task = list(args.tasks)[0].split("_")[0]
@@ -391,14 +393,13 @@ def main(gpu, ngpus_per_node, args):
         num_tasks=args.num_tasks,
     )
 
+    # The model is wrapped in DistributedDataParallel once the train_loader is built, see below.
     if args.distributed:
         if args.gpu is not None:
             torch.cuda.set_device(args.gpu)
             model.cuda(args.gpu)
-            model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu], find_unused_parameters=True)
         else:
             model.cuda()
-            model = torch.nn.parallel.DistributedDataParallel(model, find_unused_parameters=True)
     else:
         model.cuda(args.gpu)
 
@@ -419,10 +420,7 @@ def main(gpu, ngpus_per_node, args):
     # 加载模型
     if args.checkpoint is not None:
         model_dict = torch.load(args.checkpoint, map_location="cpu")
-        if args.distributed:
-            model.module.load_state_dict(model_dict["weight"])
-        else:
-            model.load_state_dict(model_dict["weight"])
+        model.load_state_dict(model_dict["weight"])
         optimizer.load_state_dict(model_dict["optimizer"])
 
     print(model)
@@ -436,7 +434,7 @@ def main(gpu, ngpus_per_node, args):
 
     # 保存模型参数，以及构建需要的 checkpoint 实例
     model_dict = {
-        "weight": model.module.state_dict() if args.distributed else model.state_dict(),
+        "weight": model.state_dict(),
         "optimizer": optimizer.state_dict(),
     }
 
@@ -464,20 +462,32 @@ def main(gpu, ngpus_per_node, args):
             args=args
     )
 
-    if args.distributed:
-        train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset)
+    # 每个 batch 只 pad 到它自己最长的那个 episode
+    if args.length_buckets:
+        train_sampler = LengthBucketBatchSampler(train_dataset.valid_lengths(), args.batch_size, seed=args.seed)
+        train_loader = torch.utils.data.DataLoader(
+                train_dataset,
+                batch_sampler=train_sampler,
+                num_workers=args.workers,
+                pin_memory=True,
+                collate_fn=trim_padding_collate,
+                persistent_workers=args.persistent_workers)
     else:
-        train_sampler = None
-
-    train_loader = torch.utils.data.DataLoader(  
-            train_dataset, 
-            batch_size=args.batch_size, 
-            shuffle=(train_sampler is None),
-            num_workers=args.workers, 
-            pin_memory=True, 
-            sampler=train_sampler, 
-            drop_last=True,
-            persistent_workers=args.persistent_workers) #,persistent_workers=True
+        if args.distributed:
+            train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset)
+        else:
+            train_sampler = None
+
+        train_loader = torch.utils.data.DataLoader(  
+                train_dataset, 
+                batch_size=args.batch_size, 
+                shuffle=(train_sampler is None),
+                num_workers=args.workers, 
+                pin_memory=True, 
+                sampler=train_sampler, 
+                drop_last=True,
+                collate_fn=trim_padding_collate,
+                persistent_workers=args.persistent_workers) #,persistent_workers=True
     
     # 构建验证集和 val_loader
     val_dataset = VLM_dataset(
@@ -508,6 +518,19 @@ def main(gpu, ngpus_per_node, args):
     #         persistent_workers=args.persistent_workers) #,persistent_workers=True
     
     val_loader = None
+
+    # 分布式训练：只在最后一个 micro-batch 同步梯度，不用的参数在开始时找一次
+    if args.distributed:
+        device = next(model.parameters()).device
+
+        def probe_step(net):
+            sample = next(iter(train_loader))
+            losses = loss_and_metrics.compute_loss(net(*model_inputs(sample, device, args)), sample)
+            sum(losses.values()).backward()
+
+        model = wrap_ddp(model, device_ids=[args.gpu] if args.gpu is not None else None,
+                         probe_step=None if args.find_unused_parameters else probe_step)
+
     # 开始训练
     training(
         model,
@@ -4,42 +4,8 @@ import transform
 import einops
 # from param import args
 
-# Identify way-point in each RLBench Demo
-def _is_stopped(demo, i, obs, stopped_buffer):
-    next_is_not_final = i == (len(demo) - 2)
-    gripper_state_no_change = i < (len(demo) - 2) and (
-        obs.gripper_open == demo[i + 1].gripper_open
-        and obs.gripper_open == demo[i - 1].gripper_open
-        and demo[i - 2].gripper_open == demo[i - 1].gripper_open
-    )
-    small_delta = np.allclose(obs.joint_velocities, 0, atol=0.1)
-    stopped = (
-        stopped_buffer <= 0
-        and small_delta
-        and (not next_is_not_final)
-        and gripper_state_no_change
-    )
-    return stopped
-
-def keypoint_discovery(demo):
-    episode_keypoints = []
-    prev_gripper_open = demo[0].gripper_open
-    stopped_buffer = 0
-    for i, obs in enumerate(demo):
-        stopped = _is_stopped(demo, i, obs, stopped_buffer)
-        stopped_buffer = 4 if stopped else stopped_buffer - 1
-        # If change in gripper, or end of episode.
-        last = i == (len(demo) - 1)
-        if i != 0 and (obs.gripper_open != prev_gripper_open or last or stopped):
-            episode_keypoints.append(i)
-        prev_gripper_open = obs.gripper_open
-    if (
-        len(episode_keypoints) > 1
-        and (episode_keypoints[-1] - 1) == episode_keypoints[-2]
-    ):
-        episode_keypoints.pop(-2)
-    # HACK for tower3 task
-    return episode_keypoints
+# Identify way-point in each RLBench Demo (implemented in amsolver.keypoints)
+from amsolver.keypoints import keypoint_discovery, episode_keypoints
 
 def max_sperate_index(inputs):
     max = 0
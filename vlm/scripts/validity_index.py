@@ -0,0 +1,91 @@
+"""
+Validity of the episodes of VLM_dataset, scanned from the low dimensional index.
+
+An episode is invalid when one of its pick or place points lies outside the
+bounds of the fused maps. get_cliport_gt only found out after loading and
+fusing the frames, and the dataset then loaded another episode in its place.
+The points only depend on the object informations of the waypoint frames, so
+every episode of a split is checked on the LowDimIndex alone and the result
+kept in a pack file (see amsolver.episode_store) at the split root:
+    valid  uint8  ceil(E / 8)  np.packbits of the episodes of the header
+with the episodes and their low_dim_obs.pkl stamps in the header. The file
+name holds a key of the settings the check depends on.
+
+Stale or missing episodes are checked again when the bitmap is opened; a
+whole split can be scanned upfront with tools/build_validity_index.py.
+"""
+import hashlib
+import json
+from pathlib import Path
+from typing import Callable, Dict, Sequence
+
+import numpy as np
+
+from amsolver.episode_store import read_pack, write_pack
+from amsolver.low_dim_index import EpisodeLowDim, LowDimIndex
+
+VALIDITY_VERSION = 1
+
+
+def validity_key(settings: Dict) -> str:
+    config = json.dumps([VALIDITY_VERSION, settings], sort_keys=True)
+    return hashlib.sha1(config.encode('utf-8')).hexdigest()[:10]
+
+
+def validity_path(dataset_path: Path, key: str) -> Path:
+    return Path(dataset_path) / f'validity_{key}.pack'
+
+
+class ValidityIndex(object):
+    """Validity of every scanned episode of a split, for one set of settings."""
+
+    def __init__(self, dataset_path, settings: Dict):
+        self.path = validity_path(dataset_path, validity_key(settings))
+        self._episodes: Dict[str, Dict] = {}
+        if not self.path.is_file():
+            return
+        try:
+            header, arrays = read_pack(self.path)
+        except (RuntimeError, ValueError, KeyError):
+            return
+        if header.get('version') != VALIDITY_VERSION:
+            return
+        valid = np.unpackbits(arrays['valid'], count=len(header['episodes'])).astype(bool)
+        for episode, stamp, v in zip(header['episodes'], header['stamps'], valid):
+            self._episodes[episode] = {'stamp': stamp, 'valid': bool(v)}
+
+    @classmethod
+    def open(cls, dataset_path, settings: Dict, episodes: Sequence, low_dim_index: LowDimIndex,
+             check: Callable[[str, EpisodeLowDim], bool]) -> 'ValidityIndex':
+        """Validity of `episodes` under `settings`, checking the stale ones with `check(episode, low_dim)`."""
+        index = cls(dataset_path, settings)
+        stale = []
+        for e in episodes:
+            record = index._episodes.get(str(e))
+            if record is None or record['stamp'] != low_dim_index[e].stamp:
+                stale.append(e)
+        if stale:
+            for e in stale:
+                low_dim = low_dim_index[e]
+                index._episodes[str(e)] = {'stamp': low_dim.stamp, 'valid': bool(check(e, low_dim))}
+            index.write()
+        return index
+
+    def write(self) -> None:
+        episodes = sorted(self._episodes)
+        valid = np.array([self._episodes[e]['valid'] for e in episodes], dtype=bool)
+        header = {
+            'version': VALIDITY_VERSION,
+            'episodes': episodes,
+            'stamps': [self._episodes[e]['stamp'] for e in episodes],
+        }
+        write_pack(self.path, {'valid': np.packbits(valid)}, header)
+
+    def __contains__(self, episode) -> bool:
+        return str(episode) in self._episodes
+
+    def __len__(self) -> int:
+        return len(self._episodes)
+
+    def __getitem__(self, episode) -> bool:
+        return self._episodes[str(episode)]['valid']
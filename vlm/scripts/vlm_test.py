@@ -2,6 +2,7 @@ import argparse
 import os
 import random
 from distutils.util import strtobool
+from functools import partial
 from pathlib import Path
 
 import cv2
@@ -15,7 +16,7 @@ from pytorch_transformers import BertTokenizer
 from scipy.spatial.transform import Rotation as R
 from torch.autograd import Variable
 # from train_vlmbench import load
-from hiverformer.process_instructions import get_language_feat
+from hiverformer.language_features import get_language_feat
 from amsolver.action_modes import ActionMode, ArmActionMode
 from amsolver.backend.utils import task_file_to_task_class
 from amsolver.environment import Environment
@@ -25,6 +26,7 @@ from cliport.agent import (BlindLangAgent_6Dof, ImgDepthAgent_6dof,
                            TwoStreamClipLingUNetLatTransporterAgent)
 from hiverformer.network import Hiveformer
 from hiverformer.utils import obs_to_attn,RLBenchEnv,Mover
+from vlm.scripts.eval_scheduler import EvalItem, EvalScheduler, format_stats
 
 
 # from param import args
@@ -73,7 +75,8 @@ class CliportAgent(object):
                 'trans_stream_fusion_type': 'conv',
                 'lang_fusion_type': 'mult',
                 'n_rotations':36,
-                'batchnorm':False
+                'batchnorm':False,
+                'attn_rotation_chunk':12  # rotations per attention pass at inference
             }
         }
         device = torch.device(device_id)
@@ -167,9 +170,6 @@ class CliportAgent(object):
 class hiveformerAgent():
     def __init__(self,args=None):
         self.args = args
-        self.rgbs = torch.Tensor([])
-        self.pcds = torch.Tensor([])
-        self.grippers = torch.Tensor([])
         self.tok = BertTokenizer.from_pretrained('/home/liuchang/projects/VLMbench/VLMbench/vlm/scripts/base-no-labels/ep_67_588997')
         self.env = RLBenchEnv(
         data_path="",
@@ -194,19 +194,13 @@ class hiveformerAgent():
             self.model.load_state_dict(model_dict["weight"])
             print("loading model from "+ str(args.load))
     def clear (self):
-        self.rgbs = torch.Tensor([])
-        self.pcds = torch.Tensor([])
-        self.grippers = torch.Tensor([])
+        self.model.reset_history()
     
     def act(self,obs,language,action_feat,step,step_id):
         # current_waypoint,_, attention_id, gripper_control, waypoint_type, related_rotation, gt_pose  = step
         with torch.no_grad():
             ob = obs # get current obs
             rgb,pcd,gripper = self.env.get_rgb_pcd_gripper_from_obs(ob)
-            self.rgbs = torch.cat([self.rgbs , rgb.unsqueeze(1)], dim=1)
-            self.pcds = torch.cat([self.pcds , pcd.unsqueeze(1)], dim=1)
-            self.grippers = torch.cat([self.grippers , gripper.unsqueeze(1)], dim=1)
-            padding_mask = torch.ones_like(self.rgbs[:, :, 0, 0, 0, 0]).bool().cuda()
 
             # lang_tokens = self.tok.tokenize(language)
             # language = ['[CLS]'] + language + ['[SEP]']
@@ -215,16 +209,16 @@ class hiveformerAgent():
             # print(language)
             lang = []
             lang.append(language)
-            language = get_language_feat(lang,"clip",75,device=padding_mask.device)
+            language = get_language_feat(lang,"clip",75,device="cuda")
 
             # self.model.eval()
-            
-            pred = self.model(
-                self.rgbs.cuda(),
-                self.pcds.cuda(),
-                padding_mask,
+
+            # Only the new frame is encoded, see Hiveformer.step
+            pred = self.model.step(
+                rgb.cuda(),
+                pcd.cuda(),
                 language.cuda(),
-                self.grippers.cuda(),
+                gripper.cuda(),
             )
             action = self.model.compute_action(pred)  # type: ignore
 
@@ -347,176 +341,136 @@ def add_argments():
     parser.add_argument('--wandb_entity', type=str, default=None, help="visualize the test results. Account Name")
     parser.add_argument('--agent', type=str, default="hiveformerAgent", help="test agent")
     parser.add_argument('--wandb_project', type=str, default=None,  help="visualize the test results. Project Name")
+    parser.add_argument('--processes', type=int, default=1, help="simulator processes evaluating the episodes in parallel")
     args = parser.parse_args()
     return args
 
+class VLMTestEvaluator(object):
+    """Simulator and agent of one evaluation process, see vlm/scripts/eval_scheduler.py."""
+
+    def __init__(self, args, worker_id=0):
+        self.args = args
+        set_seed(0)
+        obs_config = set_obs_config(args.img_size)
+        task_files, self.env = set_env(args, obs_config)
+        self.env.launch()
+        self.task_classes = {t: task_file_to_task_class(t, parent_folder = 'vlm') for t in task_files}
+        # Environment.get_task unloads the scene of the previous task env, so
+        # only the env of the last loaded task can be used.
+        self.task_file = None
+        self.task = None
+        if args.recorder:
+            self.recorder = Recorder()
+        else:
+            self.recorder = None
+        if args.agent == "CliportAgent":
+            checkpoint = args.checkpoints
+            self.agent = CliportAgent(args.model_name, device_id=args.gpu,z_roll_pitch=True, checkpoint=checkpoint, args=args)
+        elif args.agent =="hiveformerAgent":
+            self.agent = hiveformerAgent(args)
+        else:
+            self.agent = ReplayAgent()
+
+    def get_task(self, task_file):
+        if task_file != self.task_file:
+            self.task_file = None
+            self.task = self.env.get_task(self.task_classes[task_file])
+            self.task_file = task_file
+        return self.task
+
+    def evaluate(self, task_file, episode):
+        args, agent, recorder = self.args, self.agent, self.recorder
+        task = self.get_task(task_file)
+        e = Path(episode)
+        task_base = str(e/"task_base.ttm")
+        waypoint_sets = str(e/"waypoint_sets.ttm")
+        config = str(e/"configs.pkl")
+        descriptions, obs = task.load_config(task_base, waypoint_sets, config)
+        waypoints_info = {name: obj for name, obj in obs.object_informations.items() if "waypoint" in name}
+        high_descriptions = descriptions[0]
+        step=0
+        if args.add_low_lang:
+            for waypoint in waypoints_info:
+                if "low_level_descriptions" in waypoints_info[waypoint]:
+                    high_descriptions = high_descriptions+f" Step {num2words(step)}:"
+                    high_descriptions += waypoints_info[waypoint]["low_level_descriptions"]
+                    step+=1
+        print(high_descriptions)
+        target_grasp_obj_name = None
+        try:
+            if len(waypoints_info['waypoint1']['target_obj_name'])!=0:
+                target_grasp_obj_name = waypoints_info['waypoint1']['target_obj_name']
+                grasp_pose = waypoints_info['waypoint1']['pose'][0]
+            else:
+                grasp_pose = waypoints_info['waypoint1']['pose'][0]
+                target_name = None
+                distance = np.inf
+                for g_obj in task._task.get_graspable_objects():
+                    obj_name = g_obj.get_name()
+                    obj_pos = g_obj.get_position()
+                    c_distance = np.linalg.norm(obj_pos-grasp_pose[:3])
+                    if c_distance < distance:
+                        target_name = obj_name
+                        distance = c_distance
+                if distance < 0.2:
+                    target_grasp_obj_name = target_name
+        except:
+            print(f"need re-generate: {e}")
+            # Still counted in the total, as a failure.
+            return {'success': False, 'grasp_success': False, 'steps': 0, 'error': 'need re-generate'}
+        history_img = [obs]
+        history_action = [(np.append(obs.gripper_pose,obs.gripper_open))]
+        grasped, successed = False, False
+        steps = 0
+        for i in range(args.maxAction):
+            print(i)
+            if args.agent =="hiveformerAgent" and i==0:
+                agent.clear()
+            action = agent.act(obs,high_descriptions,history_action,step,i)
+            print("action:")
+            print(action)
+            steps += 1
+            try:
+                obs, reward, terminate = task.step(action, None , recorder = recorder, need_grasp_obj = target_grasp_obj_name)
+                history_img.append(obs)
+                history_action.append((np.append(obs.gripper_pose,obs.gripper_open)))
+            except:
+                reward = 0
+                break
+            if reward == 0.5:
+                grasped = True
+            elif reward == 1:
+                successed = True
+                break
+        if recorder is not None:
+            recorder.save(f"./records_{args.agent}/{task.get_name()}/{e.parents[1].name}_{e.name}.avi")
+            recorder.del_snap()
+        print(f"{task.get_name()} {e}: success {successed}, grasp success {grasped}")
+        return {'success': successed, 'grasp_success': grasped, 'steps': steps}
+
+    def shutdown(self):
+        self.env.shutdown()
+
+
 if __name__=="__main__":
     args = add_argments()
     if args.wandb_entity is not None:
         import wandb
-    set_seed(0)
-    obs_config = set_obs_config(args.img_size)
-    # recorder = Recorder()
-    need_test_numbers = 20
-    replay_test = args.replay
-    
-    renew_obs = args.renew_obs
-    task_files,env = set_env(args,obs_config)
-
-    env.launch()
-
-    if args.recorder:
-        recorder = Recorder()
-    else:
-        recorder = None
-
-    train_tasks = [task_file_to_task_class(t, parent_folder = 'vlm') for t in task_files]
+    # Only resolves the task files (and the args they change), the simulator runs in the evaluators.
+    task_files, _ = set_env(args, set_obs_config(args.img_size))
     data_folder = Path(os.path.join(args.data_folder, args.setd))
-
-
-    # if not replay_test:
-    #     checkpoint = args.checkpoints
-    #     agent = CliportAgent(args.model_name, device_id=args.gpu,z_roll_pitch=True, checkpoint=checkpoint, args=args)
-    # else:
-    #     agent = ReplayAgent()
-    if args.agent == "CliportAgent":
-        checkpoint = args.checkpoints
-        agent = CliportAgent(args.model_name, device_id=args.gpu,z_roll_pitch=True, checkpoint=checkpoint, args=args)
-    elif args.agent =="hiveformerAgent":
-        agent = hiveformerAgent(args)
-    else:
-        agent = ReplayAgent()
+    items = [EvalItem(t, str(e)) for t in task_files for e in load_test_config(data_folder, t)]
 
     output_file_name = f"/home/liuchang/projects/VLMbench/VLMbench/results_{args.agent}/{args.agent}_{args.task}_{args.setd}"
     if args.goal_conditioned:
         output_file_name += "_goalcondition"
     if args.ignore_collision:
         output_file_name += "_ignore"
-    output_file_name += ".txt"
-    file = open(output_file_name, "w")
-    for i, task_to_train in enumerate(train_tasks):
-        e_path = load_test_config(data_folder, task_files[i])
-        success_times,grasp_success_times,all_time = 0,0,0
-        task = env.get_task(task_to_train)
-        # move = Mover(task, max_tries=10)
-        for num, e in enumerate(e_path):
-            task_base = str(e/"task_base.ttm")
-            waypoint_sets = str(e/"waypoint_sets.ttm")
-            config = str(e/"configs.pkl")
-            descriptions, obs = task.load_config(task_base, waypoint_sets, config)
-            waypoints_info = {name: obj for name, obj in obs.object_informations.items() if "waypoint" in name}
-            all_time+=1
-            high_descriptions = descriptions[0]     
-            step=0
-            if args.add_low_lang:
-                for waypoint in waypoints_info:
-                    if "low_level_descriptions" in waypoints_info[waypoint]:
-                        high_descriptions = high_descriptions+f" Step {num2words(step)}:"
-                        high_descriptions += waypoints_info[waypoint]["low_level_descriptions"]
-                        step+=1
-            print(high_descriptions)
-            target_grasp_obj_name = None
-            try:
-                if len(waypoints_info['waypoint1']['target_obj_name'])!=0:
-                    target_grasp_obj_name = waypoints_info['waypoint1']['target_obj_name']
-                    grasp_pose = waypoints_info['waypoint1']['pose'][0]
-                else:
-                    grasp_pose = waypoints_info['waypoint1']['pose'][0]
-                    target_name = None
-                    distance = np.inf
-                    for g_obj in task._task.get_graspable_objects():
-                        obj_name = g_obj.get_name()
-                        obj_pos = g_obj.get_position()
-                        c_distance = np.linalg.norm(obj_pos-grasp_pose[:3])
-                        if c_distance < distance:
-                            target_name = obj_name
-                            distance = c_distance
-                    if distance < 0.2:
-                        target_grasp_obj_name = target_name
-            except:
-                print(f"need re-generate: {e}")
-                continue
-            step_list = CliportAgent.generate_action_list(waypoints_info, args)
-            history_img = [obs]
-            history_action = [(np.append(obs.gripper_pose,obs.gripper_open))]
-            hidden_states,rewards,actions = [],[],[]
-            use_gt_xy,use_gt_z,use_gt_theta,use_gt_roll_pitch = False ,False,True,True
-            grasped = False
-            for i in range(args.maxAction):
-                print(i)
-                # x_loss,y_loss,z_loss=0,0,0
-                # step = step_list[i]
-                if args.agent =="hiveformerAgent" and i==0:
-                    agent.clear()     
-                action = agent.act(obs,high_descriptions,history_action,step,i)         
-                print("action:")
-                print(action)
-                # current_waypoint,_, attention_id, gripper_control, waypoint_type, related_rotation, gt_pose  = step
-                # print("gt_pose:")
-                # print(gt_pose)
-                # if waypoint_type == "grasp":
-                #     collision_checking = False 
-                #     pre_action = action.copy()
-                #     pose = R.from_quat(action[3:7]).as_matrix()
-                #     pre_action[:3] -= 0.08*pose[:, 2]
-                #     pre_action[7] = 1
-                #     # action_list+=[pre_action, action]
-                # else: 
-                #     collision_checking = True
-                
-                # x_loss=(action[0]-gt_pose[0])
-                # y_loss=(action[1]-gt_pose[1])
-                # z_loss=(action[2]-gt_pose[2])
-                # if args.goal_conditioned:
-                #     action[:7] = gt_pose
-                #     action[7] = gripper_control
-                # action[3:7]=gt_pose[3:7]
-                # if i == len(step_list)-1:
-                #     action[7] = 1
-                # file.write(f"{task.get_name()}:x_loss: {x_loss}, y_loss: {y_loss}, z_loss {z_loss} %!\n")
-                # print(f"{task.get_name()}:x_loss: {x_loss}, y_loss: {y_loss}, z_loss {z_loss} %!\n")
-                try:
-                    # if waypoint_type == "grasp":
-                    # obs, reward, terminate = task.step(pre_action, None, recorder = recorder, need_grasp_obj = target_grasp_obj_name)
-                    # if i == 1:
-                    #     collision_checking = False  
-                    # else :
-                    #     collision_checking = True
-                    # if i == 1:
-                    #     print("grasp_pose:")
-                    #     print(grasp_pose)
-                    #     action[:7] = grasp_pose
-                    #     action[7] = 0 
-                    obs, reward, terminate = task.step(action, None , recorder = recorder, need_grasp_obj = target_grasp_obj_name)
-                    history_img.append(obs)
-                    history_action.append((np.append(obs.gripper_pose,obs.gripper_open)))
-                except:
-                    reward = 0 
-                    break
-                # rewards.append(reward)
-                if reward == 0.5:
-                    grasped = True
-                    grasp_success_times+=1
-                elif reward == 1:
-                    success_times+=1
-                    successed = True
-                    break
-            # if reward == 1 or grasped == True:
-            recorder.save(f"./records_{args.agent}/{task.get_name()}/{num+1}.avi")
-            recorder.del_snap()
-            print(f"{task.get_name()}: success {success_times} times in {all_time} steps! success rate {round(success_times/all_time * 100, 2)}%!")
-            print(f"{task.get_name()}: grasp success {grasp_success_times} times in {all_time} steps! grasp success rate {round(grasp_success_times/all_time * 100, 2)}%!")
-            file.write(f"{task.get_name()}:grasp success: {grasp_success_times}, success: {success_times}, toal {all_time} steps, success rate: {round(success_times/all_time * 100, 2)}%!\n\n")   
-    file.close()
-    env.shutdown()
-
-
-
-
-        
-
-
-
-
-
-
+    # Results of every episode go to the ledger of this folder, a run that died is resumed.
+    scheduler = EvalScheduler(output_file_name, items, partial(VLMTestEvaluator, args), args.processes)
+    stats = scheduler.run()
+    lines = format_stats(stats)
+    print("\n".join(lines))
+    with open(output_file_name + ".txt", "w") as file:
+        for line in lines:
+            file.write(line + "\n\n")
@@ -7,7 +7,7 @@ from pathlib import Path
 import numpy as np
 from num2words import num2words
 import pickle
-from vlm.scripts.utils import keypoint_discovery
+from vlm.scripts.utils import episode_keypoints
 from amsolver.utils import get_stored_demos
 import torch
 from hiverformer.utils import RLBenchEnv
@@ -31,7 +31,7 @@ from pytorch_transformers import BertTokenizer
 from scipy.spatial.transform import Rotation as R
 from torch.autograd import Variable
 # from train_vlmbench import load
-from hiverformer.process_instructions import get_language_feat
+from hiverformer.language_features import get_language_feat
 from amsolver.action_modes import ActionMode, ArmActionMode
 from amsolver.backend.utils import task_file_to_task_class
 from amsolver.environment import Environment
@@ -177,7 +177,7 @@ if __name__=="__main__":
                 low_dim_obs = str(e/"low_dim_obs.pkl")
                 with open(low_dim_obs, 'rb') as f:
                     demo_temple = pickle.load(f)
-                    key_frames = keypoint_discovery(demo_temple._observations)
+                    key_frames = episode_keypoints(e, demo_temple._observations)
                 if 0 not in key_frames:
                     key_frames.insert(0,0)
                 if (len(demo_temple)-1) not in key_frames: